@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''
+Module of the statistics of the API calls.
+
+The Kodi and echonest calls are counted by method, with their errors,
+retries, bytes sent and received. The latencies go to histograms with
+buckets growing by BUCKET_RATIO, and a percentile is the geometric middle
+of its bucket, so it is known within 10% (the square root of the ratio)
+whatever the number of calls, without keeping the measures.
+'''
+
+import threading
+import math
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+# global constants
+BUCKET_RATIO = 1.2
+# upper limit of the first bucket, in seconds
+BUCKET_MIN = 0.0001
+PERCENTILES = (50, 95, 99)
+
+class Histogram(object):
+    '''Counts of the values by geometric bucket'''
+
+    def __init__(self):
+        self.counts = {}
+        self.nb_values = 0
+
+    def add(self, value):
+        if value <= BUCKET_MIN:
+            bucket = 0
+        else:
+            bucket = int(math.ceil(
+                math.log(value / BUCKET_MIN, BUCKET_RATIO)))
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.nb_values += 1
+
+    def percentile(self, percent):
+        '''Geometric middle of the bucket of the percentile'''
+        if not self.nb_values:
+            return None
+        rank = percent / 100.0 * self.nb_values
+        nb_values = 0
+        for bucket in sorted(self.counts):
+            nb_values += self.counts[bucket]
+            if nb_values >= rank:
+                break
+        if not bucket:
+            # the first bucket has no lower limit
+            return BUCKET_MIN
+        return BUCKET_MIN * BUCKET_RATIO ** (bucket - 0.5)
+
+class MethodStats(object):
+    '''Statistics of the calls of an API method'''
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.total_time = 0.0
+        self.latency = Histogram()
+
+    def as_dict(self):
+        ret = {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'mean': self.total_time / self.calls if self.calls else None}
+        for percent in PERCENTILES:
+            ret['p%i' % percent] = self.latency.percentile(percent)
+        return ret
+
+# statistics by API and method
+stats = {}
+lock = threading.Lock()
+
+def method_stats(api, method):
+    '''Statistics of a method, lock is held'''
+    if (api, method) not in stats:
+        stats[(api, method)] = MethodStats()
+    return stats[(api, method)]
+
+def command_method(command):
+    '''Method of a JSON-RPC command, batches are counted apart'''
+    if isinstance(command, list):
+        return 'batch'
+    return command.get('method')
+
+def record(api, method, latency, bytes_out=0, bytes_in=0, error=False):
+    '''Count a call of the method'''
+    with lock:
+        method_stat = method_stats(api, method)
+        method_stat.calls += 1
+        method_stat.errors += int(bool(error))
+        method_stat.bytes_out += bytes_out
+        method_stat.bytes_in += bytes_in
+        method_stat.total_time += latency
+        method_stat.latency.add(latency)
+
+def record_retry(api, method):
+    '''Count a call sent again after a failure'''
+    with lock:
+        method_stats(api, method).retries += 1
+
+def summary(api=None):
+    '''Statistics of all methods, sorted by API and method'''
+    with lock:
+        ret = []
+        for (stat_api, method), method_stat in sorted(stats.items()):
+            if api is not None and stat_api != api:
+                continue
+            entry = method_stat.as_dict()
+            entry['api'] = stat_api
+            entry['method'] = method
+            ret.append(entry)
+        return ret
+
+def dump(fname):
+    '''Write the statistics to a JSON file'''
+    logger.debug('call dump for %s', fname)
+    f = open(fname, 'w')
+    json.dump(summary(), f, indent=2, sort_keys=True)
+    f.close()
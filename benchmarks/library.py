@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''
+Library benchmark of PyKodi, at several library sizes.
+
+For each size, a synthetic library is written to snapshot files (or to a
+SQLite store) in a temporary directory, then the load, the searches, the
+profile delta and the songs sync against the mock Kodi server are timed.
+The mock server runs in another process, so it does not share the
+interpreter lock with the measured code. The library files are written by
+a process of their own and each size is measured in a fresh process, so the
+peak memory is the one of the measured code only. The results are written as JSON and can be
+compared with a previous run:
+
+    $ python benchmarks/library.py --sizes 10000 100000 -o after.json \\
+            --compare before.json
+'''
+
+import subprocess
+import contextlib
+import re
+import argparse
+import platform
+import tempfile
+import resource
+import shutil
+import json
+import time
+import os
+import sys
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+sys.path.insert(0, BENCHMARKS)
+import mock_kodi
+
+# global constants
+SIZES = [10000, 100000, 1000000]
+REPEATS = 5
+SEARCHES = {
+        'songs': [u'love', u'cafe', u'artist 1', u'zz'],
+        'albums': [u'night', u'album river 1'],
+        'genres': [u'rock', u'hip-hop']}
+# songs played on the server between the two syncs
+NB_PLAYED = 100
+
+class Library(object):
+    '''Stand-in for the prompt object, which holds the library'''
+
+    def __init__(self, kodi_params):
+        self.kodi_params = kodi_params
+        self.songs = {}
+        self.albums = {}
+        self.songs_index = None
+        self.albums_index = None
+        self.genres_index = None
+        self.library_progress = {}
+
+@contextlib.contextmanager
+def quiet():
+    '''Hide the output of PyKodi'''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def build_search_indexes(pykodi, obj):
+    '''Create the search indexes and build them now, not on first use'''
+    pykodi.build_search_indexes(obj)
+    for index in (obj.songs_index, obj.albums_index, obj.genres_index):
+        index.build()
+
+def timed(timings, name, function, repeats=1):
+    '''Run the function, keep its median time, return its last result'''
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        with quiet():
+            ret = function()
+        times.append(time.time() - start)
+    times.sort()
+    timings[name] = times[len(times) // 2]
+    return ret
+
+def write_library(pykodi, server_library, database):
+    '''Write the synthetic library to the local files of PyKodi'''
+    songs = {}
+    for song_id in server_library.song_ids():
+        songs[song_id] = pykodi.song_record(server_library.song(song_id))
+    albums = {}
+    for album_id in range(1, server_library.nb_albums() + 1):
+        albums[album_id] = pykodi.album_record(server_library.album(album_id))
+    if database:
+        conn = pykodi.library_db.open_db(database)
+        for items, table in ((songs, 'songs'), (albums, 'albums')):
+            db_table = pykodi.library_db.DbTable(conn, table)
+            for item_id, record in items.items():
+                db_table[item_id] = record
+            db_table.flush()
+        conn.close()
+    else:
+        pykodi.save_songs(songs)
+        pykodi.save_albums(albums)
+
+def start_mock(size, seed):
+    '''Start the mock Kodi server, return its process and ports'''
+    process = subprocess.Popen(
+            [sys.executable, os.path.join(BENCHMARKS, 'mock_kodi.py'),
+                '--songs', str(size), '--seed', str(seed),
+                '--http-port', '0', '--tcp-port', '0'],
+            stdout=subprocess.PIPE)
+    line = process.stdout.readline()
+    http_port, tcp_port = re.search(
+            r'HTTP on (\d+), TCP on (\d+)', line).groups()
+    return process, int(http_port), int(tcp_port)
+
+def call_mock(kodi_params, method, params=None):
+    '''Call a method of the mock server'''
+    import kodi_api
+    return kodi_api.call_api(kodi_params, {
+        "jsonrpc": "2.0", "method": method, "params": params or {}, "id": 1})
+
+def library_fname(directory, store):
+    '''SQLite file of the library, None for the snapshot files'''
+    if store == 'db':
+        return os.path.join(directory, 'library.db')
+    return None
+
+def prepare_size(args):
+    '''Write the library files of one size, return the time taken'''
+    import pykodi
+    # same seed, same library as the mock server
+    server_library = mock_kodi.Library(args.size, args.seed)
+    os.chdir(args.directory)
+    timings = {}
+    timed(timings, 'write library', lambda: write_library(
+        pykodi, server_library, library_fname(args.directory, args.store)))
+    return timings
+
+def run_size(args):
+    '''Benchmark one library size, return the results'''
+    import pykodi
+    mock, http_port, tcp_port = start_mock(args.size, args.seed)
+    kodi_params = {
+        'tcp': not args.http,
+        'ip': '127.0.0.1',
+        'port': http_port if args.http else tcp_port,
+        'user': None,
+        'password': None,
+        'pool_size': pykodi.kodi_api.HTTP_POOL_SIZE,
+        'database': library_fname(args.directory, args.store)}
+    os.chdir(args.directory)
+    timings = {}
+    try:
+        obj = Library(kodi_params)
+        if args.store == 'db':
+            timed(timings, 'get_audio_library_from_db',
+                    lambda: pykodi.get_audio_library_from_db(obj))
+        else:
+            timed(timings, 'get_audio_library_from_files',
+                    lambda: pykodi.get_audio_library_from_files(obj))
+            timed(timings, 'build_search_indexes',
+                    lambda: build_search_indexes(pykodi, obj))
+        for search in SEARCHES['songs']:
+            timed(timings, 'get_songs_search %s' % search,
+                    lambda: pykodi.get_songs_search(
+                        search, obj.songs, obj.songs_index),
+                    args.repeats)
+        for search in SEARCHES['albums']:
+            timed(timings, 'get_albums_search %s' % search,
+                    lambda: pykodi.get_albums_search(
+                        search, obj.albums, obj.albums_index),
+                    args.repeats)
+        for search in SEARCHES['genres']:
+            timed(timings, 'get_genre_search %s' % search,
+                    lambda: pykodi.get_genre_search(
+                        search, obj.songs, obj.genres_index),
+                    args.repeats)
+        # the library and its indexes, before the sync
+        search_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        timed(timings, 'get_profile_delta',
+                lambda: pykodi.get_profile_delta(obj.songs), args.repeats)
+        # the first sync has no mark, all the songs are downloaded
+        timed(timings, 'set_songs_sync full',
+                lambda: pykodi.set_songs_sync(kodi_params, obj.songs))
+        # no song is removed from the library of the mock server
+        call_mock(kodi_params, 'Mock.Play',
+                {'songids': range(1, NB_PLAYED + 1)})
+        timed(timings, 'set_songs_sync played',
+                lambda: pykodi.set_songs_sync(kodi_params, obj.songs))
+        nb_requests = call_mock(
+                kodi_params, 'Mock.GetStats')['result']['requests']
+    finally:
+        mock.terminate()
+        mock.wait()
+        os.chdir(BENCHMARKS)
+    return {
+        'size': args.size,
+        'store': args.store,
+        'transport': 'http' if args.http else 'tcp',
+        'timings': timings,
+        'server_requests': nb_requests,
+        # kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'search_rss_kb': search_rss}
+
+def compare(results, previous):
+    '''Print the ratio of each timing to the one of a previous run'''
+    before = dict(((r['size'], r['store'], name), value)
+            for r in previous['results']
+            for name, value in r['timings'].items())
+    print
+    print "%-40s %10s %10s %8s" % ('size / timing', 'before', 'after', 'ratio')
+    for result in results:
+        for name, value in sorted(result['timings'].items()):
+            key = (result['size'], result['store'], name)
+            if key not in before:
+                continue
+            print "%-40s %10.4f %10.4f %8.2f" % (
+                    '%i %s' % (result['size'], name),
+                    before[key], value, value / max(before[key], 1e-9))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes",
+            type=int,
+            nargs='+',
+            default=SIZES,
+            help='Numbers of songs of the libraries')
+    parser.add_argument("--size",
+            type=int,
+            help=argparse.SUPPRESS)
+    parser.add_argument("--directory",
+            help=argparse.SUPPRESS)
+    parser.add_argument("--prepare",
+            action="store_true",
+            help=argparse.SUPPRESS)
+    parser.add_argument("--store",
+            choices=['snapshot', 'db'],
+            default='snapshot',
+            help='Local store of the library')
+    parser.add_argument("--http",
+            action="store_true",
+            help='Use the HTTP transport instead of TCP')
+    parser.add_argument("-r", "--repeats",
+            type=int,
+            default=REPEATS,
+            help='Runs of each search, the median is kept')
+    parser.add_argument("--seed",
+            type=int,
+            default=0,
+            help='Seed of the synthetic library')
+    parser.add_argument("-o", "--output",
+            help='JSON file of the results')
+    parser.add_argument("--compare",
+            help='JSON file of a previous run')
+    args = parser.parse_args()
+    if args.size:
+        # one step of one size, in a process of its own
+        if args.prepare:
+            print json.dumps(prepare_size(args))
+        else:
+            print json.dumps(run_size(args))
+        return
+    results = []
+    for size in args.sizes:
+        directory = tempfile.mkdtemp(prefix='pykodi-bench-')
+        command = [sys.executable, os.path.abspath(__file__),
+                '--size', str(size), '--store', args.store,
+                '--repeats', str(args.repeats), '--seed', str(args.seed),
+                '--directory', directory]
+        if args.http:
+            command.append('--http')
+        try:
+            output = subprocess.check_output(command + ['--prepare'])
+            write_timings = json.loads(output.splitlines()[-1])
+            output = subprocess.check_output(command)
+        finally:
+            shutil.rmtree(directory)
+        result = json.loads(output.splitlines()[-1])
+        result['timings'].update(write_timings)
+        results.append(result)
+        print
+        print ("%i songs, %s store, peak memory %.1f MB (%.1f MB before "
+                "the sync), %i server requests") % (
+                size, args.store, result['peak_rss_kb'] / 1024.0,
+                result['search_rss_kb'] / 1024.0, result['server_requests'])
+        for name, value in sorted(result['timings'].items()):
+            print "   %-40s %10.4f s" % (name, value)
+    report = {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results}
+    if args.output:
+        f = open(args.output, 'w')
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.close()
+    if args.compare:
+        f = open(args.compare)
+        compare(results, json.load(f))
+        f.close()
+
+if __name__ == '__main__':
+    main()
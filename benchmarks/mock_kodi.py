@@ -0,0 +1,729 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''
+Local stand-in for a Kodi server, for the tests and the benchmarks.
+
+It answers the JSON-RPC methods used by PyKodi, single or in batches, with
+HTTP on /jsonrpc and with raw TCP, and sends the player notifications to the
+TCP clients. The library is synthetic: each song is computed from its id, so
+a library of a million songs needs no memory. Latency, errors and partial
+TCP writes can be injected, with a seed so the runs can be repeated:
+
+    $ python benchmarks/mock_kodi.py --songs 100000 --latency 0.02
+    $ python pykodi.py 127.0.0.1 -p 8080
+'''
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import argparse
+import random
+import socket
+import json
+import time
+import calendar
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import kodi_api
+
+import logging
+logger = logging.getLogger(__name__)
+
+# global constants
+SONGS_BY_ALBUM = 10
+ALBUMS_BY_ARTIST = 3
+DAY = 24 * 3600
+# dates of the synthetic library, the songs are added one by minute
+ADDED_START = 1262304000
+PLAYED_START = 1420070400
+WORDS = [
+        u'love', u'night', u'blue', u'heart', u'fire', u'river', u'dream',
+        u'rain', u'café', u'noël', u'soleil', u'mañana', u'road', u'home',
+        u'light', u'storm', u'gold', u'angel', u'ghost', u'summer', u'winter',
+        u'dance', u'city', u'moon', u'star', u'wild', u'lost', u'sweet']
+GENRES = [
+        u'Rock', u'Pop', u'Jazz', u'Blues', u'Electronic', u'Hip-Hop',
+        u'Classical', u'Folk', u'Metal', u'Reggae', u'Soul', u'Chanson']
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INTERNAL_ERROR = -32603
+FAILED = -32100
+
+def date_string(timestamp):
+    '''Date in the format of Kodi'''
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+def date_timestamp(date):
+    '''Timestamp of a date in the format of Kodi'''
+    return calendar.timegm(time.strptime(date, '%Y-%m-%d %H:%M:%S'))
+
+def mix(value, seed):
+    '''Pseudo-random 32 bits integer computed from a value'''
+    value = (value * 2654435761 + seed * 40503) & 0xffffffff
+    value ^= value >> 15
+    value = (value * 2246822519) & 0xffffffff
+    return value ^ (value >> 13)
+
+class Library(object):
+    '''Synthetic audio library, the songs are computed from their id'''
+
+    def __init__(self, nb_songs, seed=0):
+        self.seed = seed
+        self.nb_songs = nb_songs
+        self.lock = threading.Lock()
+        # fields changed since the generation, by song id
+        self.changes = {}
+        self.removed = set()
+        self.last_updated = date_string(ADDED_START + nb_songs * 60)
+        # date of the last song modified after its addition
+        self.last_modified = u''
+        # song ids by sort method, computed once for all the pages
+        self.orders = {}
+
+    def nb_albums(self):
+        return (self.nb_songs + SONGS_BY_ALBUM - 1) // SONGS_BY_ALBUM
+
+    def nb_library_songs(self):
+        return self.nb_songs - len(self.removed)
+
+    def song_ids(self, start=0, end=None):
+        '''Ids of the songs from the start to the end position, by id'''
+        total = self.nb_library_songs()
+        if end is None or end > total:
+            end = total
+        # the first id is shifted by the removed ids before it
+        songid = start + 1
+        for removed in sorted(self.removed):
+            if removed > songid:
+                break
+            songid += 1
+        ids = []
+        while len(ids) < end - start:
+            if songid not in self.removed:
+                ids.append(songid)
+            songid += 1
+        return ids
+
+    def song(self, songid):
+        '''All the properties of a song'''
+        h = mix(songid, self.seed)
+        albumid = (songid - 1) // SONGS_BY_ALBUM + 1
+        played = (h >> 24) % 10 < 3
+        genre = [GENRES[(h >> 4) % len(GENRES)]]
+        if (h >> 8) % 5 == 0:
+            genre.append(GENRES[(h >> 12) % len(GENRES)])
+        song = {
+            'songid': songid,
+            'title': u'%s %s %i' % (
+                WORDS[h % len(WORDS)].capitalize(),
+                WORDS[(h >> 5) % len(WORDS)], songid),
+            'artist': [self.artist(albumid)],
+            'albumid': albumid,
+            'year': 1960 + mix(albumid, self.seed) % 60,
+            'rating': (h >> 16) % 6 if (h >> 20) % 4 == 0 else 0,
+            'playcount': 1 + (h >> 10) % 40 if played else 0,
+            'lastplayed': (date_string(PLAYED_START + (h >> 3) % (365 * DAY))
+                if played else u''),
+            'dateadded': date_string(ADDED_START + songid * 60),
+            'datemodified': date_string(ADDED_START + songid * 60),
+            'musicbrainztrackid': u'%08x-0000-4000-8000-%012x' % (h, songid),
+            'genre': genre}
+        song['label'] = song['title']
+        song.update(self.changes.get(songid, {}))
+        return song
+
+    def artist(self, albumid):
+        return u'Artist %i' % (mix(albumid, self.seed) % max(
+            1, self.nb_albums() // ALBUMS_BY_ARTIST))
+
+    def album(self, albumid):
+        '''All the properties of an album'''
+        album = {
+            'albumid': albumid,
+            'title': u'Album %s %i' % (
+                WORDS[mix(albumid, self.seed) % len(WORDS)], albumid),
+            'artist': [self.artist(albumid)],
+            'year': 1960 + mix(albumid, self.seed) % 60,
+            'dateadded': date_string(
+                ADDED_START + albumid * SONGS_BY_ALBUM * 60)}
+        album['datemodified'] = album['dateadded']
+        album['label'] = album['title']
+        return album
+
+    def play(self, songid):
+        '''Simulate a play of the song, as if listened to on the server'''
+        with self.lock:
+            song = self.song(songid)
+            changes = self.changes.setdefault(songid, {})
+            changes['playcount'] = song['playcount'] + 1
+            changes['lastplayed'] = date_string(time.time())
+            self.orders = {}
+
+    def rate(self, songid, rating):
+        with self.lock:
+            self.changes.setdefault(songid, {})['rating'] = rating
+            self.orders = {}
+
+    def retag(self, songid, fields):
+        '''Simulate a change of the tags of the song'''
+        with self.lock:
+            changes = self.changes.setdefault(songid, {})
+            changes.update(fields)
+            now = date_string(time.time())
+            changes['datemodified'] = now
+            self.last_modified = now
+            self.last_updated = now
+            self.orders = {}
+
+    def modified_song_ids(self, since):
+        '''Ids of the songs modified after the date, by id'''
+        # a song is modified when added, then by its retags
+        first = (date_timestamp(since) - ADDED_START) // 60 + 1
+        with self.lock:
+            ids = set(songid for songid, changes in self.changes.items()
+                    if changes.get('datemodified', u'') > since)
+            ids.update(xrange(max(1, first), self.nb_songs + 1))
+            ids.difference_update(self.removed)
+        return sorted(ids)
+
+    def modified_album_ids(self, since):
+        '''Ids of the albums modified after the date'''
+        first = ((date_timestamp(since) - ADDED_START)
+                // (SONGS_BY_ALBUM * 60) + 1)
+        return range(max(1, first), self.nb_albums() + 1)
+
+    def add_songs(self, nb_songs):
+        '''Songs added to the library, with the next ids'''
+        with self.lock:
+            self.nb_songs += nb_songs
+            self.last_updated = date_string(time.time())
+            self.orders = {}
+
+    def remove_song(self, songid):
+        with self.lock:
+            self.removed.add(songid)
+            self.last_updated = date_string(time.time())
+            self.orders = {}
+
+    def sorted_songs(self, sort, start, end):
+        '''Song ids of a page in the order asked by a sort parameter'''
+        sort = sort or {}
+        method = sort.get('method', 'none')
+        descending = sort.get('order') == 'descending'
+        total = self.nb_library_songs()
+        if descending:
+            # the same positions from the end of the ascending order
+            start, end = total - end, total - start
+        if method in ('none', 'dateadded', 'songid'):
+            # the id order, the page is computed from the positions
+            ids = self.song_ids(start, end)
+        else:
+            with self.lock:
+                order = self.orders.get(method)
+                if order is None:
+                    order = self.orders[method] = sorted(
+                            self.song_ids(),
+                            key=lambda i: self.song(i).get(method))
+            ids = order[start:end]
+        if descending:
+            ids.reverse()
+        return ids
+
+    def get_songs(self, params):
+        rule = params.get('filter')
+        if rule:
+            # only the filter of the modified songs, the sort is ignored
+            ids = self.modified_song_ids(rule['value'])
+            total = len(ids)
+            start, end = self.limit(total, params.get('limits'))
+            ids = ids[start:end]
+        else:
+            total = self.nb_library_songs()
+            start, end = self.limit(total, params.get('limits'))
+            ids = self.sorted_songs(params.get('sort'), start, end)
+        properties = params.get('properties', [])
+        songs = []
+        for songid in ids:
+            song = self.song(songid)
+            item = {'songid': songid, 'label': song['label']}
+            for name in properties:
+                item[name] = song.get(name)
+            songs.append(item)
+        return {
+            'limits': {'start': start, 'end': end, 'total': total},
+            'songs': songs}
+
+    def get_albums(self, params):
+        rule = params.get('filter')
+        if rule:
+            ids = self.modified_album_ids(rule['value'])
+            total = len(ids)
+            start, end = self.limit(total, params.get('limits'))
+            ids = ids[start:end]
+        else:
+            total = self.nb_albums()
+            start, end = self.limit(total, params.get('limits'))
+            ids = range(start + 1, end + 1)
+            sort = params.get('sort')
+            if sort and sort.get('order') == 'descending':
+                ids = range(total - start, total - end, -1)
+        properties = params.get('properties', [])
+        albums = []
+        for albumid in ids:
+            album = self.album(albumid)
+            item = {'albumid': albumid, 'label': album['label']}
+            for name in properties:
+                item[name] = album.get(name)
+            albums.append(item)
+        return {
+            'limits': {'start': start, 'end': end, 'total': total},
+            'albums': albums}
+
+    def limit(self, total, limits):
+        '''Start and end positions of the limits parameter'''
+        limits = limits or {}
+        start = min(limits.get('start', 0), total)
+        end = limits.get('end', -1)
+        if end < 0 or end > total:
+            end = total
+        return start, max(start, end)
+
+    def properties(self, params):
+        values = {
+            'librarylastupdated': self.last_updated,
+            'songslastadded': date_string(
+                ADDED_START + self.nb_songs * 60),
+            'albumslastadded': date_string(
+                ADDED_START + self.nb_albums() * SONGS_BY_ALBUM * 60)}
+        values['songsmodified'] = max(
+                values['songslastadded'], self.last_modified)
+        values['albumsmodified'] = values['albumslastadded']
+        return dict((name, values[name])
+                for name in params.get('properties', values))
+
+class Player(object):
+    '''State of the audio playlist and player'''
+
+    def __init__(self, library):
+        self.library = library
+        self.playlist = []
+        self.active = False
+        self.speed = 0
+        self.position = 0
+        self.started = 0
+        self.volume = 100
+
+    def item(self, songid):
+        song = self.library.song(songid)
+        return {
+            'id': songid, 'type': 'song', 'label': song['label'],
+            'title': song['title'], 'artist': song['artist']}
+
+    def add(self, item):
+        if 'songid' in item:
+            self.playlist.append(item['songid'])
+        elif 'albumid' in item:
+            first = (item['albumid'] - 1) * SONGS_BY_ALBUM + 1
+            self.playlist.extend(range(first, first + SONGS_BY_ALBUM))
+        else:
+            raise KeyError('item')
+
+    def properties(self):
+        duration = 180 + self.playlist[self.position] % 120
+        elapsed = int(time.time() - self.started) % duration
+        def kodi_time(seconds):
+            return {'hours': seconds // 3600, 'minutes': seconds // 60 % 60,
+                    'seconds': seconds % 60, 'milliseconds': 0}
+        return {
+            'time': kodi_time(elapsed),
+            'totaltime': kodi_time(duration),
+            'percentage': 100.0 * elapsed / duration,
+            'position': self.position}
+
+class Faults(object):
+    '''Latency, errors and partial writes injected in the answers'''
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, split=0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        # largest TCP write, 0 to send the answers at once
+        self.split = split
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self.lock:
+                jitter = self.random.uniform(0, self.jitter)
+            time.sleep(self.latency + jitter)
+
+    def error(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def chunks(self, data):
+        '''Parts of the data sent by separate writes'''
+        if not self.split:
+            return [data]
+        ret = []
+        start = 0
+        while start < len(data):
+            with self.lock:
+                size = self.random.randint(1, self.split)
+            ret.append(data[start:start + size])
+            start += size
+        return ret
+
+class MockKodi(object):
+    '''JSON-RPC server answering on HTTP and TCP'''
+
+    def __init__(self, library, faults=None):
+        self.library = library
+        self.faults = faults or Faults()
+        self.player = Player(library)
+        self.lock = threading.Lock()
+        self.tcp_clients = set()
+        self.servers = []
+        self.nb_requests = 0
+        self.methods = {
+            'AudioLibrary.GetSongs': lambda p: self.library.get_songs(p),
+            'AudioLibrary.GetAlbums': lambda p: self.library.get_albums(p),
+            'AudioLibrary.GetProperties':
+                lambda p: self.library.properties(p),
+            'Playlist.Add': self.playlist_add,
+            'Playlist.Clear': self.playlist_clear,
+            'Playlist.GetItems': self.playlist_get_items,
+            'Player.GetActivePlayers': self.player_get_active,
+            'Player.GetItem': self.player_get_item,
+            'Player.GetProperties': self.player_get_properties,
+            'Player.Open': self.player_open,
+            'Player.PlayPause': self.player_play_pause,
+            'Player.Stop': self.player_stop,
+            'Player.GoTo': self.player_goto,
+            'Application.SetVolume': self.set_volume,
+            'XBMC.GetInfoLabels': self.get_info_labels,
+            'JSONRPC.Ping': lambda p: 'pong',
+            # not in Kodi, to simulate the activity on the server
+            'Mock.Play': self.mock_play,
+            'Mock.Retag': self.mock_retag,
+            'Mock.GetStats': self.mock_get_stats}
+
+    # methods
+
+    def playlist_add(self, params):
+        self.player.add(params['item'])
+        self.notify('Playlist.OnAdd', {'playlistid': 0})
+        return 'OK'
+
+    def playlist_clear(self, params):
+        self.player.playlist = []
+        self.player.position = 0
+        self.notify('Playlist.OnClear', {'playlistid': 0})
+        return 'OK'
+
+    def playlist_get_items(self, params):
+        items = [self.player.item(i) for i in self.player.playlist]
+        return {
+            'items': items,
+            'limits': {'start': 0, 'end': len(items), 'total': len(items)}}
+
+    def player_get_active(self, params):
+        if self.player.active:
+            return [{'playerid': 0, 'type': 'audio'}]
+        return []
+
+    def active_player(self):
+        if not self.player.active:
+            raise RuntimeError('player not active')
+
+    def player_get_item(self, params):
+        self.active_player()
+        return {'item': self.player.item(
+            self.player.playlist[self.player.position])}
+
+    def player_get_properties(self, params):
+        self.active_player()
+        properties = self.player.properties()
+        return dict((name, properties[name])
+                for name in params.get('properties', []) if name in properties)
+
+    def player_open(self, params):
+        item = params.get('item', {})
+        if item.get('partymode'):
+            total = self.library.nb_library_songs()
+            self.player.playlist = [
+                    self.library.song_ids(position, position + 1)[0]
+                    for position in random.sample(
+                        xrange(total), min(10, total))]
+        if not self.player.playlist:
+            raise RuntimeError('empty playlist')
+        self.player.active = True
+        self.player.speed = 1
+        self.player.position = 0
+        self.start_song()
+        return 'OK'
+
+    def start_song(self):
+        self.player.started = time.time()
+        songid = self.player.playlist[self.player.position]
+        self.library.play(songid)
+        self.notify('Player.OnPlay', {
+            'item': {'id': songid, 'type': 'song'},
+            'player': {'playerid': 0, 'speed': 1}})
+
+    def player_play_pause(self, params):
+        self.active_player()
+        self.player.speed = 1 - self.player.speed
+        method = 'Player.OnPlay' if self.player.speed else 'Player.OnPause'
+        self.notify(method, {'player': {'playerid': 0,
+            'speed': self.player.speed}})
+        return {'speed': self.player.speed}
+
+    def player_stop(self, params):
+        self.active_player()
+        self.player.active = False
+        self.player.speed = 0
+        self.notify('Player.OnStop', {'end': False})
+        return 'OK'
+
+    def player_goto(self, params):
+        self.active_player()
+        if self.player.position + 1 >= len(self.player.playlist):
+            raise RuntimeError('end of the playlist')
+        self.player.position += 1
+        self.start_song()
+        return 'OK'
+
+    def set_volume(self, params):
+        self.player.volume = int(params['volume'])
+        return self.player.volume
+
+    def get_info_labels(self, params):
+        labels = {'System.FriendlyName': 'Mock Kodi'}
+        return dict((label, labels.get(label, ''))
+                for label in params.get('labels', []))
+
+    def mock_play(self, params):
+        for songid in params['songids']:
+            self.library.play(songid)
+        return 'OK'
+
+    def mock_retag(self, params):
+        for songid in params['songids']:
+            self.library.retag(songid, params['fields'])
+        return 'OK'
+
+    def mock_get_stats(self, params):
+        return {'requests': self.nb_requests}
+
+    # JSON-RPC
+
+    def error(self, request_id, code, message):
+        return {'jsonrpc': '2.0', 'id': request_id,
+                'error': {'code': code, 'message': message}}
+
+    def answer(self, request):
+        '''Response to a single request, None for a notification'''
+        if not isinstance(request, dict) or 'method' not in request:
+            return self.error(None, INVALID_REQUEST, 'Invalid request.')
+        request_id = request.get('id')
+        method = self.methods.get(request['method'])
+        if method is None:
+            response = self.error(
+                    request_id, METHOD_NOT_FOUND, 'Method not found.')
+        elif self.faults.error():
+            response = self.error(
+                    request_id, INTERNAL_ERROR, 'Internal error (injected).')
+        else:
+            try:
+                with self.lock:
+                    self.nb_requests += 1
+                    result = method(request.get('params', {}))
+                response = {'jsonrpc': '2.0', 'id': request_id,
+                        'result': result}
+            except (KeyError, TypeError, ValueError, RuntimeError) as e:
+                response = self.error(
+                        request_id, FAILED,
+                        'Failed to execute method: %s' % e)
+        if 'id' not in request:
+            return None
+        return response
+
+    def handle(self, message):
+        '''Response to a request or a batch, None if nothing to send'''
+        self.faults.delay()
+        if isinstance(message, list):
+            if not message:
+                return self.error(None, INVALID_REQUEST, 'Invalid request.')
+            responses = [self.answer(request) for request in message]
+            responses = [r for r in responses if r is not None]
+            return responses or None
+        return self.answer(message)
+
+    def notify(self, method, data):
+        '''Send a notification to all the TCP clients'''
+        message = {'jsonrpc': '2.0', 'method': method,
+                'params': {'data': data, 'sender': 'xbmc'}}
+        for client in list(self.tcp_clients):
+            client.send(message)
+
+    # servers
+
+    def start(self, http_port=8080, tcp_port=9090, host='127.0.0.1'):
+        '''Serve in background threads, return the actual ports'''
+        mock = self
+
+        class HttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                if self.path != '/jsonrpc':
+                    self.send_error(404)
+                    return
+                data = self.rfile.read(int(self.headers['Content-Length']))
+                try:
+                    response = mock.handle(json.loads(data.decode('utf-8')))
+                except ValueError:
+                    response = mock.error(None, PARSE_ERROR, 'Parse error.')
+                body = b''
+                if response is not None:
+                    body = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        class TcpHandler(SocketServer.BaseRequestHandler):
+
+            def setup(self):
+                self.write_lock = threading.Lock()
+                mock.tcp_clients.add(self)
+
+            def finish(self):
+                mock.tcp_clients.discard(self)
+
+            def send(self, message):
+                data = json.dumps(message).encode('utf-8')
+                with self.write_lock:
+                    try:
+                        for chunk in mock.faults.chunks(data):
+                            self.request.sendall(chunk)
+                    except socket.error:
+                        pass
+
+            def handle(self):
+                framer = kodi_api.JsonFramer()
+                while True:
+                    try:
+                        framer.fill(self.request)
+                    except socket.error:
+                        return
+                    while True:
+                        try:
+                            message = framer.next_message()
+                        except ValueError:
+                            framer.clear()
+                            self.send(mock.error(
+                                None, PARSE_ERROR, 'Parse error.'))
+                            break
+                        if message is None:
+                            break
+                        response = mock.handle(message)
+                        if response is not None:
+                            self.send(response)
+
+        class ThreadingHttpServer(
+                SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        class ThreadingTcpServer(
+                SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.servers = [
+            ThreadingHttpServer((host, http_port), HttpHandler),
+            ThreadingTcpServer((host, tcp_port), TcpHandler)]
+        for server in self.servers:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        return [server.server_address[1] for server in self.servers]
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--songs",
+            type=int,
+            default=10000,
+            help='Number of songs of the synthetic library')
+    parser.add_argument("--http-port",
+            type=int,
+            default=8080,
+            help='Port of the HTTP transport')
+    parser.add_argument("--tcp-port",
+            type=int,
+            default=9090,
+            help='Port of the TCP transport')
+    parser.add_argument("--latency",
+            type=float,
+            default=0,
+            help='Delay before each answer, in seconds')
+    parser.add_argument("--jitter",
+            type=float,
+            default=0,
+            help='Random delay added to the latency, in seconds')
+    parser.add_argument("--error-rate",
+            type=float,
+            default=0,
+            help='Part of the requests answered with an error')
+    parser.add_argument("--split",
+            type=int,
+            default=0,
+            help='Largest TCP write, to test partial reads')
+    parser.add_argument("--seed",
+            type=int,
+            default=0,
+            help='Seed of the library and of the injected faults')
+    parser.add_argument("-v", "--verbosity",
+            action="count",
+            help='Increase output verbosity')
+    args = parser.parse_args()
+    if args.verbosity:
+        logging.basicConfig(level=logging.DEBUG)
+    mock = MockKodi(
+            Library(args.songs, args.seed),
+            Faults(args.latency, args.jitter, args.error_rate, args.split,
+                args.seed))
+    http_port, tcp_port = mock.start(args.http_port, args.tcp_port)
+    print "Mock Kodi with %i songs, HTTP on %i, TCP on %i" % (
+            args.songs, http_port, tcp_port)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mock.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''
+Start-up time benchmark of PyKodi.
+
+Compare the one-shot mode (-c play_pause), the interactive start-up until the
+prompt is ready, and the interactive start-up until the library is loaded.
+The server arguments are given to pykodi.py as they are, for example:
+
+    $ python benchmarks/startup.py 192.168.1.251 --tcp -n 20
+'''
+
+import subprocess
+import argparse
+import time
+import os
+import sys
+
+# global constants
+PYKODI = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'pykodi.py')
+SCENARIOS = [
+        ('one-shot play_pause', ['-c', 'play_pause'], ''),
+        ('interactive, prompt', [], ''),
+        ('interactive, library', [], 'songs_page 1\n'),
+        ]
+
+def run_pykodi(server_args, args, stdin):
+    '''Run PyKodi once, return the elapsed time'''
+    start = time.time()
+    process = subprocess.Popen(
+            [sys.executable, PYKODI] + server_args + args,
+            stdin=subprocess.PIPE,
+            stdout=open(os.devnull, 'w'),
+            stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(PYKODI))
+    # the end of the input quits the prompt
+    process.communicate(stdin)
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--runs",
+            type=int,
+            default=10,
+            help='Number of runs of each scenario')
+    args, server_args = parser.parse_known_args()
+    print "%-25s %10s %10s %10s" % ('scenario', 'min (ms)', 'median', 'max')
+    for label, pykodi_args, stdin in SCENARIOS:
+        times = sorted(
+                run_pykodi(server_args, pykodi_args, stdin)
+                for i in range(args.runs))
+        print "%-25s %10.1f %10.1f %10.1f" % (
+                label,
+                times[0] * 1000,
+                times[len(times) // 2] * 1000,
+                times[-1] * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -8,55 +8,182 @@
 
 '''
 Module of functions for echonest API management.
+
+All the calls go through a token bucket shared by the threads, so several
+uploads can run at the same time without exceeding the quota of the key.
 '''
 
-import requests
+import api_stats
+
+import json
+import threading
+import time
 import logging
 logger = logging.getLogger(__name__)
 
+# global constants
+API_URL = 'http://developer.echonest.com/api/v4/'
+# standard keys, the upgraded ones are allowed 120 calls by minute
+CALLS_PER_MINUTE = 20
+BURST = 4
+MAX_RETRIES = 5
+BACKOFF_DELAY = 2
+RATE_LIMITED = 429
+# status code of the response when the profile ID is not known
+UNKNOWN_ID = 5
+
+class ProfileNotFound(Exception):
+    '''The taste profile ID is not known by echonest'''
+
+class TokenBucket(object):
+    '''Rate limiter, a call takes a token and the tokens come back over time'''
+
+    def __init__(self, calls_per_minute, burst=BURST):
+        self.lock = threading.Lock()
+        self.set_rate(calls_per_minute, burst)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.blocked_until = 0
+
+    def set_rate(self, calls_per_minute, burst=BURST):
+        logger.info('echonest rate: %i calls by minute', calls_per_minute)
+        self.calls_per_minute = calls_per_minute
+        self.rate = calls_per_minute / 60.0
+        self.burst = min(burst, calls_per_minute)
+
+    def acquire(self):
+        '''Wait until a call is allowed'''
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(
+                        self.burst,
+                        self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(
+                        self.blocked_until - now,
+                        (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def block(self, delay):
+        '''No call allowed during the delay, after a rate limit response'''
+        with self.lock:
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, time.time() + delay)
+
+limiter = TokenBucket(CALLS_PER_MINUTE)
+
+def set_calls_per_minute(calls_per_minute):
+    '''Configure the rate limiter for the tier of the key'''
+    limiter.set_rate(calls_per_minute)
+
+def call_stats():
+    '''Number of calls of the session by API method'''
+    return [(entry['method'], entry['calls'])
+            for entry in api_stats.summary('echonest')]
+
+def api_call(verb, method, payload, headers=None):
+    '''Call an API method within the rate limit, return the response'''
+    import requests
+    delay = BACKOFF_DELAY
+    for attempt in range(MAX_RETRIES):
+        limiter.acquire()
+        start = time.time()
+        try:
+            r = requests.request(
+                    verb, API_URL + method, headers=headers, params=payload)
+        except requests.RequestException:
+            api_stats.record('echonest', method, time.time() - start,
+                    error=True)
+            raise
+        # the parameters are sent in the URL
+        api_stats.record('echonest', method, time.time() - start,
+                len(r.url), len(r.content), r.status_code != 200)
+        logger.debug('URL: %s', r.url)
+        # the quota of the key is given with each response
+        limit = r.headers.get('X-RateLimit-Limit')
+        if limit and int(limit) != limiter.calls_per_minute:
+            set_calls_per_minute(int(limit))
+        if r.status_code != RATE_LIMITED:
+            return r
+        api_stats.record_retry('echonest', method)
+        retry_after = r.headers.get('Retry-After')
+        wait = float(retry_after) if retry_after else delay
+        logger.warning('echonest rate limit reached, wait %.1fs', wait)
+        limiter.block(wait)
+        delay *= 2
+    logger.error('echonest rate limit still reached, call abandoned')
+    return r
+
+def check_profile(r):
+    '''Raise ProfileNotFound if the call failed on an unknown profile ID'''
+    if r.status_code == 200:
+        return
+    try:
+        code = r.json()['response']['status']['code']
+    except (ValueError, KeyError, TypeError):
+        return
+    if code == UNKNOWN_ID:
+        raise ProfileNotFound(r.text)
+
 
 #TODO: rename to tasteprofile in place of echonest
 def echonest_favorite(api_key, profile_id, song_id):
     '''Make a song favorite in echonest tasteprofile'''
     logger.debug('call set_echonest_favorite')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/favorite'
     payload = {"api_key": api_key,
               "id": profile_id,
               "item": str(song_id)
               }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
+    r = api_call('GET', 'tasteprofile/favorite', payload)
     logger.debug('return: %s', r.text)
+    check_profile(r)
 
 def echonest_skip(api_key, profile_id, song_id):
     '''Skip a song favorite in echonest taste profile'''
     logger.debug('call set_echonest_skip')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/skip'
     payload = {"api_key": api_key,
               "id": profile_id,
               "item": str(song_id)
               }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
+    r = api_call('GET', 'tasteprofile/skip', payload)
     logger.debug('return: %s', r.text)
+    check_profile(r)
 
 def echonest_info(api_key, profile_id):
     '''Display info about echonest profile'''
     logger.debug('call echonest_info')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/profile'
     payload = {"api_key": api_key,
               "id": profile_id
               }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
+    r = api_call('GET', 'tasteprofile/profile', payload)
     logger.debug('return: %s', r.text)
+    check_profile(r)
     ret = r.json()
     return ret['response']['catalog']
 
+def echonest_update(api_key, profile_id, items):
+    '''Update items of the tasteprofile, return True if successful'''
+    logger.debug('call echonest_update')
+    headers = {'content-type': 'multipart/form-data'}
+    payload = {
+            'api_key': api_key,
+            'id': profile_id,
+            'data': json.dumps(items)}
+    r = api_call('POST', 'tasteprofile/update', payload, headers)
+    check_profile(r)
+    if r.status_code == 200:
+        logger.debug('return: %s', r.text)
+        return True
+    logger.error('return: %s', r.text)
+    return False
+
 def echonest_read(api_key, profile_id, item_id):
     '''Display dat about a given item'''
     logger.debug('call echonest_read')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/read'
     payload = {
             'api_key': api_key,
             'id': profile_id,
@@ -66,21 +193,20 @@ def echonest_read(api_key, profile_id, item_id):
                 'song_currency', 'song_hotttnesss', 'song_type',
                 ]
             }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
+    r = api_call('GET', 'tasteprofile/read', payload)
     logger.debug('return: %s', r.text)
+    check_profile(r)
     ret = r.json()
     return ret['response']['catalog']['items'][0]
 
 def echonest_delete(api_key, profile_id):
     '''Delete echonest tasteprofile'''
     logger.debug('call echonest_delete')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/delete'
     headers = {'content-type': 'multipart/form-data'}
     payload = {"api_key": api_key,
             "id": profile_id
             }
-    r = requests.post(url, headers=headers, params=payload)
+    r = api_call('POST', 'tasteprofile/delete', payload, headers)
     #TODO: move to disp function
     print(r.url)
     print(r.text)
@@ -171,6 +171,86 @@ def echonest_read(song_data):
     print "   Artist hotttnesss: \t%s" % (song_data['artist_hotttnesss'])
     print "   Artist discovery: \t%s" % (song_data['artist_discovery'])
 
+def genres(counts):
+    '''Display genres with their number of songs'''
+    print
+    for genre, nb_songs in counts:
+        print "   %s (%i)" % (genre, nb_songs)
+    print
+    print "Total number of genres: %i" % len(counts)
+    print
+
+def library_refresh(new_songs, removed_songs, modified_songs,
+        new_albums, removed_albums, modified_albums):
+    '''Display the changes of a library refresh'''
+    print
+    if (new_songs or removed_songs or modified_songs
+            or new_albums or removed_albums or modified_albums):
+        print "   Songs: %i added, %i removed, %i modified" % (
+                new_songs, removed_songs, modified_songs)
+        print "   Albums: %i added, %i removed, %i modified" % (
+                new_albums, removed_albums, modified_albums)
+    else:
+        print "   The local library is up to date."
+    print
+
+def library_loading(progress):
+    '''Display the progress of the library loading'''
+    if progress:
+        print "Loading the library... %s: %i / %i" % (
+                progress['label'], progress['done'], progress['total'])
+    else:
+        print "Loading the library..."
+
+def library_unavailable():
+    '''Warn that a command cannot run without the library'''
+    print
+    print "The library could not be loaded, this command is not available."
+    print
+
+def connections(opened, reused):
+    '''Display the number of connections opened and reused'''
+    print
+    print "   Connections opened: %i" % opened
+    print "   Connections reused: %i" % reused
+    print
+
+def sync_status(nb_pending, last_played):
+    '''Display the number of songs to push to the taste profile'''
+    print
+    print "   Songs to push to the taste profile: %i" % nb_pending
+    print "   Last song played at the last sync: %s" % (last_played or 'never')
+    print
+
+def echonest_calls(calls):
+    '''Display the number of echonest calls of the session'''
+    print "   Echonest calls in this session:"
+    if not calls:
+        print "      none"
+    for method, nb_calls in calls:
+        print "      %-25s %i" % (method, nb_calls)
+    print
+
+def api_stats(stats):
+    '''Display the statistics of the API calls by method'''
+    print
+    if not stats:
+        print "   No API call in this session"
+        print
+        return
+    print "   %-32s %6s %5s %5s %9s %9s %8s %8s %8s" % (
+            'method', 'calls', 'err', 'retry', 'kB out', 'kB in',
+            'p50 ms', 'p95 ms', 'p99 ms')
+    for entry in stats:
+        print "   %-32s %6i %5i %5i %9.1f %9.1f %8.1f %8.1f %8.1f" % (
+                entry['api'] + ' ' + entry['method'],
+                entry['calls'], entry['errors'], entry['retries'],
+                entry['bytes_out'] / 1024.0, entry['bytes_in'] / 1024.0,
+                (entry['p50'] or 0) * 1000,
+                (entry['p95'] or 0) * 1000,
+                (entry['p99'] or 0) * 1000)
+    print
+
 # prompt for confirmation
 
 def validate_playlist():
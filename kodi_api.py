@@ -9,61 +9,395 @@
 Module of functions for Kodi API management.
 '''
 
-import requests
+import api_stats
+
+import socket
 import json
+import copy
+import re
+import time
+import itertools
+import collections
+import threading
 import logging
 logger = logging.getLogger(__name__)
 
+# global constants
+HTTP_POOL_SIZE = 4
+BUFFER_SIZE = 16384
+TCP_TIMEOUT = 30
+JSON_TOKENS = re.compile(br'[\[\]{}"\\]')
+STRING_TOKENS = re.compile(br'["\\]')
+BATCH_SIZE = 100
+CACHE_SIZE = 64
+# seconds a response stays valid, the other methods are not cached
+CACHE_TTL = {
+        'XBMC.GetInfoLabels': 300,
+        'Player.GetActivePlayers': 2,
+        'Player.GetItem': 2,
+        'Player.GetProperties': 0.5,
+        'Playlist.GetItems': 2}
+# the other methods of the player and the playlist may change their state,
+# and make the cached responses obsolete
+PLAYER_METHODS = ('Player.', 'Playlist.')
+# read-only methods other than the Get ones, sent again after a lost connection
+READ_ONLY_METHODS = set([
+        'JSONRPC.Ping', 'JSONRPC.Version', 'JSONRPC.Introspect'])
+# error of the commands left without response in a batch
+NO_RESPONSE_ERROR = {"code": -32603, "message": "no response in the batch"}
+
+# ids of the JSON-RPC requests, unique for the session
+request_ids = itertools.count(1)
+
 # API call management
 
+def set_request_id(command):
+    '''Give a unique id to the command, return the id'''
+    command['id'] = next(request_ids)
+    return command['id']
+
+def is_read_only(command):
+    '''True if the command, or all commands of a batch, change nothing'''
+    if isinstance(command, list):
+        return all(is_read_only(item) for item in command)
+    method = command.get('method') or ''
+    if method in CACHE_TTL or method in READ_ONLY_METHODS:
+        return True
+    return method.partition('.')[2].startswith('Get')
+
+def is_mutating(command):
+    '''True if the command may change the player or the playlist'''
+    method = command.get('method') or ''
+    return method.startswith(PLAYER_METHODS) and not is_read_only(command)
+
 def call_api(server_params, command):
+    cache = response_cache(server_params)
+    if isinstance(command, dict):
+        ret = cache.get(command)
+        if ret is not None:
+            logger.debug('cached response for %s', command['method'])
+            return ret
+        set_request_id(command)
     if server_params['tcp']:
-        ret = call_api_tcp(
-                server_params['ip'], 
-                server_params['port'],
-                command)
+        ret = call_api_tcp(server_params, command)
     else:
         ret = call_api_http(server_params, command)
+    if isinstance(command, dict):
+        cache.update(command, ret)
     return ret
 
+class ResponseCache(object):
+    '''Recent responses of read-only methods, the least recently used out'''
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, command):
+        return (command['method'],
+                json.dumps(command.get('params'), sort_keys=True))
+
+    def get(self, command):
+        '''Cached response to the command, None if none is valid'''
+        if command.get('method') not in CACHE_TTL:
+            return None
+        key = self.key(command)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # most recently used last
+            self.entries[key] = entry
+            self.hits += 1
+        # the caller may change the nested objects of its response
+        response = copy.deepcopy(entry[1])
+        response['id'] = command.get('id')
+        return response
+
+    def update(self, command, response):
+        '''Keep the response, or invalidate after a mutating command'''
+        if is_mutating(command):
+            self.invalidate()
+        ttl = CACHE_TTL.get(command.get('method'))
+        if ttl is None or 'error' in response:
+            return
+        response = copy.deepcopy(response)
+        with self.lock:
+            self.entries.pop(self.key(command), None)
+            self.entries[self.key(command)] = (time.time() + ttl, response)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        '''Forget the responses about the player and the playlist'''
+        with self.lock:
+            for key in list(self.entries):
+                if key[0].startswith(PLAYER_METHODS):
+                    del self.entries[key]
+
+def response_cache(server_params):
+    '''Return the response cache of the server, create it if needed'''
+    # the loader thread and the prompt may ask for it at the same time
+    return server_params.setdefault('response_cache', ResponseCache())
+
+def connection_stats(server_params):
+    '''Return the number of connections opened and reused'''
+    if server_params['tcp']:
+        return tcp_connection_stats(server_params)
+    return http_connection_stats(server_params)
+
+def http_session(server_params):
+    '''Return the keep-alive HTTP session of the server, create it if needed'''
+    if 'http_session' not in server_params:
+        logger.debug('create HTTP session')
+        # not needed by the TCP transport, imported on demand
+        import requests
+        from requests.adapters import HTTPAdapter
+        pool_size = server_params.get('pool_size') or HTTP_POOL_SIZE
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=pool_size))
+        session.headers.update({'Content-Type': 'application/json'})
+        if server_params['user']:
+            session.auth = (server_params['user'], server_params['password'])
+        server_params['http_url'] = 'http://%s:%i/jsonrpc' % (
+                server_params['ip'], server_params['port'])
+        server_params['http_session'] = session
+    return server_params['http_session']
+
+def http_connection_stats(server_params):
+    '''Return the number of HTTP connections opened and reused'''
+    if 'http_session' not in server_params:
+        return (0, 0)
+    session = server_params['http_session']
+    kodi_url = server_params['http_url']
+    pool = session.get_adapter(kodi_url).poolmanager.connection_from_url(
+            kodi_url)
+    opened = pool.num_connections
+    reused = pool.num_requests - pool.num_connections
+    return (opened, reused)
+
 def call_api_http(server_params, command):
+    ret, nb_bytes = post_api_http(server_params, command)
+    return ret
+
+def is_error(ret):
+    '''True if the response, or one of a batch, is an error'''
+    if isinstance(ret, list):
+        return any('error' in response for response in ret)
+    return 'error' in ret
+
+def post_api_http(server_params, command):
+    '''Send the command using HTTP, return the result and its size'''
     logger.debug('call call_api_http')
     logger.debug('command: %s', command)
-    kodi_url = 'http://' + server_params['ip'] +  ':' + str(server_params['port']) + '/jsonrpc'
-    headers = {'Content-Type': 'application/json'}
-    r = requests.post(
-            kodi_url,
-            data=json.dumps(command),
-            headers=headers,
-            auth=(server_params['user'], server_params['password']))
-    ret = r.json()
+    session = http_session(server_params)
+    data = json.dumps(command)
+    method = api_stats.command_method(command)
+    start = time.time()
+    try:
+        r = session.post(server_params['http_url'], data=data)
+        ret = r.json()
+    except Exception:
+        api_stats.record('kodi', method, time.time() - start, len(data),
+                error=True)
+        raise
+    api_stats.record('kodi', method, time.time() - start, len(data),
+            len(r.content), is_error(ret))
     logger.debug('url: %s', r.url)
     logger.debug('status code: %s', r.status_code)
     logger.debug('text: %s', r.text)
-    return ret
+    return ret, len(r.content)
+
+class JsonFramer(object):
+    '''Split a stream of bytes into JSON messages'''
+
+    def __init__(self):
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.end = 0
+        self.last_size = 0
+        self.reset()
+
+    def reset(self):
+        '''Restart the scan at the beginning of the buffer'''
+        self.pos = 0
+        self.start = None
+        self.depth = 0
+        self.in_string = False
+
+    def clear(self):
+        '''Drop all the buffered data'''
+        self.end = 0
+        self.reset()
+
+    def fill(self, sock):
+        '''Receive data from the socket directly into the buffer'''
+        if len(self.buffer) - self.end < BUFFER_SIZE:
+            # double the capacity, the growth is amortized
+            self.buffer.extend(bytearray(len(self.buffer)))
+        view = memoryview(self.buffer)
+        nb_bytes = sock.recv_into(view[self.end:])
+        del view
+        if nb_bytes == 0:
+            raise socket.error('connection closed by the server')
+        self.end += nb_bytes
+        logger.debug('length of the filler: %i', nb_bytes)
+
+    def next_message(self):
+        '''Return the next complete message, None if more data is needed'''
+        buf = self.buffer
+        while True:
+            if self.in_string:
+                match = STRING_TOKENS.search(buf, self.pos, self.end)
+            else:
+                match = JSON_TOKENS.search(buf, self.pos, self.end)
+            if match is None:
+                self.pos = self.end
+                return None
+            i = match.start()
+            token = buf[i]
+            if token == ord('\\'):
+                if i + 1 >= self.end:
+                    # the escaped character is not received yet
+                    self.pos = i
+                    return None
+                self.pos = i + 2
+            elif token == ord('"'):
+                self.in_string = not self.in_string
+                self.pos = i + 1
+            elif token in (ord('{'), ord('[')):
+                if self.depth == 0:
+                    self.start = i
+                self.depth += 1
+                self.pos = i + 1
+            else:
+                self.depth -= 1
+                self.pos = i + 1
+                if self.depth == 0 and self.start is not None:
+                    break
+        data = memoryview(buf)[self.start:self.pos].tobytes()
+        # keep the beginning of the next message only
+        remaining = self.end - self.pos
+        buf[:remaining] = buf[self.pos:self.end]
+        self.end = remaining
+        if len(buf) > 2 * BUFFER_SIZE and remaining < BUFFER_SIZE:
+            # give back the memory of a large message, fill needs
+            # BUFFER_SIZE free bytes after the remaining ones
+            del buf[BUFFER_SIZE if not remaining else 2 * BUFFER_SIZE:]
+        self.reset()
+        self.last_size = len(data)
+        logger.debug('data length: %i', len(data))
+        return json.loads(data.decode('utf-8'))
+
+class TcpConnection(object):
+    '''Long-lived TCP connection to the Kodi server'''
+
+    def __init__(self, ip, port):
+        self.address = (ip, port)
+        self.sock = None
+        self.framer = JsonFramer()
+        self.nb_opened = 0
+        self.nb_calls = 0
+        self.last_sent = 0
+        # one exchange at a time, the prompt and the playlist feeder share it
+        self.lock = threading.Lock()
 
-def call_api_tcp(ip, port, command):
+    def connect(self):
+        '''Open the socket if needed'''
+        if self.sock is None:
+            logger.debug('open TCP connection to %s:%i', *self.address)
+            self.sock = socket.create_connection(self.address, TCP_TIMEOUT)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.framer.clear()
+            self.nb_opened += 1
+
+    def close(self):
+        '''Close the socket, it will be reopened on the next call'''
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, command):
+        '''Send a command on the connection'''
+        self.connect()
+        self.nb_calls += 1
+        data = json.dumps(command).encode('utf-8')
+        self.last_sent = len(data)
+        self.sock.sendall(data)
+
+    def read_message(self):
+        '''Block until a complete message is received'''
+        while True:
+            message = self.framer.next_message()
+            if message is not None:
+                return message
+            self.framer.fill(self.sock)
+
+def tcp_connection(server_params):
+    '''Return the TCP connection of the server, create it if needed'''
+    if 'tcp_connection' not in server_params:
+        # a single connection even if the loader thread and the prompt
+        # get here at the same time, its socket is opened on the first call
+        server_params.setdefault('tcp_connection', TcpConnection(
+                server_params['ip'], server_params['port']))
+    return server_params['tcp_connection']
+
+def tcp_connection_stats(server_params):
+    '''Return the number of TCP connections opened and reused'''
+    if 'tcp_connection' not in server_params:
+        return (0, 0)
+    conn = server_params['tcp_connection']
+    return (conn.nb_opened, conn.nb_calls - conn.nb_opened)
+
+def is_response(message):
+    '''True if the message is not a notification sent by the server'''
+    return isinstance(message, list) or 'id' in message
+
+def is_response_to(message, command):
+    '''True if the message is the response to the command'''
+    if isinstance(command, list):
+        return isinstance(message, list)
+    return isinstance(message, dict) and message.get('id') == command['id']
+
+def call_api_tcp(server_params, command):
     '''Send the command using TCP'''
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((ip, port))
     logger.debug('command: %s', command)
-    s.send(json.dumps(command))
-    data = ''
-    while True:
-        filler = s.recv(BUFFER_SIZE)
-        logger.debug('data received: %s', filler)
-        logger.debug('length of the filler: %i', len(filler))
-        data += filler
-        nb_open_brackets = data.count('{') - data.count('}')
-        logger.debug('number of open brackets: %i', nb_open_brackets)
-        if nb_open_brackets == 0:
-            break
-        else:
-            logger.info('api reception incomplete')
-    s.close()
-    logger.debug('data length: %i', len(data))
-    ret = json.loads(data)
+    conn = tcp_connection(server_params)
+    method = api_stats.command_method(command)
+    with conn.lock:
+        start = time.time()
+        for attempt in range(2):
+            try:
+                conn.send(command)
+                while True:
+                    ret = conn.read_message()
+                    if is_response_to(ret, command):
+                        break
+                    logger.debug('message skipped: %s', ret)
+                    if not is_response(ret):
+                        # the player may have been changed by another remote
+                        response_cache(server_params).invalidate()
+                break
+            except socket.error:
+                # the server may have closed an idle connection
+                conn.close()
+                # a command changing something may have been received,
+                # it is not sent twice
+                if attempt or not is_read_only(command):
+                    api_stats.record('kodi', method, time.time() - start,
+                            conn.last_sent, error=True)
+                    raise
+                logger.info('TCP connection lost, reconnect')
+                api_stats.record_retry('kodi', method)
+        api_stats.record('kodi', method, time.time() - start, conn.last_sent,
+                conn.framer.last_size, is_error(ret))
     logger.debug('return: %s', ret)
+    return ret
 
 def display_result(ret):
     '''Display command result for simple methods'''
@@ -74,6 +408,69 @@ def display_result(ret):
     else:
         logger.info('command processed successfully')
 
+# batch requests
+
+def error_response(request_id, error):
+    '''Error response to a command the server did not answer'''
+    return {"jsonrpc": "2.0", "id": request_id, "error": dict(error)}
+
+class Batch(object):
+    '''Queue several commands and send them as JSON-RPC batch arrays'''
+
+    def __init__(self, server_params, size=BATCH_SIZE):
+        self.server_params = server_params
+        self.size = size
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def add(self, command):
+        '''Queue a command, return the id to match its response'''
+        command = dict(command)
+        self.commands.append(command)
+        return set_request_id(command)
+
+    def send(self):
+        '''Send the queued commands, return the responses by id
+
+        Each id has a response: the commands of a rejected batch, or left
+        unanswered, get an error response.
+        '''
+        logger.debug('call send batch of %i commands', len(self.commands))
+        cache = response_cache(self.server_params)
+        responses = {}
+        commands = []
+        mutated = False
+        for command in self.commands:
+            # the commands after a mutating one see its effect
+            mutated = mutated or is_mutating(command)
+            response = None if mutated else cache.get(command)
+            if response is None:
+                commands.append(command)
+            else:
+                responses[command['id']] = response
+        for start in range(0, len(commands), self.size):
+            chunk = commands[start:start + self.size]
+            ret = call_api(self.server_params, chunk)
+            if isinstance(ret, dict):
+                # the whole batch has been rejected
+                display_result(ret)
+                error = ret.get('error', NO_RESPONSE_ERROR)
+                ret = []
+            else:
+                error = NO_RESPONSE_ERROR
+            for response in ret:
+                responses[response.get('id')] = response
+            for command in chunk:
+                if command['id'] not in responses:
+                    responses[command['id']] = error_response(
+                            command['id'], error)
+                # a failed mutating command may still have changed the player
+                cache.update(command, responses[command['id']])
+        self.commands = []
+        return responses
+
 # audiolibrary
 
 def audiolibrary_get_albums(server_params, album_id_start, album_id_end):
@@ -104,19 +501,77 @@ def audiolibrary_get_songs(server_params, song_id_start, song_id_end):
     display_result(ret)
     return ret['result']
 
-# playlist
+def audiolibrary_get_albums_command(properties, start, end, sort=None,
+        filter_rule=None):
+    '''Command to retrieve the properties of albums whithin limits'''
+    command = {"jsonrpc": "2.0",
+            "method": "AudioLibrary.GetAlbums",
+            "params": {
+                "properties": properties,
+                "limits": {
+                    "start": start,
+                    "end": end } },
+            "id": 1}
+    if sort:
+        command['params']['sort'] = sort
+    if filter_rule:
+        command['params']['filter'] = filter_rule
+    return command
 
-def playlist_add(item_type, item_id, server_params):
-    '''Add an item to the audio playlist'''
-    logger.debug('call function playlist_add')
+def audiolibrary_get_songs_command(properties, start, end, sort=None,
+        filter_rule=None):
+    '''Command to retrieve the properties of songs whithin limits'''
     command = {"jsonrpc": "2.0",
+            "method": "AudioLibrary.GetSongs",
+            "params": {
+                "properties": properties,
+                "limits": {
+                    "start": start,
+                    "end": end } },
+            "id": 1}
+    if sort:
+        command['params']['sort'] = sort
+    if filter_rule:
+        command['params']['filter'] = filter_rule
+    return command
+
+def audiolibrary_get_properties_command():
+    '''Command to retrieve the update markers of the library'''
+    return {"jsonrpc": "2.0",
+            "method": "AudioLibrary.GetProperties",
+            "params": {
+                "properties": [
+                    "librarylastupdated",
+                    "songslastadded",
+                    "albumslastadded" ] },
+            "id": 1}
+
+def audiolibrary_get_modified_command():
+    '''Command to retrieve the modification markers, Kodi 19 and later'''
+    return {"jsonrpc": "2.0",
+            "method": "AudioLibrary.GetProperties",
+            "params": {
+                "properties": [
+                    "songsmodified",
+                    "albumsmodified" ] },
+            "id": 1}
+
+# playlist
+
+def playlist_add_command(item_type, item_id):
+    '''Command to add an item to the audio playlist'''
+    return {"jsonrpc": "2.0",
             "method": "Playlist.Add",
             "params": {
                 "playlistid": 0,
                 "item": {
                     item_type: item_id } },
             "id": 1}
-    ret = call_api(server_params, command)
+
+def playlist_add(item_type, item_id, server_params):
+    '''Add an item to the audio playlist'''
+    logger.debug('call function playlist_add')
+    ret = call_api(server_params, playlist_add_command(item_type, item_id))
     display_result(ret)
 
 def playlist_clear(server_params):
@@ -130,17 +585,24 @@ def playlist_clear(server_params):
     ret = call_api(server_params, command)
     display_result(ret)
 
-def playlist_get_items(server_params):
-    '''Get all items from the audio playlist'''
-    #TODO: change to return the item id only
-    logger.debug('call playlist_get_items')
-    command = {"jsonrpc": "2.0",
+def playlist_get_items_command():
+    '''Command to get all items from the audio playlist'''
+    return {"jsonrpc": "2.0",
             "method": "Playlist.GetItems",
             "params": {
                 "playlistid": 0,
                 },
             "id": 1}
-    ret = call_api(server_params, command)
+
+def playlist_get_items(server_params):
+    '''Get all items from the audio playlist'''
+    #TODO: change to return the item id only
+    logger.debug('call playlist_get_items')
+    ret = call_api(server_params, playlist_get_items_command())
+    return playlist_get_items_result(ret)
+
+def playlist_get_items_result(ret):
+    '''Item ids from the return of the playlist items command'''
     display_result(ret)
     items = []
     try:
@@ -153,43 +615,56 @@ def playlist_get_items(server_params):
 
 # player
 
-def player_get_active(server_params):
-    '''Returns active audio players (boolean)'''
-    logger.debug('call function player_get_active')
-    command = {"jsonrpc": "2.0",
+def player_get_active_command():
+    '''Command to get the active players'''
+    return {"jsonrpc": "2.0",
             "method": "Player.GetActivePlayers",
             "id": 1,
             }
-    ret = call_api(server_params, command)
+
+def player_get_active(server_params):
+    '''Returns active audio players (boolean)'''
+    logger.debug('call function player_get_active')
+    ret = call_api(server_params, player_get_active_command())
+    return player_get_active_result(ret)
+
+def player_get_active_result(ret):
+    '''Audio player activity from the return of the active players command'''
     display_result(ret)
     is_active = False
-    for player in ret ['result']:
+    for player in ret.get('result', []):
         if player['playerid'] == 0:
             is_active = True
     logger.debug('active audio player: %s', is_active)
     return is_active
 
-def player_get_item(server_params):
-    '''Get the current played item'''
-    #TODO: change to return item id only
-    logger.debug('call function get_item')
-    command = {"jsonrpc": "2.0",
+def player_get_item_command():
+    '''Command to get the current played item'''
+    return {"jsonrpc": "2.0",
             "method": "Player.GetItem",
             "params": {
                 "playerid": 0,
                 },
             "id": 1}
-    ret = call_api(server_params, command)
+
+def player_get_item(server_params):
+    '''Get the current played item'''
+    #TODO: change to return item id only
+    logger.debug('call function get_item')
+    ret = call_api(server_params, player_get_item_command())
+    return player_get_item_result(ret)
+
+def player_get_item_result(ret):
+    '''Item id from the return of the played item command'''
     display_result(ret)
     if 'result' in ret:
         return ret['result']['item']['id']
     else:
         return None
 
-def player_get_properties(server_params):
-    '''Get properties of the played item'''
-    logger.debug('call function player_get_properties')
-    command = {"jsonrpc": "2.0",
+def player_get_properties_command():
+    '''Command to get properties of the played item'''
+    return {"jsonrpc": "2.0",
             "method": "Player.GetProperties",
             "params": {
                 "playerid": 0,
@@ -199,7 +674,15 @@ def player_get_properties(server_params):
                     "percentage",
                     "position" ] },
                 "id": 1}
-    ret = call_api(server_params, command)
+
+def player_get_properties(server_params):
+    '''Get properties of the played item'''
+    logger.debug('call function player_get_properties')
+    ret = call_api(server_params, player_get_properties_command())
+    return player_get_properties_result(ret)
+
+def player_get_properties_result(ret):
+    '''Properties from the return of the player properties command'''
     display_result(ret)
     if 'result' in ret:
         result = ret['result']
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''
+Module of the concurrent client for Kodi API management.
+
+Requests are sent without waiting for the previous ones. Over TCP, all of them
+share a single connection and the responses are matched by JSON-RPC id by a
+reader thread. Over HTTP, a pool of workers uses the keep-alive session. The
+command builders of kodi_api give the commands to send.
+'''
+
+import kodi_api
+import api_stats
+
+import socket
+import threading
+import Queue
+import collections
+import heapq
+import random
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+# global constants
+MAX_IN_FLIGHT = 8
+MAX_RETRIES = 3
+# delay before the first retry of a page, doubled at each retry
+RETRY_DELAY = 0.2
+MAX_RETRY_DELAY = 5.0
+TARGET_LATENCY = 0.5
+PAGE_MEMORY_BUDGET = 4 * 1024 * 1024
+MIN_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 5000
+
+class Pending(object):
+    '''Response of a request still in flight'''
+
+    def __init__(self, command, callback=None):
+        self.command = command
+        self.callback = callback
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+        self.nb_bytes = 0
+        self.nb_bytes_sent = 0
+        self.sent = time.time()
+        self.latency = None
+
+    def set_response(self, response):
+        self.response = response
+        self.finish()
+
+    def set_error(self, error):
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        self.latency = time.time() - self.sent
+        self.done.set()
+        if self.callback is not None:
+            self.callback(self)
+
+    def result(self, timeout=None):
+        '''Wait for the response and return it'''
+        if not self.done.wait(timeout):
+            raise socket.timeout('no response for %s' % self.command)
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+class TcpMultiplexer(object):
+    '''Send requests on one TCP connection, dispatch the responses by id'''
+
+    def __init__(self, server_params):
+        self.conn = kodi_api.TcpConnection(
+                server_params['ip'], server_params['port'])
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.reader = None
+
+    def submit(self, command, callback=None):
+        '''Send the command, return its pending response'''
+        command = dict(command)
+        request_id = kodi_api.set_request_id(command)
+        pending = Pending(command, callback)
+        with self.lock:
+            self.pending[request_id] = pending
+            try:
+                self.conn.send(command)
+                pending.nb_bytes_sent = self.conn.last_sent
+            except socket.error as e:
+                del self.pending[request_id]
+                self.conn.close()
+                error = e
+            else:
+                error = None
+            if error is None and self.reader is None:
+                self.reader = threading.Thread(target=self.read_loop)
+                self.reader.daemon = True
+                self.reader.start()
+        if error is not None:
+            pending.set_error(error)
+        return pending
+
+    def read_loop(self):
+        '''Dispatch the received messages to the pending requests'''
+        logger.debug('call read_loop')
+        while True:
+            try:
+                message = self.conn.read_message()
+            except socket.timeout:
+                with self.lock:
+                    if not self.pending:
+                        continue
+                    failed = self.stop_reading()
+                self.fail(failed, socket.timeout('no response from the server'))
+                return
+            except (socket.error, AttributeError) as e:
+                # AttributeError: the socket has been closed meanwhile
+                with self.lock:
+                    failed = self.stop_reading()
+                self.fail(failed, socket.error(str(e)))
+                return
+            if not kodi_api.is_response(message):
+                logger.debug('notification skipped: %s', message)
+                continue
+            if isinstance(message, dict):
+                message = [message]
+            for response in message:
+                with self.lock:
+                    pending = self.pending.pop(response.get('id'), None)
+                if pending is None:
+                    logger.info('unexpected response: %s', response)
+                else:
+                    pending.nb_bytes = self.conn.framer.last_size
+                    pending.set_response(response)
+                    api_stats.record(
+                            'kodi', api_stats.command_method(pending.command),
+                            pending.latency, pending.nb_bytes_sent,
+                            pending.nb_bytes, 'error' in response)
+
+    def stop_reading(self):
+        '''Close the connection, return the pending requests, lock is held'''
+        self.conn.close()
+        self.reader = None
+        failed = self.pending.values()
+        self.pending = {}
+        return failed
+
+    def fail(self, failed, error):
+        '''Release the pending requests with an error'''
+        logger.info('TCP connection lost: %s', error)
+        for pending in failed:
+            pending.set_error(error)
+            api_stats.record(
+                    'kodi', api_stats.command_method(pending.command),
+                    pending.latency, pending.nb_bytes_sent, error=True)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class HttpWorkers(object):
+    '''Send requests from a pool of workers on the keep-alive session'''
+
+    def __init__(self, server_params, nb_workers):
+        self.server_params = server_params
+        self.queue = Queue.Queue()
+        kodi_api.http_session(server_params)
+        for i in range(nb_workers):
+            worker = threading.Thread(target=self.work_loop)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, command, callback=None):
+        '''Queue the command, return its pending response'''
+        pending = Pending(dict(command), callback)
+        self.queue.put(pending)
+        return pending
+
+    def work_loop(self):
+        while True:
+            pending = self.queue.get()
+            try:
+                ret, pending.nb_bytes = kodi_api.post_api_http(
+                        self.server_params, pending.command)
+            except Exception as e:
+                pending.set_error(e)
+            else:
+                pending.set_response(ret)
+
+    def close(self):
+        pass
+
+class KodiClient(object):
+    '''Concurrent client with a bounded number of requests in flight'''
+
+    def __init__(self, server_params, max_in_flight=None):
+        if not max_in_flight:
+            # as many requests as keep-alive connections by default
+            max_in_flight = server_params.get('pool_size') or MAX_IN_FLIGHT
+        self.max_in_flight = max_in_flight
+        self.server_params = server_params
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        if server_params['tcp']:
+            self.transport = TcpMultiplexer(server_params)
+        else:
+            self.transport = HttpWorkers(server_params, max_in_flight)
+
+    def submit(self, command, callback=None):
+        '''Send a command, block while too many requests are in flight'''
+        def release(pending):
+            self.slots.release()
+            if callback is not None:
+                callback(pending)
+        if kodi_api.is_mutating(command):
+            kodi_api.response_cache(self.server_params).invalidate()
+        self.slots.acquire()
+        return self.transport.submit(command, release)
+
+    def call(self, command):
+        '''Send a command and wait for its response'''
+        return self.submit(command).result()
+
+    def call_many(self, commands):
+        '''Send all commands concurrently, return the responses in order'''
+        pendings = [self.submit(command) for command in commands]
+        return [pending.result() for pending in pendings]
+
+    def close(self):
+        self.transport.close()
+
+def kodi_client(server_params, max_in_flight=None):
+    '''Return the concurrent client of the server, create it if needed'''
+    if 'kodi_client' not in server_params:
+        server_params['kodi_client'] = KodiClient(server_params, max_in_flight)
+    return server_params['kodi_client']
+
+# paged downloads
+
+class AdaptivePager(object):
+    '''Hand out page limits, sized from the measures of the previous pages
+
+    The size of the pages grows or shrinks so that a page is received in
+    about TARGET_LATENCY seconds, without any page above the memory budget.
+    '''
+
+    def __init__(self, total, page_size,
+            target_latency=TARGET_LATENCY, memory_budget=PAGE_MEMORY_BUDGET):
+        self.total = total
+        self.page_size = page_size
+        self.target_latency = target_latency
+        self.memory_budget = memory_budget
+        self.cursor = 0
+
+    def has_more(self):
+        return self.cursor < self.total
+
+    def next_limits(self):
+        '''Limits of the next page to download'''
+        limits = (self.cursor, min(self.cursor + self.page_size, self.total))
+        self.cursor = limits[1]
+        return limits
+
+    def record(self, nb_items, latency, nb_bytes):
+        '''Adjust the page size from the measures of a received page'''
+        if not nb_items or not latency:
+            return
+        # no more than doubled or halved at each step, to stay stable
+        ratio = max(0.5, min(2.0, self.target_latency / latency))
+        size = int(self.page_size * ratio)
+        if nb_bytes:
+            size = min(size, self.memory_budget * nb_items // nb_bytes)
+        self.page_size = max(MIN_PAGE_SIZE, min(MAX_PAGE_SIZE, size))
+        logger.debug('page of %i items in %.3f s (%i bytes), next size: %i',
+                nb_items, latency, nb_bytes, self.page_size)
+
+    def record_failure(self):
+        '''Shrink the pages after a failed one, it may have been too big'''
+        self.page_size = max(MIN_PAGE_SIZE, self.page_size // 2)
+
+def retry_delay(nb_retries):
+    '''Delay before a retry, doubled at each one'''
+    delay = min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (nb_retries - 1))
+    # random, so that the pages failed together are not resent together
+    return random.uniform(delay / 2, delay)
+
+def fetch_pages(client, page_command, key, pager, merge):
+    '''Download all pages of a library method concurrently
+
+    The page_command function returns the command for given start and end
+    limits, merge is called with the items of each page as they arrive.
+    The pager gives the limits of the pages and learns from their latency.
+    Failed pages are sent again in smaller pages, up to MAX_RETRIES times,
+    after a growing random delay. Return the number of items received and the time spent.
+    '''
+    logger.debug('call fetch_pages for %i %s', pager.total, key)
+    begin = time.time()
+    # (time of the retry, limits) of the failed pages
+    failed_pages = []
+    retries = collections.Counter()
+    done = Queue.Queue()
+    nb_in_flight = 0
+    nb_items = 0
+    while failed_pages or pager.has_more() or nb_in_flight:
+        now = time.time()
+        while nb_in_flight < client.max_in_flight:
+            if failed_pages and failed_pages[0][0] <= now:
+                limits = heapq.heappop(failed_pages)[1]
+            elif pager.has_more():
+                limits = pager.next_limits()
+            else:
+                break
+            pending = client.submit(page_command(*limits), done.put)
+            pending.limits = limits
+            nb_in_flight += 1
+        if not nb_in_flight:
+            # only failed pages left, wait for the first retry
+            time.sleep(max(0.0, failed_pages[0][0] - now))
+            continue
+        timeout = None
+        if failed_pages:
+            timeout = max(0.0, failed_pages[0][0] - now)
+        try:
+            pending = done.get(timeout=timeout)
+        except Queue.Empty:
+            continue
+        nb_in_flight -= 1
+        try:
+            items = pending.result()['result'].get(key, [])
+        except (KeyError, IOError, ValueError) as e:
+            retries[pending.limits] += 1
+            if retries[pending.limits] > MAX_RETRIES:
+                raise IOError('%s %i to %i failed %i times: %s' % (
+                    key, pending.limits[0], pending.limits[1],
+                    retries[pending.limits], e))
+            logger.info('error when loading %s %i to %i, retry',
+                    key, *pending.limits)
+            api_stats.record_retry(
+                    'kodi', api_stats.command_method(pending.command))
+            pager.record_failure()
+            # the page may have been too big, it is resent in smaller ones
+            start, end = pending.limits
+            nb_retries = retries[pending.limits]
+            size = min(pager.page_size,
+                    max(MIN_PAGE_SIZE, (end - start + 1) // 2))
+            retry_time = time.time() + retry_delay(nb_retries)
+            for page_start in range(start, end, size):
+                limits = (page_start, min(page_start + size, end))
+                retries[limits] = nb_retries
+                heapq.heappush(failed_pages, (retry_time, limits))
+            continue
+        pager.record(len(items), pending.latency, pending.nb_bytes)
+        nb_items += len(items)
+        merge(items)
+    return nb_items, time.time() - begin
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''
+Module of functions for the SQLite library store.
+
+The songs and albums are stored in indexed tables instead of pickle files.
+The DbTable class gives a dict-like access to a table: rows are read on demand
+and not kept, the records report their modifications and only the modified
+rows are written back in a single transaction by flush. The titles, artists
+and genres are also stored folded like the search indexes do, so both stores
+give the same search results.
+'''
+
+import library_records
+from library_index import normalize, match_rank
+
+import sqlite3
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+# global constants
+SONG_COLUMNS = [
+        'title', 'artist', 'year', 'rating', 'playcount',
+        'musicbrainztrackid', 'genre', 'rating_en', 'playcount_en']
+ALBUM_COLUMNS = ['title', 'artist', 'year']
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS songs (
+    id INTEGER PRIMARY KEY,
+    title TEXT,
+    artist TEXT,
+    year INTEGER,
+    rating INTEGER,
+    playcount INTEGER,
+    musicbrainztrackid TEXT,
+    genre TEXT,
+    rating_en INTEGER,
+    playcount_en INTEGER,
+    title_key TEXT,
+    artist_key TEXT);
+CREATE TABLE IF NOT EXISTS albums (
+    id INTEGER PRIMARY KEY,
+    title TEXT,
+    artist TEXT,
+    year INTEGER,
+    title_key TEXT,
+    artist_key TEXT);
+CREATE TABLE IF NOT EXISTS song_genres (
+    song_id INTEGER,
+    genre TEXT,
+    genre_key TEXT);
+CREATE TABLE IF NOT EXISTS profile_delta (
+    song_id INTEGER PRIMARY KEY);
+CREATE INDEX IF NOT EXISTS song_genres_song ON song_genres (song_id);
+'''
+# indexes of the previous versions, not used by any query: the searches
+# match substrings of the folded columns, which an index cannot help
+UNUSED_INDEXES = [
+        'songs_title', 'songs_artist', 'songs_year', 'songs_rating',
+        'songs_playcount', 'albums_title', 'albums_artist', 'albums_year']
+# folded columns, not in the records
+KEY_COLUMNS = ['title_key', 'artist_key']
+# escape character of the LIKE patterns
+LIKE_ESCAPE = '\\'
+
+def open_db(fname):
+    '''Open the library database, create the tables if needed'''
+    logger.debug('call open_db for %s', fname)
+    conn = sqlite3.connect(fname, check_same_thread=False)
+    conn.executescript(SCHEMA)
+    (version,) = conn.execute('PRAGMA user_version').fetchone()
+    if version < 1:
+        # databases of the previous version have no profile delta yet
+        with conn:
+            conn.execute(
+                    'INSERT OR IGNORE INTO profile_delta (song_id) '
+                    'SELECT id FROM songs '
+                    'WHERE rating != rating_en OR playcount != playcount_en')
+            conn.execute('PRAGMA user_version = 1')
+    if version < 2:
+        add_key_columns(conn)
+    if version < 3:
+        # they only slowed down the writes of flush
+        with conn:
+            for index in UNUSED_INDEXES:
+                conn.execute('DROP INDEX IF EXISTS %s' % index)
+            conn.execute('PRAGMA user_version = 3')
+    conn.execute(
+            'CREATE INDEX IF NOT EXISTS song_genres_key '
+            'ON song_genres (genre_key)')
+    return conn
+
+def add_key_columns(conn):
+    '''Add and fill the folded columns, for the previous databases'''
+    logger.info('add the folded columns to the library database')
+    conn.create_function('fold', 1, fold)
+    with conn:
+        for table, columns in (
+                ('songs', KEY_COLUMNS), ('albums', KEY_COLUMNS),
+                ('song_genres', ['genre_key'])):
+            existing = set(row[1] for row in conn.execute(
+                    'PRAGMA table_info(%s)' % table))
+            for column in columns:
+                if column not in existing:
+                    conn.execute('ALTER TABLE %s ADD COLUMN %s TEXT' % (
+                        table, column))
+        for table in ('songs', 'albums'):
+            conn.execute(
+                    'UPDATE %s SET title_key = fold(title), '
+                    'artist_key = fold(artist)' % table)
+        conn.execute('UPDATE song_genres SET genre_key = fold(genre)')
+        conn.execute('DROP INDEX IF EXISTS song_genres_genre')
+        conn.execute('PRAGMA user_version = 2')
+
+def fold(text):
+    '''Folded text of a column, as the search indexes compare them'''
+    return normalize(text or u'')
+
+class DbSong(library_records.Tracked, library_records.Song):
+    __slots__ = ('table', 'item_id')
+
+class DbAlbum(library_records.Tracked, library_records.Album):
+    __slots__ = ('table', 'item_id')
+
+class DbTable(object):
+    '''Dict-like access to the songs or albums table'''
+
+    def __init__(self, conn, table):
+        self.conn = conn
+        self.table = table
+        if table == 'songs':
+            self.columns = SONG_COLUMNS
+            self.record_class = DbSong
+        else:
+            self.columns = ALBUM_COLUMNS
+            self.record_class = DbAlbum
+        # records modified since the last flush, and the ids of these
+        # records not in the database yet
+        self.modified = {}
+        self.added = set()
+        # ids in the database removed since the last flush
+        self.deleted = set()
+
+    def __len__(self):
+        (nb_rows,) = self.conn.execute(
+                'SELECT COUNT(*) FROM %s' % self.table).fetchone()
+        return nb_rows - len(self.deleted) + len(self.added)
+
+    def __contains__(self, item_id):
+        if item_id in self.modified:
+            return True
+        return item_id not in self.deleted and self.in_db(item_id)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, item_id):
+        if item_id in self.modified:
+            return self.modified[item_id]
+        if item_id in self.deleted:
+            raise KeyError(item_id)
+        row = self.conn.execute(
+                'SELECT %s FROM %s WHERE id = ?' % (
+                    ', '.join(self.columns), self.table),
+                (item_id,)).fetchone()
+        if row is None:
+            raise KeyError(item_id)
+        # not kept, its modifications are reported by the record
+        return self.to_record(item_id, row)
+
+    def __setitem__(self, item_id, record):
+        if item_id in self.deleted:
+            self.deleted.discard(item_id)
+        elif item_id not in self.modified and not self.in_db(item_id):
+            self.added.add(item_id)
+        tracked = self.new_record(item_id)
+        for key, value in record.items():
+            library_records.Record.__setitem__(tracked, key, value)
+        self.modified[item_id] = tracked
+
+    def __delitem__(self, item_id):
+        if item_id not in self:
+            raise KeyError(item_id)
+        self.modified.pop(item_id, None)
+        if item_id in self.added:
+            self.added.discard(item_id)
+        else:
+            self.deleted.add(item_id)
+
+    def new_record(self, item_id):
+        record = self.record_class()
+        record.table = self
+        record.item_id = item_id
+        return record
+
+    def record_changed(self, item_id, record, key, value):
+        '''Called by the records when a field is modified'''
+        self.modified[item_id] = record
+
+    def in_db(self, item_id):
+        return self.conn.execute(
+                'SELECT 1 FROM %s WHERE id = ?' % self.table,
+                (item_id,)).fetchone() is not None
+
+    def keys(self):
+        '''All ids, sorted'''
+        ids = set(row[0] for row in self.conn.execute(
+                'SELECT id FROM %s' % self.table))
+        ids.update(self.added)
+        ids.difference_update(self.deleted)
+        return sorted(ids)
+
+    def column_values(self, name):
+        '''Values of a field by id, read in a single query'''
+        if name not in self.columns:
+            raise KeyError(name)
+        values = dict(self.conn.execute(
+                'SELECT id, %s FROM %s' % (name, self.table)))
+        if name == 'genre':
+            # each distinct list of genres is decoded once
+            decoded = {}
+            for item_id, value in values.items():
+                if value not in decoded:
+                    decoded[value] = json.loads(value or '[]')
+                values[item_id] = decoded[value]
+        for item_id in self.deleted:
+            values.pop(item_id, None)
+        for item_id, record in self.modified.items():
+            values[item_id] = record.get(name)
+        return values
+
+    def to_record(self, item_id, row):
+        record = self.new_record(item_id)
+        for column, value in zip(self.columns, row):
+            if column == 'genre':
+                value = json.loads(value or '[]')
+            # not reported as a modification
+            library_records.Record.__setitem__(record, column, value)
+        return record
+
+    def to_row(self, item_id, record):
+        row = [item_id]
+        for column in self.columns:
+            value = record.get(column)
+            if column == 'genre':
+                value = json.dumps(list(value or []))
+            row.append(value)
+        row.append(fold(record.get('title')))
+        row.append(fold(record.get('artist')))
+        return row
+
+    def flush(self):
+        '''Write the modified rows in a single transaction'''
+        logger.debug('flush %i rows to %s', len(self.modified), self.table)
+        columns = self.columns + KEY_COLUMNS
+        changed = list(self.modified) + list(self.deleted)
+        with self.conn:
+            self.conn.executemany(
+                    'INSERT OR REPLACE INTO %s (id, %s) VALUES (?, %s)' % (
+                        self.table,
+                        ', '.join(columns),
+                        ', '.join('?' * len(columns))),
+                    (self.to_row(i, r) for i, r in self.modified.items()))
+            self.conn.executemany(
+                    'DELETE FROM %s WHERE id = ?' % self.table,
+                    ((i,) for i in self.deleted))
+            if self.table == 'songs':
+                self.conn.executemany(
+                        'DELETE FROM song_genres WHERE song_id = ?',
+                        ((i,) for i in changed))
+                self.conn.executemany(
+                        'INSERT INTO song_genres (song_id, genre, genre_key) '
+                        'VALUES (?, ?, ?)',
+                        ((i, genre, fold(genre))
+                            for i, r in self.modified.items()
+                            for genre in r.get('genre') or []))
+                self.conn.executemany(
+                        'DELETE FROM profile_delta WHERE song_id = ?',
+                        ((i,) for i in changed))
+                self.conn.executemany(
+                        'INSERT INTO profile_delta (song_id) VALUES (?)',
+                        ((i,) for i, r in self.modified.items()
+                            if library_records.profile_changed(r)))
+        self.modified = {}
+        self.added = set()
+        self.deleted = set()
+
+# queries
+
+def like_pattern(text):
+    '''LIKE pattern of the texts containing the text'''
+    for special in (LIKE_ESCAPE, '%', '_'):
+        text = text.replace(special, LIKE_ESCAPE + special)
+    return '%' + text + '%'
+
+def search_titles(table, search_string):
+    '''Ids with the string in the title or artist, best matches first'''
+    query = normalize(search_string)
+    rows = table.conn.execute(
+            'SELECT id, title_key, artist_key FROM %s '
+            'WHERE title_key LIKE ? ESCAPE ? OR artist_key LIKE ? ESCAPE ?'
+            % table.table,
+            (like_pattern(query), LIKE_ESCAPE) * 2)
+    # ranked as the search indexes do
+    results = []
+    for item_id, title, artist in rows:
+        rank = match_rank(query, title)
+        if rank is None:
+            rank = match_rank(query, artist)
+            if rank is None:
+                continue
+            rank += 4
+        results.append((rank, item_id))
+    results.sort()
+    return [item_id for rank, item_id in results]
+
+def search_genre(table, genre):
+    '''Song ids of a genre, the case and accents are ignored'''
+    rows = table.conn.execute(
+            'SELECT DISTINCT song_id FROM song_genres WHERE genre_key = ?',
+            (normalize(genre),))
+    return sorted(row[0] for row in rows)
+
+def genre_counts(table):
+    '''Genre names with their number of songs, by name'''
+    rows = table.conn.execute(
+            'SELECT MIN(genre), COUNT(DISTINCT song_id) FROM song_genres '
+            'GROUP BY genre_key')
+    return sorted(rows)
+
+def profile_delta(table):
+    '''Song ids with echonest rating or playcount not up-to-date'''
+    ids = set(row[0] for row in table.conn.execute(
+            'SELECT song_id FROM profile_delta'))
+    # records modified since the last flush
+    for song_id, record in table.modified.items():
+        if library_records.profile_changed(record):
+            ids.add(song_id)
+        else:
+            ids.discard(song_id)
+    ids.difference_update(table.deleted)
+    return sorted(ids)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''
+Module of the search indexes of the local library.
+
+Titles and artists are normalized (lower case, accents removed) and kept as
+UTF-8 strings. Every title trigram points to a sorted array of the rows
+containing it, a substring query intersects the rows of its trigrams and
+only checks these candidates. The artists are indexed once each and point to
+the array of their items. The genres are indexed by their normalized name.
+
+The indexes are built on the first search, so loading the library does not
+wait for them, and the arrays keep them small next to the snapshots.
+'''
+
+import array
+import bisect
+import unicodedata
+import logging
+logger = logging.getLogger(__name__)
+
+# global constants
+GRAM_SIZE = 3
+
+class FoldTable(dict):
+    '''Translation table removing accents, filled on demand'''
+
+    def __missing__(self, code):
+        decomposed = unicodedata.normalize('NFKD', unichr(code))
+        folded = u''.join(
+                c for c in decomposed if not unicodedata.combining(c))
+        self[code] = folded
+        return folded
+
+fold_table = FoldTable()
+
+def normalize(text):
+    '''Lower case text without accents, for comparisons'''
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+    return text.lower().translate(fold_table)
+
+def grams(text):
+    '''Set of the trigrams of a normalized text'''
+    return set([text[i:i + GRAM_SIZE]
+            for i in xrange(len(text) - GRAM_SIZE + 1)])
+
+def encode(text):
+    '''Normalized UTF-8 text, without the separator of the titles'''
+    return normalize(text or u'').replace(u'\x00', u'').encode('utf-8')
+
+def match_rank(query, text):
+    '''Quality of a match, lower is better, None if no match'''
+    if text == query:
+        return 0
+    if text.startswith(query):
+        return 1
+    if (' ' + query) in text:
+        return 2
+    if query in text:
+        return 3
+    return None
+
+def intersection(postings):
+    '''Values which may be in all the postings
+
+    The values are checked by the caller, so the intersection stops when
+    the values left are much fewer than the ones of the next posting.
+    '''
+    postings.sort(key=len)
+    values = set(postings[0])
+    for other in postings[1:]:
+        if len(values) * 16 < len(other):
+            break
+        values.intersection_update(other)
+    return values
+
+class TextIndex(object):
+    '''Trigram index of the title and artist of songs or albums'''
+
+    def __init__(self, items=None):
+        # indexed on the first search
+        self.items = items
+        # by row: item id, -1 once removed, and number of the artist
+        self.ids = array.array('i')
+        self.artist_rows = array.array('i')
+        # titles separated by a null byte, the start of each one and the end
+        self.titles = bytearray()
+        self.offsets = array.array('i', [0])
+        self.postings = {}
+        # by artist number: normalized name and item ids
+        self.artists = []
+        self.artist_items = []
+        self.artist_numbers = {}
+        self.artist_postings = {}
+        self.nb_items = 0
+
+    def __len__(self):
+        self.build()
+        return self.nb_items
+
+    def build(self):
+        '''Index all the items, if not done yet'''
+        items = self.items
+        if items is None:
+            return
+        logger.debug('build text index')
+        self.items = None
+        if hasattr(items, 'column_values'):
+            # snapshot tables read whole columns much faster than records
+            titles = items.column_values('title')
+            artists = items.column_values('artist')
+            for item_id in sorted(titles):
+                self.append(item_id, titles[item_id], artists[item_id])
+        else:
+            for item_id in items.keys():
+                record = items[item_id]
+                self.append(item_id, record.get('title'), record.get('artist'))
+
+    def add(self, item_id, record):
+        '''Index an item, replace it if already indexed'''
+        if self.items is not None:
+            # the build reads the items as they are then
+            return
+        if self.row_of(item_id) is not None:
+            self.remove(item_id)
+        self.append(item_id, record.get('title'), record.get('artist'))
+
+    def append(self, item_id, title, artist):
+        row = len(self.ids)
+        self.ids.append(item_id)
+        title = encode(title)
+        self.titles.extend(title + b'\x00')
+        self.offsets.append(len(self.titles))
+        postings = self.postings
+        for gram in grams(title):
+            rows = postings.get(gram)
+            if rows is None:
+                rows = postings[gram] = array.array('i')
+            rows.append(row)
+        number = self.artist_number(artist or u'')
+        self.artist_rows.append(number)
+        self.artist_items[number].append(item_id)
+        self.nb_items += 1
+
+    def artist_number(self, artist):
+        '''Number of an artist, index it if needed'''
+        number = self.artist_numbers.get(artist)
+        if number is None:
+            number = len(self.artists)
+            self.artist_numbers[artist] = number
+            name = encode(artist)
+            self.artists.append(name)
+            self.artist_items.append(array.array('i'))
+            for gram in grams(name):
+                self.artist_postings.setdefault(gram, []).append(number)
+        return number
+
+    def row_of(self, item_id):
+        try:
+            return self.ids.index(item_id)
+        except ValueError:
+            return None
+
+    def remove(self, item_id):
+        '''Remove an item from the index'''
+        if self.items is not None:
+            return
+        row = self.row_of(item_id)
+        if row is None:
+            raise KeyError(item_id)
+        # the title stays in the postings, its row is skipped
+        self.ids[row] = -1
+        self.artist_items[self.artist_rows[row]].remove(item_id)
+        self.nb_items -= 1
+
+    def title_rows(self, query):
+        '''Rows which may contain the query in their title'''
+        if not query:
+            return range(len(self.ids))
+        query_grams = grams(query)
+        if query_grams:
+            return intersection(
+                    [self.postings.get(gram, ()) for gram in query_grams])
+        # too short for trigrams, the titles are scanned
+        rows = []
+        find = self.titles.find
+        offsets = self.offsets
+        pos = find(query)
+        while pos >= 0:
+            row = bisect.bisect_right(offsets, pos) - 1
+            rows.append(row)
+            pos = find(query, offsets[row + 1])
+        return rows
+
+    def artist_candidates(self, query):
+        '''Numbers of the artists which may contain the query'''
+        query_grams = grams(query)
+        if not query_grams:
+            return [number for number, name in enumerate(self.artists)
+                    if query in name]
+        return intersection(
+                [self.artist_postings.get(gram, ()) for gram in query_grams])
+
+    def search(self, search_string):
+        '''Ids with the string in the title or artist, best matches first'''
+        self.build()
+        query = encode(search_string)
+        # ids by rank, title matches come before artist matches
+        ranks = [[] for rank in range(8)]
+        ids = self.ids
+        titles = self.titles
+        offsets = self.offsets
+        word = b' ' + query
+        for row in self.title_rows(query):
+            item_id = ids[row]
+            if item_id < 0:
+                continue
+            # match_rank of the title, without copying it out of the buffer
+            start = offsets[row]
+            end = offsets[row + 1] - 1
+            pos = titles.find(query, start, end)
+            if pos < 0:
+                continue
+            if pos == start:
+                rank = 0 if end - start == len(query) else 1
+            elif titles.find(word, start, end) >= 0:
+                rank = 2
+            else:
+                rank = 3
+            ranks[rank].append(item_id)
+        found = set()
+        for rank_ids in ranks[:4]:
+            found.update(rank_ids)
+        for number in self.artist_candidates(query):
+            rank = match_rank(query, self.artists[number])
+            if rank is None:
+                continue
+            if found:
+                ranks[rank + 4].extend(item_id
+                        for item_id in self.artist_items[number]
+                        if item_id not in found)
+            else:
+                ranks[rank + 4].extend(self.artist_items[number])
+        results = []
+        for rank_ids in ranks:
+            rank_ids.sort()
+            results.extend(rank_ids)
+        return results
+
+def build_text_index(items):
+    '''Index of the title and artist of all items, built on first use'''
+    logger.debug('call build_text_index')
+    return TextIndex(items)
+
+class GenreIndex(object):
+    '''Song ids by normalized genre'''
+
+    def __init__(self, songs=None):
+        # indexed on the first search
+        self.items = songs
+        self.songs = {}
+        self.names = {}
+
+    def build(self):
+        '''Index all the songs, if not done yet'''
+        songs = self.items
+        if songs is None:
+            return
+        logger.debug('build genre index')
+        self.items = None
+        if hasattr(songs, 'column_values'):
+            genres = songs.column_values('genre')
+            for song_id in sorted(genres):
+                self.append(song_id, genres[song_id])
+        else:
+            for song_id in songs.keys():
+                self.append(song_id, songs[song_id].get('genre'))
+
+    def add(self, song_id, record):
+        '''Index a song, replace it if already indexed'''
+        if self.items is not None:
+            # the build reads the songs as they are then
+            return
+        self.remove(song_id)
+        self.append(song_id, record.get('genre'))
+
+    def append(self, song_id, genres):
+        # genres differing by their case or accents only are one genre
+        keys = set()
+        for genre in genres or []:
+            key = normalize(genre)
+            if key in keys:
+                continue
+            keys.add(key)
+            self.names.setdefault(key, genre)
+            ids = self.songs.get(key)
+            if ids is None:
+                ids = self.songs[key] = array.array('i')
+            ids.append(song_id)
+
+    def remove(self, song_id):
+        '''Remove a song from the index'''
+        if self.items is not None:
+            return
+        for key, ids in self.songs.items():
+            if song_id in ids:
+                ids.remove(song_id)
+                if not ids:
+                    del self.songs[key]
+                    del self.names[key]
+
+    def search(self, genre):
+        '''Song ids of a genre, the case and accents are ignored'''
+        self.build()
+        return list(self.songs.get(normalize(genre), ()))
+
+    def counts(self):
+        '''Genre names with their number of songs, by name'''
+        self.build()
+        return sorted(
+                (self.names[key], len(ids)) for key, ids in self.songs.items())
+
+def build_genre_index(songs):
+    '''Index of the genres of all songs, built on first use'''
+    logger.debug('call build_genre_index')
+    return GenreIndex(songs)
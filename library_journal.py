@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''
+Module of the append-only journal of the library changes.
+
+Each line is a JSON array: the item id and the modified fields, or null when
+the item has been removed. The journal is replayed over the snapshot at load
+time. When it is compacted in a new snapshot, it is first renamed so that the
+changes made meanwhile go to a new journal.
+'''
+
+import json
+import os
+import shutil
+import logging
+logger = logging.getLogger(__name__)
+
+def open_lines(fname):
+    '''Open a file of lines to append to it, after a complete line'''
+    f = open(fname, 'a+b')
+    f.seek(0, os.SEEK_END)
+    if f.tell():
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'\n':
+            # a write interrupted by a crash, its entry is skipped at
+            # replay but the next ones must not be appended to it
+            f.seek(0, os.SEEK_END)
+            f.write(b'\n')
+        f.seek(0, os.SEEK_END)
+    return f
+
+class Journal(object):
+    '''Append-only file of the changes made after a snapshot'''
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.rotated_fname = fname + '.compacting'
+        self.nb_entries = 0
+
+    def append(self, entries):
+        '''Write (id, fields) entries, fields is None for a removal'''
+        if not entries:
+            return
+        logger.debug('append %i entries to %s', len(entries), self.fname)
+        data = b''.join(
+                json.dumps([item_id, fields]).encode('utf-8') + b'\n'
+                for item_id, fields in entries)
+        f = open_lines(self.fname)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        self.nb_entries += len(entries)
+
+    def entries(self):
+        '''All entries, the ones of an interrupted compaction first'''
+        self.nb_entries = 0
+        for fname in (self.rotated_fname, self.fname):
+            if not os.path.exists(fname):
+                continue
+            f = open(fname, 'rb')
+            for line in f:
+                try:
+                    item_id, fields = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # last line of a write interrupted by a crash
+                    logger.info('invalid journal entry skipped in %s', fname)
+                    continue
+                self.nb_entries += 1
+                yield item_id, fields
+            f.close()
+
+    def rotate(self):
+        '''Set the current entries aside before a compaction'''
+        self.nb_entries = 0
+        if not os.path.exists(self.fname):
+            return
+        if os.path.exists(self.rotated_fname):
+            # entries of an interrupted compaction, kept until the end
+            rotated = open_lines(self.rotated_fname)
+            f = open(self.fname, 'rb')
+            shutil.copyfileobj(f, rotated)
+            f.close()
+            rotated.close()
+            os.remove(self.fname)
+        else:
+            os.rename(self.fname, self.rotated_fname)
+
+    def drop_rotated(self):
+        '''Remove the entries set aside, they are in the new snapshot'''
+        if os.path.exists(self.rotated_fname):
+            os.remove(self.rotated_fname)
+
+    def clear(self):
+        '''Remove all entries'''
+        self.drop_rotated()
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+        self.nb_entries = 0
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''
+Module of the local playlist recommendations.
+
+Each song is described by sparse features: its genres, its artist, its
+decade and its year. The features are numbered once, and each one keeps the
+indexes of its songs (a column of the song-feature matrix) with an inverse
+frequency weight, so that a rare genre counts more than a common one. The
+rating and the playcount give a prior score by song.
+
+A query is a weighted set of features: the ones of a seed song, or the
+strongest ones of the best rated and most played songs for the taste
+profile. Its scores are accumulated column by column, which only touches the
+songs sharing a feature with it. The playlist is drawn at random among the
+best songs, so a regenerated playlist is different.
+'''
+
+from library_index import normalize
+
+import array
+import math
+import heapq
+import random
+import logging
+logger = logging.getLogger(__name__)
+
+# global constants
+PLAYLIST_SIZE = 50
+GENRE_WEIGHT = 1.0
+ARTIST_WEIGHT = 1.5
+DECADE_WEIGHT = 0.5
+YEAR_WEIGHT = 0.3
+RATING_WEIGHT = 0.5
+PLAYCOUNT_WEIGHT = 0.3
+# songs making the taste profile, and features of the profile query
+PROFILE_SIZE = 200
+PROFILE_FEATURES = 40
+# the playlist is drawn among POOL_RATIO times its size of best songs
+POOL_RATIO = 3
+MAX_BY_ARTIST = 3
+
+class Recommender(object):
+    '''Precomputed features of the songs of the library'''
+
+    def __init__(self):
+        self.song_ids = array.array('i')
+        self.indexes = {}
+        # (rating, playcount) until finish, then the prior scores
+        self.priors = []
+        self.inverse_norms = array.array('d')
+        self.artists = []
+        self.mbids = []
+        # features of each song, song indexes and weight of each feature
+        self.song_features = []
+        self.feature_ids = {}
+        self.columns = []
+        self.kind_weights = []
+        self.weights = array.array('d')
+
+    def feature(self, key, kind_weight):
+        '''Number of a feature, add it if needed'''
+        feature_id = self.feature_ids.get(key)
+        if feature_id is None:
+            feature_id = len(self.columns)
+            self.feature_ids[key] = feature_id
+            self.columns.append(array.array('i'))
+            self.kind_weights.append(kind_weight)
+        return feature_id
+
+    def add(self, song_id, record):
+        '''Add a song, the weights are computed by finish'''
+        index = len(self.song_ids)
+        self.song_ids.append(song_id)
+        self.indexes[song_id] = index
+        keys = [(GENRE_WEIGHT, ('genre', normalize(genre)))
+                for genre in record.get('genre') or []]
+        artist = normalize(record.get('artist') or u'')
+        if artist:
+            keys.append((ARTIST_WEIGHT, ('artist', artist)))
+        year = record.get('year') or 0
+        if year:
+            keys.append((DECADE_WEIGHT, ('decade', year // 10)))
+            keys.append((YEAR_WEIGHT, ('year', year)))
+        features = []
+        for kind_weight, key in keys:
+            feature_id = self.feature(key, kind_weight)
+            self.columns[feature_id].append(index)
+            features.append(feature_id)
+        self.song_features.append(tuple(features))
+        self.artists.append(artist)
+        self.mbids.append(record.get('musicbrainztrackid') or None)
+        self.priors.append(
+                (record.get('rating') or 0, record.get('playcount') or 0))
+
+    def finish(self):
+        '''Compute the feature weights, the song norms and priors'''
+        nb_songs = len(self.song_ids)
+        self.weights = array.array('d', (
+                kind_weight * math.log(1.0 + float(nb_songs) / len(column))
+                for kind_weight, column in zip(
+                    self.kind_weights, self.columns)))
+        self.inverse_norms = array.array('d', (
+                1.0 / (math.sqrt(sum(self.weights[feature_id] ** 2
+                    for feature_id in features)) or 1.0)
+                for features in self.song_features))
+        max_playcount = max([playcount for rating, playcount in self.priors]
+                or [0])
+        playcount_scale = math.log(1.0 + max_playcount) or 1.0
+        self.priors = array.array('d', (
+                RATING_WEIGHT * (rating - 2.5) / 2.5 * bool(rating)
+                + PLAYCOUNT_WEIGHT * math.log(1.0 + playcount)
+                    / playcount_scale
+                for rating, playcount in self.priors))
+        logger.info('recommender: %i songs, %i features',
+                nb_songs, len(self.columns))
+
+    def __contains__(self, song_id):
+        return song_id in self.indexes
+
+    def scores(self, query):
+        '''Cosine similarity to the query by song index, plus the prior
+
+        The query gives a number of occurrences by feature.
+        '''
+        query_norm = math.sqrt(sum(
+            (weight * self.weights[feature_id]) ** 2
+            for feature_id, weight in query.items())) or 1.0
+        scores = {}
+        get = scores.get
+        inverse_norms = self.inverse_norms
+        priors = self.priors
+        for feature_id, weight in query.items():
+            value = weight * self.weights[feature_id] ** 2 / query_norm
+            for index in self.columns[feature_id]:
+                scores[index] = (get(index, priors[index])
+                        + value * inverse_norms[index])
+        return scores
+
+    def draw(self, scores, size, first=None):
+        '''Draw songs among the best, with a few songs by artist'''
+        pool = heapq.nlargest(size * POOL_RATIO, scores, key=scores.get)
+        if not pool:
+            return []
+        # weighted draw without replacement: the larger u ** (1 / weight)
+        lowest = scores[pool[-1]]
+        keys = [(random.random() ** (1.0 / (scores[index] - lowest + 0.01)),
+                    index)
+                for index in pool]
+        keys.sort(reverse=True)
+        playlist = []
+        by_artist = {}
+        mbids = set()
+        if first is not None:
+            keys.insert(0, (None, first))
+        for key, index in keys:
+            if len(playlist) == size:
+                break
+            if index == first and playlist:
+                continue
+            artist = self.artists[index]
+            if by_artist.get(artist, 0) >= MAX_BY_ARTIST:
+                continue
+            # the same recording on several albums is played once
+            mbid = self.mbids[index]
+            if mbid in mbids:
+                continue
+            if mbid:
+                mbids.add(mbid)
+            by_artist[artist] = by_artist.get(artist, 0) + 1
+            playlist.append(self.song_ids[index])
+        return playlist
+
+    def seed_playlist(self, song_id, size=PLAYLIST_SIZE):
+        '''Songs similar to the seed song, the seed first'''
+        logger.debug('call seed_playlist for %i', song_id)
+        seed = self.indexes[song_id]
+        scores = self.scores(dict.fromkeys(self.song_features[seed], 1.0))
+        return self.draw(scores, size, seed)
+
+    def profile_playlist(self, size=PLAYLIST_SIZE):
+        '''Songs matching the best rated and most played songs'''
+        logger.debug('call profile_playlist')
+        liked = heapq.nlargest(
+                PROFILE_SIZE,
+                (i for i in range(len(self.song_ids)) if self.priors[i] > 0),
+                key=lambda index: self.priors[index])
+        if not liked:
+            # nothing rated or played yet, any song will do
+            return self.draw(dict.fromkeys(range(len(self.song_ids)), 0.0),
+                    size)
+        query = {}
+        for index in liked:
+            for feature_id in self.song_features[index]:
+                query[feature_id] = (query.get(feature_id, 0.0)
+                        + self.priors[index])
+        # the weak features would add most of the songs for little
+        strongest = heapq.nlargest(PROFILE_FEATURES, query,
+                key=lambda feature_id:
+                    query[feature_id] * self.weights[feature_id] ** 2)
+        query = dict((feature_id, query[feature_id])
+                for feature_id in strongest)
+        return self.draw(self.scores(query), size)
+
+def build_recommender(songs):
+    '''Compute the features of all songs'''
+    logger.debug('call build_recommender')
+    recommender = Recommender()
+    fields = ('genre', 'artist', 'year', 'rating', 'playcount',
+            'musicbrainztrackid')
+    if hasattr(songs, 'column_values'):
+        # the snapshot and database tables read whole columns much faster
+        # than records
+        columns = [(field, songs.column_values(field)) for field in fields]
+        for song_id in sorted(columns[0][1]):
+            recommender.add(song_id, dict(
+                (field, values[song_id]) for field, values in columns))
+    else:
+        for song_id in songs.keys():
+            recommender.add(song_id, songs[song_id])
+    recommender.finish()
+    return recommender
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''
+Module of the compact song and album records.
+
+The records have fixed fields stored in slots instead of a dict per item, and
+the artist and genre values are interned so the same string is shared by all
+the songs of an artist or a genre. They are read and written like dicts, so
+songs[song_id]['artist'] works as before.
+'''
+
+import logging
+logger = logging.getLogger(__name__)
+
+# interned strings and genre tuples, shared by all records
+interned = {}
+# fields pushed to the echonest taste profile, with their pushed values
+PROFILE_FIELDS = (('rating', 'rating_en'), ('playcount', 'playcount_en'))
+
+def intern_value(value):
+    '''Shared instance of an equal string or tuple'''
+    return interned.setdefault(value, value)
+
+class Record(object):
+    '''Record with fixed fields and a dict interface'''
+    __slots__ = ()
+    fields = ()
+    interned_fields = ()
+
+    def __init__(self, values=(), **kwargs):
+        for key, value in dict(values, **kwargs).items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(key)
+        if key in self.interned_fields and value is not None:
+            if isinstance(value, list):
+                value = tuple(value)
+            value = intern_value(value)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.fields and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        try:
+            return dict(self.items()) == dict(other.items())
+        except AttributeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            self[key] = value
+
+    def get(self, key, default=None):
+        # only the fields, not the attributes and methods of the class
+        if key not in self.fields:
+            return default
+        return getattr(self, key, default)
+
+    def keys(self):
+        return [key for key in self.fields if hasattr(self, key)]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+class Song(Record):
+    '''Song of the local library'''
+    fields = (
+            'title', 'artist', 'year', 'rating', 'playcount',
+            'musicbrainztrackid', 'genre', 'rating_en', 'playcount_en')
+    __slots__ = fields
+    interned_fields = ('artist', 'genre')
+
+class Album(Record):
+    '''Album of the local library'''
+    fields = ('title', 'artist', 'year')
+    __slots__ = fields
+    interned_fields = ('artist',)
+
+class Tracked(object):
+    '''Record read from a table, modifications are reported to the table'''
+    __slots__ = ()
+
+    def __setitem__(self, key, value):
+        super(Tracked, self).__setitem__(key, value)
+        self.table.record_changed(self.item_id, self, key, value)
+
+def profile_changed(record):
+    '''True if the record differs from the values pushed to the profile'''
+    for field, pushed_field in PROFILE_FIELDS:
+        if record.get(field) != record.get(pushed_field):
+            return True
+    return False
@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''
+Module of functions for the memory-mapped library snapshots.
+
+A snapshot stores the songs or albums by columns. The numeric columns are
+arrays of 32 bits integers, the text columns are indexes in a table of
+interned strings. The file is memory-mapped, so opening it is immediate and
+only the pages of the accessed items are read from the disk.
+
+File layout: the magic string, the length of a JSON header, the header
+(number of rows, offset and kind of each column, offsets of the string
+table), then the columns, the ids of the songs to push to the taste profile,
+the string offsets and the UTF-8 strings blob.
+
+The modifications are appended to a journal instead of rewriting the file.
+The journal is replayed when the snapshot is opened, and compacted in a new
+snapshot in the background when it gets long.
+'''
+
+import mmap
+import struct
+import array
+import json
+import os
+import sys
+import bisect
+import threading
+import library_records
+import library_journal
+
+import logging
+logger = logging.getLogger(__name__)
+
+# global constants
+MAGIC = b'PKLS'
+VERSION = 2
+GENRE_SEPARATOR = u'\x1f'
+# journal entries above which the snapshot is rewritten
+JOURNAL_MAX_ENTRIES = 20000
+# MoveFileEx flags, os.rename does not replace a file on Windows
+MOVEFILE_REPLACE_EXISTING = 0x1
+MOVEFILE_WRITE_THROUGH = 0x8
+# column kinds: 'i' integer, 's' string, 'l' list of strings
+SONG_COLUMNS = [
+        ('title', 's'),
+        ('artist', 's'),
+        ('year', 'i'),
+        ('rating', 'i'),
+        ('playcount', 'i'),
+        ('musicbrainztrackid', 's'),
+        ('genre', 'l'),
+        ('rating_en', 'i'),
+        ('playcount_en', 'i')]
+ALBUM_COLUMNS = [
+        ('title', 's'),
+        ('artist', 's'),
+        ('year', 'i')]
+
+def int_array(values):
+    '''Array of little-endian 32 bits integers'''
+    ret = array.array('i', values)
+    if sys.byteorder == 'big':
+        ret.byteswap()
+    return ret
+
+def replace_file(src, dst):
+    '''Rename src to dst, replace dst if it exists'''
+    if os.name != 'nt':
+        os.rename(src, dst)
+        return
+    import ctypes
+    flags = MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH
+    if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst),
+            flags):
+        raise ctypes.WinError()
+
+def write_snapshot(fname, items, columns):
+    '''Write the items, a dict of records by id, to a snapshot file'''
+    logger.debug('call write_snapshot for %s', fname)
+    ids = sorted(items)
+    strings = []
+    string_indexes = {}
+    def intern(value):
+        if value not in string_indexes:
+            string_indexes[value] = len(strings)
+            strings.append(value)
+        return string_indexes[value]
+    data = [('id', 'i', int_array(ids))]
+    for name, kind in columns:
+        if kind == 'i':
+            values = [items[i].get(name) or 0 for i in ids]
+        elif kind == 's':
+            values = [intern(items[i].get(name) or u'') for i in ids]
+        else:
+            values = [intern(GENRE_SEPARATOR.join(items[i].get(name) or []))
+                    for i in ids]
+        data.append((name, kind, int_array(values)))
+    encoded = [string.encode('utf-8') for string in strings]
+    string_offsets = [0]
+    for string in encoded:
+        string_offsets.append(string_offsets[-1] + len(string))
+    # offsets are relative to the end of the header
+    header = {'version': VERSION, 'nb_rows': len(ids), 'columns': {}}
+    offset = 0
+    for name, kind, values in data:
+        header['columns'][name] = [kind, offset]
+        offset += len(values) * values.itemsize
+    dirty = None
+    if 'rating_en' in dict(columns):
+        # songs to push to the taste profile, kept with the library
+        dirty = int_array(i for i in ids
+                if library_records.profile_changed(items[i]))
+        header['dirty'] = [offset, len(dirty)]
+        offset += len(dirty) * dirty.itemsize
+    header['string_offsets'] = offset
+    header['strings'] = offset + len(string_offsets) * 4
+    header_data = json.dumps(header).encode('utf-8')
+    tmp_fname = fname + '.tmp'
+    f = open(tmp_fname, 'wb')
+    f.write(MAGIC)
+    f.write(struct.pack('<I', len(header_data)))
+    f.write(header_data)
+    for name, kind, values in data:
+        values.tofile(f)
+    if dirty is not None:
+        dirty.tofile(f)
+    int_array(string_offsets).tofile(f)
+    f.write(b''.join(encoded))
+    # the data is on the disk before the rename makes it the snapshot
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    # the old snapshot stays valid until the new one is complete
+    replace_file(tmp_fname, fname)
+
+class Snapshot(object):
+    '''Read-only access to a memory-mapped snapshot file'''
+
+    def __init__(self, fname):
+        logger.debug('open snapshot %s', fname)
+        f = open(fname, 'rb')
+        self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        if self.mm[:4] != MAGIC:
+            raise IOError('%s is not a library snapshot' % fname)
+        (header_size,) = struct.unpack_from('<I', self.mm, 4)
+        header = json.loads(self.mm[8:8 + header_size].decode('utf-8'))
+        base = 8 + header_size
+        self.nb_rows = header['nb_rows']
+        self.columns = {}
+        for name, (kind, offset) in header['columns'].items():
+            self.columns[name] = (kind, base + offset)
+        self.string_offsets = base + header['string_offsets']
+        self.dirty = header.get('dirty')
+        if self.dirty and header['version'] >= 2:
+            offset, nb_dirty = self.dirty
+            self.dirty = self.integers(base + offset, nb_dirty)
+        self.strings = base + header['strings']
+
+    def close(self):
+        self.mm.close()
+
+    def integer(self, name, row):
+        return struct.unpack_from(
+                '<i', self.mm, self.columns[name][1] + 4 * row)[0]
+
+    def integers(self, offset, count):
+        '''Array of the integers at the offset'''
+        ret = array.array('i')
+        ret.fromstring(self.mm[offset:offset + 4 * count])
+        if sys.byteorder == 'big':
+            ret.byteswap()
+        return ret
+
+    def column(self, name):
+        '''All values of an integer column'''
+        return self.integers(self.columns[name][1], self.nb_rows)
+
+    def string(self, index):
+        '''String from the table of interned strings'''
+        start, end = struct.unpack_from(
+                '<II', self.mm, self.string_offsets + 4 * index)
+        return self.mm[self.strings + start:self.strings + end].decode('utf-8')
+
+    def row_of(self, item_id):
+        '''Row of an id, by binary search in the sorted id column'''
+        low, high = 0, self.nb_rows
+        while low < high:
+            middle = (low + high) // 2
+            if self.integer('id', middle) < item_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.nb_rows and self.integer('id', low) == item_id:
+            return low
+        return None
+
+    def value(self, name, row):
+        kind = self.columns[name][0]
+        value = self.integer(name, row)
+        if kind == 'i':
+            return value
+        return self.decode(kind, value)
+
+    def decode(self, kind, index):
+        '''Value of a string or list column from its string index'''
+        value = self.string(index)
+        if kind == 's':
+            return value
+        return value.split(GENRE_SEPARATOR) if value else []
+
+    def records(self, columns):
+        '''All records by id, read column by column'''
+        values = []
+        for name, kind in columns:
+            column = self.column(name)
+            if kind != 'i':
+                # each interned string is decoded once
+                decoded = {}
+                for index in set(column):
+                    decoded[index] = self.decode(kind, index)
+                column = [decoded[index] for index in column]
+            values.append(column)
+        names = [name for name, kind in columns]
+        return dict(zip(
+            self.column('id'),
+            (dict(zip(names, row)) for row in zip(*values))))
+
+class SnapshotSong(library_records.Tracked, library_records.Song):
+    __slots__ = ('table', 'item_id')
+
+class SnapshotAlbum(library_records.Tracked, library_records.Album):
+    __slots__ = ('table', 'item_id')
+
+class SnapshotTable(object):
+    '''Dict-like access to the songs or albums of a snapshot file'''
+
+    def __init__(self, fname, columns, record_class):
+        self.fname = fname
+        self.columns = columns
+        self.record_class = record_class
+        self.snapshot = Snapshot(fname)
+        # records added or modified since the snapshot was written
+        self.modified = {}
+        self.deleted = set()
+        # all ids sorted, built on first use then kept up to date
+        self.sorted_ids = None
+        # changes not yet in the journal, fields by id, None if removed
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.journal = library_journal.Journal(journal_name(fname))
+        self.compaction = None
+        # ids changed while a compaction is running
+        self.changed_during_compaction = None
+        # ids of the songs to push to the taste profile
+        self.dirty = set(self.snapshot.dirty or [])
+        if self.snapshot.dirty is None and 'rating_en' in dict(columns):
+            self.dirty = self.scan_dirty()
+        self.replay()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.ids())
+
+    def __contains__(self, item_id):
+        if item_id in self.modified:
+            return True
+        return (item_id not in self.deleted
+                and self.snapshot.row_of(item_id) is not None)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, item_id):
+        if item_id in self.modified:
+            return self.modified[item_id]
+        row = None
+        snapshot = self.snapshot
+        if item_id not in self.deleted:
+            row = snapshot.row_of(item_id)
+        if row is None:
+            raise KeyError(item_id)
+        record = self.new_record(item_id)
+        for name, kind in self.columns:
+            # not reported as a modification
+            library_records.Record.__setitem__(
+                    record, name, snapshot.value(name, row))
+        return record
+
+    def __setitem__(self, item_id, record):
+        # a record of the table, so its next modifications are tracked
+        tracked = self.new_record(item_id)
+        fields = dict(record.items())
+        for name, value in fields.items():
+            library_records.Record.__setitem__(tracked, name, value)
+        with self.lock:
+            self.deleted.discard(item_id)
+            self.modified[item_id] = tracked
+            self.pending[item_id] = fields
+            self.add_id(item_id)
+            self.mark_changed(item_id)
+            self.update_dirty(item_id, tracked)
+
+    def __delitem__(self, item_id):
+        if item_id not in self:
+            raise KeyError(item_id)
+        with self.lock:
+            self.modified.pop(item_id, None)
+            self.deleted.add(item_id)
+            self.pending[item_id] = None
+            self.remove_id(item_id)
+            self.mark_changed(item_id)
+            self.dirty.discard(item_id)
+
+    def new_record(self, item_id):
+        '''Empty record of the table'''
+        record = self.record_class.__new__(self.record_class)
+        record.table = self
+        record.item_id = item_id
+        return record
+
+    def record_changed(self, item_id, record, key, value):
+        '''Called by the records when a field is modified'''
+        with self.lock:
+            self.modified[item_id] = record
+            fields = self.pending.get(item_id)
+            if fields is None:
+                fields = self.pending[item_id] = {}
+            fields[key] = value
+            self.mark_changed(item_id)
+            self.update_dirty(item_id, record)
+
+    def ids(self):
+        '''All ids sorted, lock is held'''
+        if self.sorted_ids is None:
+            ids = set(self.snapshot.column('id'))
+            ids.update(self.modified)
+            ids.difference_update(self.deleted)
+            self.sorted_ids = sorted(ids)
+        return self.sorted_ids
+
+    def add_id(self, item_id):
+        ids = self.sorted_ids
+        if ids is None:
+            return
+        index = bisect.bisect_left(ids, item_id)
+        if index == len(ids) or ids[index] != item_id:
+            ids.insert(index, item_id)
+
+    def remove_id(self, item_id):
+        ids = self.sorted_ids
+        if ids is None:
+            return
+        index = bisect.bisect_left(ids, item_id)
+        if index < len(ids) and ids[index] == item_id:
+            del ids[index]
+
+    def mark_changed(self, item_id):
+        if self.changed_during_compaction is not None:
+            self.changed_during_compaction.add(item_id)
+
+    def update_dirty(self, item_id, record):
+        if library_records.profile_changed(record):
+            self.dirty.add(item_id)
+        else:
+            self.dirty.discard(item_id)
+
+    def scan_dirty(self):
+        '''Songs to push to the taste profile, for the previous snapshots'''
+        values = [self.column_values(name)
+                for fields in library_records.PROFILE_FIELDS
+                for name in fields]
+        rating, rating_en, playcount, playcount_en = values
+        return set(item_id for item_id in rating
+                if rating[item_id] != rating_en[item_id]
+                or playcount[item_id] != playcount_en[item_id])
+
+    def replay(self):
+        '''Apply the changes of the journal made after the snapshot'''
+        for item_id, fields in self.journal.entries():
+            if fields is None:
+                self.modified.pop(item_id, None)
+                self.deleted.add(item_id)
+                self.dirty.discard(item_id)
+                continue
+            if item_id in self.modified:
+                record = self.modified[item_id]
+            elif item_id in self:
+                record = self[item_id]
+            else:
+                record = self.new_record(item_id)
+            for name, value in fields.items():
+                library_records.Record.__setitem__(record, name, value)
+            self.deleted.discard(item_id)
+            self.modified[item_id] = record
+            self.update_dirty(item_id, record)
+        logger.debug('%i journal entries replayed for %s',
+                self.journal.nb_entries, self.fname)
+
+    def column_values(self, name):
+        '''Values of a field by id, read column by column'''
+        kind = dict(self.columns)[name]
+        snapshot = self.snapshot
+        values = dict(zip(snapshot.column('id'), snapshot.column(name)))
+        if kind != 'i':
+            decoded = {}
+            for index in set(values.values()):
+                decoded[index] = snapshot.decode(kind, index)
+            values = dict(
+                    (item_id, decoded[index])
+                    for item_id, index in values.items())
+        for item_id in self.deleted:
+            values.pop(item_id, None)
+        for item_id, record in self.modified.items():
+            values[item_id] = record.get(name)
+        return values
+
+    def keys(self):
+        '''All ids, sorted'''
+        with self.lock:
+            return list(self.ids())
+
+    def items(self):
+        return [(item_id, self[item_id]) for item_id in self.keys()]
+
+    def flush(self):
+        '''Append the modifications to the journal'''
+        with self.lock:
+            entries = list(self.pending.items())
+            self.pending = {}
+            self.journal.append(entries)
+            compact = (self.journal.nb_entries >= JOURNAL_MAX_ENTRIES
+                    and self.compaction is None)
+            if compact:
+                self.compaction = threading.Thread(target=self.compact)
+                self.compaction.daemon = True
+        if compact:
+            logger.info('compaction of %s in the background', self.fname)
+            self.compaction.start()
+
+    def compact(self):
+        '''Write a new snapshot with the modifications, empty the journal'''
+        logger.debug('call compact for %s', self.fname)
+        with self.lock:
+            # the changes made from now on go to a new journal
+            self.journal.rotate()
+            modified = dict(
+                    (item_id, dict(record.items()))
+                    for item_id, record in self.modified.items())
+            deleted = set(self.deleted)
+            self.changed_during_compaction = set()
+        # the snapshot file is only replaced by the compaction
+        items = self.snapshot.records(self.columns)
+        for item_id in deleted:
+            items.pop(item_id, None)
+        items.update(modified)
+        write_snapshot(self.fname, items, self.columns)
+        snapshot = Snapshot(self.fname)
+        with self.lock:
+            changed = self.changed_during_compaction
+            self.snapshot = snapshot
+            # the old snapshot is closed when no record reads it anymore
+            for item_id in list(self.modified):
+                if item_id not in changed:
+                    del self.modified[item_id]
+            self.deleted.intersection_update(changed)
+            self.changed_during_compaction = None
+            self.journal.drop_rotated()
+            self.compaction = None
+        logger.info('compaction of %s done', self.fname)
+
+    def wait_compaction(self):
+        '''Wait for the end of a background compaction'''
+        compaction = self.compaction
+        if compaction is not None:
+            compaction.join()
+
+def journal_name(fname):
+    '''Journal of the changes made after a snapshot'''
+    return fname + '.journal'
+
+def create_snapshot(fname, items, columns):
+    '''Write a complete snapshot, the previous journal is obsolete'''
+    write_snapshot(fname, items, columns)
+    library_journal.Journal(journal_name(fname)).clear()
@@ -10,17 +10,24 @@ Kodi remote controller based on HTTP/TCP transport, JSON and using the (cmd) int
 '''
 
 import kodi_api
+import kodi_async
 import en_api
 import fancy_disp
+import library_db
+import library_snapshot
+import library_records
+import library_index
+import library_recommend
+import api_stats
 
-import socket
-import requests
 import json
 #from datetime import timedelta
-from progressbar import *
 import pickle
-import time
 import random
+import threading
+import Queue
+import time
+import functools
 import cmd
 import logging
 import argparse
@@ -29,14 +36,44 @@ from sys import exit
 logger = logging.getLogger(__name__)
 
 # global constants
-BUFFER_SIZE = 1024
 DISPLAY_NB_LINES = 10
 PROFILE_NAME = 'Kodi library'
 ALBUM = 'albumid'
 SONG = 'songid'
+SONGS_PAGE_SIZE = 20
+ALBUMS_PAGE_SIZE = 10
+SONGS_FILE = 'songs.snapshot'
+ALBUMS_FILE = 'albums.snapshot'
+PAGE_SIZES_FILE = 'pages.pickle'
+LIBRARY_STATE_FILE = 'library.pickle'
+REFRESH_PAGE_SIZE = 100
+SORT_NEWEST = {"method": "dateadded", "order": "descending"}
+SORT_LAST_PLAYED = {"method": "lastplayed", "order": "descending"}
+SYNC_STATE_FILE = 'sync.pickle'
+PROFILE_IDS_FILE = 'profiles.pickle'
+EN_UPLOAD_SIZE = 30
+EN_UPLOAD_WORKERS = 4
+FEED_CHUNK_SIZE = 20
+LIBRARY_WAIT_DELAY = 1
+SONG_PROPERTIES = [
+        "title",
+        "artist",
+        "year",
+        "rating",
+        "playcount",
+        "musicbrainztrackid",
+        "genre"
+        ]
+ALBUM_PROPERTIES = [
+        "title",
+        "artist",
+        "year"
+        ]
 
 #TODO: add instrospect
-#TODO: display number of transactions calls in echonest API
+
+# taste profile IDs by API key, also saved to PROFILE_IDS_FILE
+profile_ids = {}
 
 # utility functions
 
@@ -59,8 +96,21 @@ def get_pykodi_params():
     parser.add_argument("-v", "--verbosity",
             action="count",
             help='Increase output verbosity')
+    parser.add_argument("-ps", "--pool-size",
+            type=int,
+            default=kodi_api.HTTP_POOL_SIZE,
+            help='Number of keep-alive connections for HTTP transport')
+    parser.add_argument("-db", "--database",
+            help='Store the library in this SQLite file')
     parser.add_argument("-enk", "--echonest-key",
             help='Echonest API key')
+    parser.add_argument("-enr", "--echonest-rate",
+            type=int,
+            default=en_api.CALLS_PER_MINUTE,
+            help='Echonest calls by minute allowed for the key')
+    parser.add_argument("-st", "--stats-file",
+            help='Write the statistics of the API calls to this JSON file '
+                'on exit')
     parser.add_argument("-c", "--command",
             default=0,
             help='Execute command and quit.')
@@ -71,15 +121,25 @@ def get_pykodi_params():
     server_params['port'] = args.port
     server_params['user'] = args.user
     server_params['password'] = args.password
+    server_params['pool_size'] = args.pool_size
+    server_params['database'] = args.database
+    server_params['stats_file'] = args.stats_file
     if args.verbosity == 2:
         logging.basicConfig(level=logging.DEBUG)
     else:
         if args.verbosity == 1:
             logging.basicConfig(level=logging.INFO)
+    en_api.set_calls_per_minute(args.echonest_rate)
     logger.info('Kodi controller started in verbosity mode ...')
     logger.debug('... and even in high verbosity mode!')
     return server_params, args.echonest_key, args.command
 
+def save_api_stats(server_params):
+    '''Write the statistics of the API calls if asked'''
+    if server_params.get('stats_file'):
+        logger.info('API statistics saved to %s', server_params['stats_file'])
+        api_stats.dump(server_params['stats_file'])
+
 # local files
 
 def is_file(fname):
@@ -95,51 +155,247 @@ def is_library_files():
     '''Check if there are library local files'''
     logger.debug('call function is_library_files')
     ret = True
-    ret = ret and is_file('albums.pickle')
-    ret = ret and is_file('songs.pickle')
+    ret = ret and is_file(ALBUMS_FILE)
+    ret = ret and is_file(SONGS_FILE)
+    if not ret and is_pickle_files():
+        convert_pickle_files()
+        ret = True
     logger.info('library files check: %s', ret)
     return ret
 
+def is_pickle_files():
+    '''Check if there are library local files of the previous versions'''
+    return is_file('albums.pickle') and is_file('songs.pickle')
+
+def convert_pickle_files():
+    '''Convert library pickle files to snapshots'''
+    logger.info('convert the pickle files to snapshots')
+    for fname, snapshot_fname, columns in (
+            ('songs.pickle', SONGS_FILE, library_snapshot.SONG_COLUMNS),
+            ('albums.pickle', ALBUMS_FILE, library_snapshot.ALBUM_COLUMNS)):
+        f = open(fname, 'rb')
+        items = pickle.load(f)
+        f.close()
+        library_snapshot.create_snapshot(snapshot_fname, items, columns)
+
 def get_audio_library(obj):
     '''Manage lists for audio library, from a local file or the server'''
     logger.debug('call function get_audio_library')
     logger.debug('load albums library in memory')
-    if is_library_files():
-        get_audio_library_from_files(obj)
-    else:
+    if obj.kodi_params.get('database'):
+        get_audio_library_from_db(obj)
+        # the database indexes are used for the searches
+        return
+    if not is_library_files():
+        get_audio_library_from_server(obj)
+    # the later changes are appended to the journal of the snapshots
+    get_audio_library_from_files(obj)
+    build_search_indexes(obj)
+
+def build_search_indexes(obj):
+    '''Indexes of the titles, artists and genres, built on the first search'''
+    logger.debug('call function build_search_indexes')
+    obj.songs_index = library_index.build_text_index(obj.songs)
+    obj.albums_index = library_index.build_text_index(obj.albums)
+    obj.genres_index = library_index.build_genre_index(obj.songs)
+
+def get_recommender(obj):
+    '''Return the recommender of the library, build it if needed'''
+    if obj.recommender is None:
+        start = time.time()
+        obj.recommender = library_recommend.build_recommender(obj.songs)
+        logger.info('recommender built in %.3f s', time.time() - start)
+    return obj.recommender
+
+def update_search_index(index, items, added_ids, removed_ids):
+    '''Report library changes to a search index'''
+    if index is None:
+        return
+    for item_id in removed_ids:
+        index.remove(item_id)
+    for item_id in added_ids:
+        index.add(item_id, items[item_id])
+
+def load_page_size(server_params, name, default):
+    '''Page size chosen for the server during the last download'''
+    logger.debug('call function load_page_size')
+    if not is_file(PAGE_SIZES_FILE):
+        return default
+    f = open(PAGE_SIZES_FILE, 'rb')
+    page_sizes = pickle.load(f)
+    f.close()
+    return page_sizes.get(
+            (server_params['ip'], server_params['port'], name), default)
+
+def save_page_size(server_params, name, page_size):
+    '''Remember the page size chosen for the server'''
+    logger.debug('call function save_page_size')
+    page_sizes = {}
+    if is_file(PAGE_SIZES_FILE):
+        f = open(PAGE_SIZES_FILE, 'rb')
+        page_sizes = pickle.load(f)
+        f.close()
+    page_sizes[(server_params['ip'], server_params['port'], name)] = page_size
+    f = open(PAGE_SIZES_FILE, 'wb')
+    pickle.dump(page_sizes, f)
+    f.close()
+
+def get_audio_library_from_db(obj):
+    '''Open the library in the SQLite store, fill it from the server'''
+    logger.debug('call function get_audio_library_from_db')
+    conn = library_db.open_db(obj.kodi_params['database'])
+    obj.songs = library_db.DbTable(conn, 'songs')
+    obj.albums = library_db.DbTable(conn, 'albums')
+    obj.nb_songs = len(obj.songs)
+    obj.nb_albums = len(obj.albums)
+    if obj.nb_songs == 0:
         get_audio_library_from_server(obj)
 
 def save_songs(songs):
     '''Save songs to local files'''
     logger.debug('call function save_songs')
-    f = open('songs.pickle', 'wb')
-    pickle.dump(songs, f)
-    f.close()
+    if isinstance(songs, (library_db.DbTable, library_snapshot.SnapshotTable)):
+        songs.flush()
+        return
+    library_snapshot.create_snapshot(
+            SONGS_FILE, songs, library_snapshot.SONG_COLUMNS)
 
 def save_albums(albums):
     '''Save albums to local files'''
     logger.debug('call function save_albums')
-    f = open('albums.pickle', 'wb')
-    pickle.dump(albums, f)
+    if isinstance(albums, (library_db.DbTable, library_snapshot.SnapshotTable)):
+        albums.flush()
+        return
+    library_snapshot.create_snapshot(
+            ALBUMS_FILE, albums, library_snapshot.ALBUM_COLUMNS)
+
+def load_library_state():
+    '''Load the state of the server library at the last update'''
+    logger.debug('call function load_library_state')
+    if not is_file(LIBRARY_STATE_FILE):
+        return {}
+    f = open(LIBRARY_STATE_FILE, 'rb')
+    state = pickle.load(f)
+    f.close()
+    return state
+
+def save_library_state(state):
+    '''Save the state of the server library'''
+    logger.debug('call function save_library_state')
+    f = open(LIBRARY_STATE_FILE, 'wb')
+    pickle.dump(state, f)
+    f.close()
+
+def load_sync_state():
+    '''Load the high-water mark of the last songs sync'''
+    logger.debug('call function load_sync_state')
+    if not is_file(SYNC_STATE_FILE):
+        return {}
+    f = open(SYNC_STATE_FILE, 'rb')
+    state = pickle.load(f)
+    f.close()
+    return state
+
+def save_sync_state(state):
+    '''Save the high-water mark of the songs sync'''
+    logger.debug('call function save_sync_state')
+    f = open(SYNC_STATE_FILE, 'wb')
+    pickle.dump(state, f)
     f.close()
 
 def get_audio_library_from_files(obj):
     '''Load the library in memory from local files'''
     logger.debug('call function get_audio_library_from_files')
-    f = open('songs.pickle', 'rb')
-    obj.songs = pickle.load(f)
-    f.close()
+    obj.songs = library_snapshot.SnapshotTable(
+            SONGS_FILE, library_snapshot.SONG_COLUMNS,
+            library_snapshot.SnapshotSong)
     obj.nb_songs = len(obj.songs)
-    f = open('albums.pickle', 'rb')
-    obj.albums = pickle.load(f)
-    f.close()
+    obj.albums = library_snapshot.SnapshotTable(
+            ALBUMS_FILE, library_snapshot.ALBUM_COLUMNS,
+            library_snapshot.SnapshotAlbum)
     obj.nb_albums = len(obj.albums)
 
+def song_record(song):
+    '''Local library entry of a song returned by the server'''
+    record = library_records.Song()
+    record['title'] = song['title']
+    record['artist'] = u''
+    if song['artist']:
+        record['artist'] = song['artist'][0]
+    record['year'] = song['year']
+    record['rating'] = song['rating']
+    record['playcount'] = song['playcount']
+    record['musicbrainztrackid'] = song['musicbrainztrackid']
+    record['genre'] = song['genre']
+    # store the last update to echonest profile
+    record['rating_en'] = 0
+    record['playcount_en'] = 0
+    return record
+
+def album_record(album):
+    '''Local library entry of an album returned by the server'''
+    record = library_records.Album()
+    record['title'] = album['title']
+    record['artist'] = album['artist'][0]
+    record['year'] = album['year']
+    return record
+
+def library_progress_bar(label, total):
+    '''Progress bar for a library download'''
+    # imported on demand, for a fast start-up
+    from progressbar import ProgressBar, Percentage, Bar, Counter, ETA
+    widgets = [
+        label + ': ', Percentage(),
+        ' ', Bar(marker='#',left='[',right=']'),
+        ' (', Counter(), ' in ' + str(total) + ') ',
+        ETA()]
+    return ProgressBar(widgets=widgets, maxval=total)
+
+def fetch_library_pages(server_params, label, page_command, key, total,
+        page_name, page_size, merge, progress=None):
+    '''Download pages concurrently with a progress bar and throughput
+
+    The background loader gives a progress dict, displayed by the commands
+    waiting for the library: nothing is printed over the prompt. Raise
+    IOError if a page cannot be downloaded, the pages already received
+    have been merged.
+    '''
+    client = kodi_async.kodi_client(server_params)
+    pager = kodi_async.AdaptivePager(
+            total, load_page_size(server_params, page_name, page_size))
+    pbar = None
+    if progress is None:
+        progress = {}
+        pbar = library_progress_bar(label, total)
+        pbar.start()
+    progress.update({'label': label, 'done': 0, 'total': total})
+    def merge_page(items):
+        merge(items)
+        progress['done'] += len(items)
+        if pbar is not None:
+            pbar.update(min(progress['done'], total))
+    try:
+        nb_items, elapsed = kodi_async.fetch_pages(
+                client, page_command, key, pager, merge_page)
+    except IOError:
+        if pbar is not None:
+            pbar.finish()
+        raise
+    save_page_size(server_params, page_name, pager.page_size)
+    throughput = "%i %s in %.1f s (%.0f %s/s)" % (
+            nb_items, key, elapsed, nb_items / max(elapsed, 0.001), key)
+    if pbar is not None:
+        pbar.finish()
+        print throughput
+    else:
+        logger.info(throughput)
+    return nb_items
+
 def get_audio_library_from_server(obj):
     '''Load the library in memory from the Kodi server'''
     logger.debug('get_audio_library_from_server')
-    print "Loading the Kodi server library, this may be very long"
-    print
+    # in the loader thread, the progress is displayed by wait_library
+    logger.info('loading the Kodi server library, this may be very long')
     # Loading songs
     songs_dummy = kodi_api.audiolibrary_get_songs(obj.kodi_params, 0, 1)
     nb_songs = songs_dummy['limits']['total']
@@ -148,103 +404,211 @@ def get_audio_library_from_server(obj):
         logger.critical("Library seems to be empty.")
         exit()
     obj.nb_songs = nb_songs
-    widgets = [
-        'Songs: ', Percentage(),
-        ' ', Bar(marker='#',left='[',right=']'),
-        ' (', Counter(), ' in ' + str(nb_songs) + ') ',
-        ETA()]
-    pbar = ProgressBar(widgets=widgets, maxval=nb_songs)
-    pbar.start()
-    limits = range(0, nb_songs, 20)
-    if not limits[-1] == nb_songs:
-        limits.append(nb_songs)
-    for start, end in zip(limits[:-1], limits[1:]):
-        logger.info('Processing song %i to %i ...', start, end)
-        pbar.update(start)
-        while True:
-            try:
-                #TODO: use an API function
-                command = {"jsonrpc": "2.0",
-                        "method": "AudioLibrary.GetSongs",
-                         "params": {
-                            "properties": [
-                                "title", 
-                                "artist", 
-                                "year",
-                                "rating",
-                                "playcount",
-                                "musicbrainztrackid",
-                                "genre"
-                                ],
-                            "limits": { 
-                                "start": start, 
-                                "end": end } },
-                        "id": 1}
-                ret = kodi_api.call_api(obj.kodi_params, command)
-                for song in ret['result']['songs']:
-                    obj.songs[song['songid']] = {}
-                    obj.songs[song['songid']]['title'] = song['title']
-                    if song['artist']:
-                        obj.songs[song['songid']]['artist'] = song['artist'][0]
-                    obj.songs[song['songid']]['year'] = song['year']
-                    obj.songs[song['songid']]['rating'] = song['rating']
-                    obj.songs[song['songid']]['playcount'] = song['playcount']
-                    obj.songs[song['songid']][
-                            'musicbrainztrackid'] = song['musicbrainztrackid']
-                    obj.songs[song['songid']]['genre'] = song['genre']
-                    # store the last update to echonest profile
-                    obj.songs[song['songid']]['rating_en'] = 0
-                    obj.songs[song['songid']]['playcount_en'] = 0
-                break
-            except KeyError:
-                #TODO: improve error catching, limit to API errors
-                logger.info('error when loading library, retry')
-    pbar.finish()
+    def merge_songs(songs):
+        for song in songs:
+            obj.songs[song['songid']] = song_record(song)
+    fetch_library_pages(
+            obj.kodi_params, 'Songs',
+            lambda start, end: kodi_api.audiolibrary_get_songs_command(
+                SONG_PROPERTIES, start, end),
+            'songs', nb_songs, 'songs', SONGS_PAGE_SIZE, merge_songs,
+            obj.library_progress)
     save_songs(obj.songs)
     # Loading albums
     albums_dummy = kodi_api.audiolibrary_get_albums(obj.kodi_params, 0, 1)
     nb_albums = albums_dummy['limits']['total']
     logger.debug('number of albums: %i', nb_albums)
     obj.nb_albums = nb_albums
-    widgets = [
-        'Albums: ', Percentage(),
-        ' ', Bar(marker='#',left='[',right=']'),
-        ' (', Counter(), ' in ' + str(nb_albums) + ') ',
-        ETA()]
-    pbar = ProgressBar(widgets=widgets, maxval=nb_albums)
-    pbar.start()
-    limits = range(0, nb_albums, 10)
-    if not limits[-1] == nb_albums:
-        limits.append(nb_albums)
-    for start, end in zip(limits[:-1], limits[1:]):
-        logger.info('Processing album %i to %i ...', start, end)
-        pbar.update(start)
-        while True:
-            try:
-                #TODO: use an API function
-                command = {"jsonrpc": "2.0",
-                        "method": "AudioLibrary.GetAlbums",
-                         "params": {
-                            "properties": [
-                                "title", 
-                                "artist", 
-                                "year"],
-                            "limits": { 
-                                "start": start, 
-                                "end": end } },
-                        "id": 1}
-                ret = kodi_api.call_api(obj.kodi_params, command)
-                for album in ret['result']['albums']:
-                    obj.albums[album['albumid']] = {}
-                    obj.albums[album['albumid']]['title'] = album['title']
-                    obj.albums[album['albumid']]['artist'] = album['artist'][0]
-                    obj.albums[album['albumid']]['year'] = album['year']
-                break
-            except KeyError:
-                logger.info('error when loading library, retry')
-    pbar.finish()
+    def merge_albums(albums):
+        for album in albums:
+            obj.albums[album['albumid']] = album_record(album)
+    fetch_library_pages(
+            obj.kodi_params, 'Albums',
+            lambda start, end: kodi_api.audiolibrary_get_albums_command(
+                ALBUM_PROPERTIES, start, end),
+            'albums', nb_albums, 'albums', ALBUMS_PAGE_SIZE, merge_albums,
+            obj.library_progress)
     save_albums(obj.albums)
-    print
+    try:
+        save_library_state(get_library_state(obj.kodi_params))
+    except IOError as e:
+        # the library is complete, the next refresh downloads it again
+        logger.warning('%s', e)
+
+def get_library_state(server_params):
+    '''Update markers and number of items of the server library'''
+    logger.debug('call function get_library_state')
+    batch = kodi_api.Batch(server_params)
+    properties_id = batch.add(kodi_api.audiolibrary_get_properties_command())
+    modified_id = batch.add(kodi_api.audiolibrary_get_modified_command())
+    songs_id = batch.add(kodi_api.audiolibrary_get_songs_command([], 0, 1))
+    albums_id = batch.add(kodi_api.audiolibrary_get_albums_command([], 0, 1))
+    rets = batch.send()
+    for ret in (rets[songs_id], rets[albums_id]):
+        if 'error' in ret:
+            raise IOError('library state not available: %s'
+                    % ret['error']['message'])
+    # the markers are not available before Kodi 18
+    state = dict(rets[properties_id].get('result', {}))
+    # and the modification markers before Kodi 19
+    state.update(rets[modified_id].get('result', {}))
+    state['nb_songs'] = rets[songs_id]['result']['limits']['total']
+    state['nb_albums'] = rets[albums_id]['result']['limits']['total']
+    logger.debug('library state: %s', state)
+    return state
+
+def get_new_items(server_params, page_command, key, id_key, items, record):
+    '''Add the items added on the server since the last update'''
+    logger.debug('call function get_new_items for %s', key)
+    new_ids = []
+    start = 0
+    while True:
+        ret = kodi_api.call_api(
+                server_params,
+                page_command(start, start + REFRESH_PAGE_SIZE))
+        kodi_api.display_result(ret)
+        page = ret.get('result', {}).get(key, [])
+        nb_page_new = 0
+        for item in page:
+            if item[id_key] not in items:
+                items[item[id_key]] = record(item)
+                new_ids.append(item[id_key])
+                nb_page_new += 1
+        # newest first, stop at the first page already known
+        if nb_page_new == 0 or len(page) < REFRESH_PAGE_SIZE:
+            break
+        start += REFRESH_PAGE_SIZE
+    return new_ids
+
+def get_modified_items(server_params, page_command, key, id_key, items,
+        record, since):
+    '''Update the items modified on the server since the date
+
+    The new items are left to get_new_items. The values pushed to the taste
+    profile are kept, they are not known by the server.
+    '''
+    logger.debug('call function get_modified_items for %s', key)
+    rule = {'field': 'datemodified', 'operator': 'after', 'value': since}
+    modified_ids = []
+    start = 0
+    while True:
+        ret = kodi_api.call_api(
+                server_params,
+                page_command(start, start + REFRESH_PAGE_SIZE, rule))
+        if 'error' in ret:
+            logger.warning('modified %s not available: %s',
+                    key, ret['error']['message'])
+            break
+        page = ret['result'].get(key, [])
+        for item in page:
+            item_id = item[id_key]
+            if item_id not in items:
+                continue
+            old = items[item_id]
+            new = record(item)
+            for field, pushed_field in library_records.PROFILE_FIELDS:
+                if pushed_field in old:
+                    new[pushed_field] = old[pushed_field]
+            items[item_id] = new
+            modified_ids.append(item_id)
+        if len(page) < REFRESH_PAGE_SIZE:
+            break
+        start += REFRESH_PAGE_SIZE
+    return modified_ids
+
+def get_removed_items(server_params, label, page_command, key, id_key,
+        items, total):
+    '''Remove the items not in the server library anymore'''
+    logger.debug('call function get_removed_items for %s', key)
+    server_ids = set()
+    def merge_ids(page):
+        server_ids.update(item[id_key] for item in page)
+    fetch_library_pages(
+            server_params, label, page_command, key, total,
+            key + '_ids', REFRESH_PAGE_SIZE, merge_ids)
+    removed_ids = [item_id for item_id in items if item_id not in server_ids]
+    for item_id in removed_ids:
+        del items[item_id]
+    return removed_ids
+
+def refresh_audio_library(obj):
+    '''Update the local library with the changes of the server library'''
+    logger.debug('call function refresh_audio_library')
+    old_state = load_library_state()
+    state = get_library_state(obj.kodi_params)
+    markers = ('librarylastupdated', 'songslastadded', 'albumslastadded',
+            'songsmodified', 'albumsmodified')
+    if (all(old_state.get(m) == state.get(m) for m in markers)
+            and state.get('librarylastupdated')
+            and state['nb_songs'] == len(obj.songs)
+            and state['nb_albums'] == len(obj.albums)):
+        logger.info('library not modified since the last update')
+        return (0, 0, 0, 0, 0, 0)
+    if 'songsmodified' not in state:
+        logger.info('the modified songs and albums are not reported by '
+                'this server, Kodi 19 or later is needed')
+    new_songs, removed_songs, new_albums, removed_albums = [], [], [], []
+    modified_songs, modified_albums = [], []
+    try:
+        # before the new items, which are reported as modified too
+        since = old_state.get('songsmodified')
+        if since and state.get('songsmodified') != since:
+            modified_songs.extend(get_modified_items(
+                    obj.kodi_params,
+                    lambda start, end, rule:
+                        kodi_api.audiolibrary_get_songs_command(
+                            SONG_PROPERTIES, start, end, filter_rule=rule),
+                    'songs', 'songid', obj.songs, song_record, since))
+        since = old_state.get('albumsmodified')
+        if since and state.get('albumsmodified') != since:
+            modified_albums.extend(get_modified_items(
+                    obj.kodi_params,
+                    lambda start, end, rule:
+                        kodi_api.audiolibrary_get_albums_command(
+                            ALBUM_PROPERTIES, start, end, filter_rule=rule),
+                    'albums', 'albumid', obj.albums, album_record, since))
+        new_songs.extend(get_new_items(
+                obj.kodi_params,
+                lambda start, end: kodi_api.audiolibrary_get_songs_command(
+                    SONG_PROPERTIES, start, end, SORT_NEWEST),
+                'songs', 'songid', obj.songs, song_record))
+        if state['nb_songs'] != len(obj.songs):
+            removed_songs.extend(get_removed_items(
+                    obj.kodi_params, 'Songs',
+                    lambda start, end: kodi_api.audiolibrary_get_songs_command(
+                        [], start, end),
+                    'songs', 'songid', obj.songs, state['nb_songs']))
+        new_albums.extend(get_new_items(
+                obj.kodi_params,
+                lambda start, end: kodi_api.audiolibrary_get_albums_command(
+                    ALBUM_PROPERTIES, start, end, SORT_NEWEST),
+                'albums', 'albumid', obj.albums, album_record))
+        if state['nb_albums'] != len(obj.albums):
+            removed_albums.extend(get_removed_items(
+                    obj.kodi_params, 'Albums',
+                    lambda start, end:
+                        kodi_api.audiolibrary_get_albums_command(
+                            [], start, end),
+                    'albums', 'albumid', obj.albums, state['nb_albums']))
+    finally:
+        # the changes received before a failure are kept, the library state
+        # is not saved so the next refresh looks for the others
+        if new_songs or removed_songs or modified_songs:
+            save_songs(obj.songs)
+        if new_albums or removed_albums or modified_albums:
+            save_albums(obj.albums)
+        # the modified items are indexed again
+        update_search_index(obj.songs_index, obj.songs,
+                new_songs + modified_songs, removed_songs)
+        update_search_index(obj.genres_index, obj.songs,
+                new_songs + modified_songs, removed_songs)
+        update_search_index(obj.albums_index, obj.albums,
+                new_albums + modified_albums, removed_albums)
+        obj.nb_songs = len(obj.songs)
+        obj.nb_albums = len(obj.albums)
+    save_library_state(state)
+    return (len(new_songs), len(removed_songs), len(modified_songs),
+            len(new_albums), len(removed_albums), len(modified_albums))
 
 # parsers
 
@@ -283,8 +647,12 @@ def parse_get_string(line):
 
 # other
 
-def get_albums_search(search_string, albums):
+def get_albums_search(search_string, albums, index=None):
     '''Internal album indexes for a string search'''
+    if isinstance(albums, library_db.DbTable):
+        return library_db.search_titles(albums, search_string)
+    if index is not None:
+        return index.search(search_string)
     search_result_title = []
     search_result_artist = []
     for album_id in albums.keys():
@@ -296,8 +664,12 @@ def get_albums_search(search_string, albums):
     logger.debug('search result by artist: %s', search_result_artist)
     return sorted(list(set(search_result_title + search_result_artist)))
 
-def get_songs_search(search_string, songs):
+def get_songs_search(search_string, songs, index=None):
     '''Internal song indexes for a string search'''
+    if isinstance(songs, library_db.DbTable):
+        return library_db.search_titles(songs, search_string)
+    if index is not None:
+        return index.search(search_string)
     search_result_title = []
     search_result_artist = []
     for song_id in songs.keys():
@@ -309,8 +681,12 @@ def get_songs_search(search_string, songs):
     logger.debug('search result by artist: %s', search_result_artist)
     return sorted(list(set(search_result_title + search_result_artist)))
 
-def get_genre_search(search_string, songs):
+def get_genre_search(search_string, songs, index=None):
     '''Internal song indexes for a string search'''
+    if isinstance(songs, library_db.DbTable):
+        return library_db.search_genre(songs, search_string)
+    if index is not None:
+        return index.search(search_string)
     search_result_genre = []
     for song_id in songs.keys():
         for genre in songs[song_id]['genre']:
@@ -319,70 +695,92 @@ def get_genre_search(search_string, songs):
     logger.debug('search result by genre: %s', search_result_genre)
     return sorted(list(search_result_genre))
 
-def set_songs_sync(server_params, songs):
+def merge_songs_sync(songs, r_songs, counters):
+    '''Update the rating and playcount of the songs returned by the server'''
+    for r_song in r_songs:
+        if r_song['songid'] not in songs:
+            logger.info('unknown song %s, skipped', r_song['songid'])
+            continue
+        song = songs[r_song['songid']]
+        for field in ('rating', 'playcount'):
+            if song[field] != r_song[field]:
+                logger.info(
+                        'updating %s for %s!', field, r_song['songid'])
+                song[field] = r_song[field]
+                counters[field] += 1
+
+def get_last_played(server_params, start, end):
+    '''Rating and playcount of the songs, the last played first'''
+    ret = kodi_api.call_api(
+            server_params,
+            kodi_api.audiolibrary_get_songs_command(
+                ['rating', 'playcount', 'lastplayed'], start, end,
+                SORT_LAST_PLAYED))
+    kodi_api.display_result(ret)
+    return ret.get('result', {}).get('songs', [])
+
+def set_songs_sync_full(server_params, songs, counters):
+    '''Download the rating and playcount of all songs'''
+    logger.debug('call set_songs_sync_full')
+    nb_songs = len(songs)
+    logger.debug('number of songs: %i', nb_songs)
+    fetch_library_pages(
+            server_params, 'Songs',
+            lambda start, end: kodi_api.audiolibrary_get_songs_command(
+                ['rating', 'playcount'], start, end),
+            'songs', nb_songs, 'songs_sync', SONGS_PAGE_SIZE,
+            lambda r_songs: merge_songs_sync(songs, r_songs, counters))
+
+def set_songs_sync_played(server_params, songs, counters, last_played):
+    '''Download the songs played since the last sync only'''
+    logger.debug('call set_songs_sync_played since %s', last_played)
+    start = 0
+    while True:
+        r_songs = get_last_played(
+                server_params, start, start + REFRESH_PAGE_SIZE)
+        # songs played at the mark are checked again, it is cheap
+        played = [r_song for r_song in r_songs
+                if r_song['lastplayed'] >= last_played]
+        merge_songs_sync(songs, played, counters)
+        if len(played) < REFRESH_PAGE_SIZE:
+            break
+        start += REFRESH_PAGE_SIZE
+    logger.info('%i page(s) of played songs', start // REFRESH_PAGE_SIZE + 1)
+
+def set_songs_sync(server_params, songs, full=False):
     '''Sync playcount and rating'''
     logger.debug('call set_songs_sync')
+    counters = {'rating': 0, 'playcount': 0}
+    last_played = load_sync_state().get('lastplayed')
+    # the mark is read before the sync, songs played meanwhile are not missed
+    r_songs = get_last_played(server_params, 0, 1)
+    new_last_played = r_songs[0]['lastplayed'] if r_songs else ''
     print
-    print "Updating songs rating and playcount (could be long)"
-    print
-    nb_songs = len(songs)
-    logger.debug('number of songs: %i', nb_songs)
-    widgets = [
-             'Songs: ', Percentage(),
-             ' ', Bar(marker='#',left='[',right=']'),
-             ' (', Counter(), ' in ' + str(nb_songs) + ') ',
-             ETA()]
-    pbar = ProgressBar(widgets=widgets, maxval=nb_songs)
-    pbar.start()
-    limits = range(0, nb_songs, 20)
-    nb_update_rating = 0
-    nb_update_playcount = 0
-    if not limits[-1] == nb_songs:
-        limits.append(nb_songs)
-    for start, end in zip(limits[:-1], limits[1:]):
-        logger.info('Processing song %i to %i ...', start, end)
-        pbar.update(start)
-        while True:
-            #TODO: use an API function
-            try:
-                command = {"jsonrpc": "2.0",
-                        "method": "AudioLibrary.GetSongs",
-                         "params": {
-                            "properties": [
-                                "rating",
-                                "playcount",
-                                ],
-                            "limits": { 
-                                "start": start, 
-                                "end": end } },
-                        "id": 1}
-                ret = kodi_api.call_api(server_params, command)
-                for r_song in ret['result']['songs']:
-                    if songs[r_song['songid']]['rating'] != r_song['rating']:
-                        logger.info(
-                                'updating rating for %s!',
-                                r_song['songid'])
-                        songs[r_song['songid']]['rating'] = r_song['rating']
-                        nb_update_rating += 1
-                    if songs[r_song['songid']]['playcount'] != r_song['playcount']:
-                        logger.info(
-                                'updating playcount for %s!',
-                                r_song['songid'])
-                        songs[r_song['songid']]['playcount'] = r_song['playcount']
-                        nb_update_playcount += 1
-                break
-            except KeyError:
-                logger.info('error when loading library, retry')
-    pbar.finish()
-    save_songs(songs)
+    try:
+        if full or not last_played:
+            print "Updating songs rating and playcount (could be long)"
+            print
+            set_songs_sync_full(server_params, songs, counters)
+        else:
+            print "Updating songs played since %s" % last_played
+            set_songs_sync_played(server_params, songs, counters, last_played)
+    finally:
+        # the songs merged before a failure are kept, the mark is not moved
+        save_songs(songs)
+    save_sync_state({'lastplayed': new_last_played})
     print
-    print "%i song(s) rating updated" % nb_update_rating
-    print "%i song(s) playcount updated" % nb_update_playcount
+    print "%i song(s) rating updated" % counters['rating']
+    print "%i song(s) playcount updated" % counters['playcount']
     print
 
 def get_profile_delta(songs):
     '''Songs id with echonest rating and playcount not up-to-date'''
     logger.debug('call get_profile_delta')
+    if isinstance(songs, library_db.DbTable):
+        return library_db.profile_delta(songs)
+    if isinstance(songs, library_snapshot.SnapshotTable):
+        # maintained by the table on each change
+        return sorted(songs.dirty)
     songs_id_delta = []
     for song_id in songs.keys():
         if not songs[song_id]['rating'] == songs[song_id]['rating_en']:
@@ -393,11 +791,21 @@ def get_profile_delta(songs):
             continue
     return songs_id_delta
 
+def echonest_update_item(song_id, song):
+    '''Tasteprofile update of the rating and playcount of a song'''
+    return {
+        "action": 'update',
+        "item": {
+            "item_id": str(song_id),
+            "song_id": 'musicbrainz:song:' + song['musicbrainztrackid'],
+            "rating": song['rating'] * 2,
+            "play_count": song['playcount']
+            }
+        }
+
 def echonest_sync(api_key, profile_id, songs):
     '''Sync songs with echonest tasteprofile'''
     logger.debug('call echonest_sync')
-    #TODO: cache the profile ID
-    #TODO: create routines for echonest API calls + HTTP Kodi calls
     en_info = en_api.echonest_info(api_key, profile_id)
     if en_info['total'] == 0:
         logger.info("no songs in tasteprofile, full sync")
@@ -411,124 +819,69 @@ def echonest_sync(api_key, profile_id, songs):
     print
     logger.info('delta size: %i', nb_songs_delta)
     logger.debug('delta songs %s', songs_id_delta)
-    widgets = [
-            'Songs: ', Percentage(),
-            ' ', Bar(marker='#',left='[',right=']'),
-            ' (', Counter(), ' in ' + str(nb_songs_delta) + ') ',
-            ETA()]
-    pbar = ProgressBar(widgets=widgets, maxval=nb_songs_delta)
+    # the records are only read and updated by this thread
+    uploads = Queue.Queue()
+    for start in range(0, nb_songs_delta, EN_UPLOAD_SIZE):
+        chunk = songs_id_delta[start:start + EN_UPLOAD_SIZE]
+        uploads.put((chunk, [
+            echonest_update_item(song_id, songs[song_id])
+            for song_id in chunk]))
+    nb_uploads = uploads.qsize()
+    results = Queue.Queue()
+    def upload():
+        while True:
+            try:
+                chunk, items = uploads.get_nowait()
+            except Queue.Empty:
+                return
+            # the rate limiter spaces the calls of all the workers
+            try:
+                ok = en_api.echonest_update(api_key, profile_id, items)
+            except Exception:
+                logger.exception('upload failed')
+                ok = False
+            results.put((chunk, ok))
+    for i in range(min(EN_UPLOAD_WORKERS, nb_uploads)):
+        worker = threading.Thread(target=upload)
+        worker.daemon = True
+        worker.start()
+    pbar = library_progress_bar('Songs', nb_songs_delta)
     pbar.start()
-    # slicing
-    limits = range(0, nb_songs_delta, 30)
-    if not limits[-1] == nb_songs_delta:
-        limits.append(nb_songs_delta)
-    for start, end in zip(limits[:-1], limits[1:]):
-        logger.info('Processing song index from  %i to %i ...', start, end)
-        pbar.update(start)
-        command = []
-        songs_index_slice = range(start, end)
-        for song_index in songs_index_slice:
-            song_id = songs_id_delta[song_index]
-            rating = songs[song_id]['rating'] * 2
-            mb_song_id = 'musicbrainz:song:' + songs[song_id]['musicbrainztrackid']
-            #TODO: use API function
-            command.append({
-                "action": 'update',
-                "item": {
-                    "item_id": str(song_id),
-                    "song_id": mb_song_id,
-                    "rating": rating, 
-                    "play_count": songs[song_id]['playcount']
-                    }
-                })
-
+    nb_done = 0
+    nb_failed = 0
+    for i in range(nb_uploads):
+        chunk, ok = results.get()
+        nb_done += len(chunk)
+        pbar.update(nb_done)
+        if not ok:
+            # still in the delta, pushed by the next sync
+            nb_failed += len(chunk)
+            continue
+        for song_id in chunk:
             songs[song_id]['rating_en'] = songs[song_id]['rating']
             songs[song_id]['playcount_en'] = songs[song_id]['playcount']
-        url = 'http://developer.echonest.com/api/v4/tasteprofile/update'
-        headers = {'content-type': 'multipart/form-data'}
-        payload = {
-                'api_key': api_key,
-                'id': profile_id,
-                'data': json.dumps(command)}
-        logger.debug('command: %s', command)
-        r = requests.post(url, headers=headers, params=payload)
-        if r.status_code == 200:
-            logger.debug('return: %s', r.text)
-        else:
-            logger.error('return: %s', r.text)
-        time.sleep(0.51)
     pbar.finish()
     save_songs(songs)
+    if nb_failed:
+        logger.error('%i song(s) not pushed to the tasteprofile', nb_failed)
     print
 
-def echonest_playlist(api_key, profile_id):
-    '''Create a premium static playlist'''
-    logger.debug('call echonest_playlist')
-    #TODO: split in API function + conversion of namespace
-    print
-    print "Requesting a playlist to echonest ..."
-    url = 'http://developer.echonest.com/api/v4/playlist/static'
-    payload = {"api_key": api_key,
-              "type": 'catalog',
-              "seed_catalog": profile_id,
-              "bucket": 'id:' + profile_id
-              }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
-    ret = r.json()
-    en_songs = ret['response']['songs']
-    playlist = []
-    for en_song in en_songs:
-        en_id = en_song['foreign_ids'][0]['foreign_id']
-        kodi_id = en_id.replace(profile_id + ':song:', "")
-        playlist.append(int(kodi_id))
-    return playlist
-
-def echonest_pl_seed(api_key, profile_id, song_id):
-    '''Create a premium static playlist seeded by a song'''
-    logger.debug('call echonest_pl_song')
-    #TODO: split in API function + conversion of namespace
-    print
-    print "Requesting a playlist to echonest ..."
-    url = 'http://developer.echonest.com/api/v4/playlist/static'
-    en_song_id = profile_id + ':song:' + str(song_id)
-    payload = {"api_key": api_key,
-              "type": 'catalog',
-              "seed_catalog": profile_id,
-              "song_id": en_song_id,
-              "bucket": 'id:' + profile_id
-              }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
-    ret = r.json()
-    en_songs = ret['response']['songs']
-    playlist = []
-    for en_song in en_songs:
-        en_id = en_song['foreign_ids'][0]['foreign_id']
-        kodi_id = en_id.replace(profile_id + ':song:', "")
-        playlist.append(int(kodi_id))
-    return playlist
-
-def get_profile_id(api_key):
-    '''Get echonest profile profile ID'''
+def lookup_profile_id(api_key):
+    '''Get echonest profile profile ID, create the profile if needed'''
     #TODO: split in unit API functions
-    logger.debug('call get_profile_id')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/profile'
+    logger.debug('call lookup_profile_id')
     payload = {
             'api_key': api_key,
             'name': PROFILE_NAME}
-    r = requests.get(url, params=payload)
+    r = en_api.api_call('GET', 'tasteprofile/profile', payload)
     if r.status_code == 400:
         logger.debug('no taste profile found')
-        url = 'http://developer.echonest.com/api/v4/tasteprofile/create'
         headers = {'content-type': 'multipart/form-data'}
         payload = {
                 'api_key': api_key,
                 'name': PROFILE_NAME,
                 'type': 'general'}
-        r = requests.post(url, headers=headers, params=payload)
+        r = en_api.api_call('POST', 'tasteprofile/create', payload, headers)
         ret = r.json()
         profile_id = ret['response']['id']
     else:
@@ -538,34 +891,60 @@ def get_profile_id(api_key):
     logger.debug('return: %s', r.text)
     logger.debug('profile id: %s', profile_id)
     return profile_id
-def get_profile_id(api_key):
-    '''Get echonest profile profile ID'''
-    #TODO: split in unit API functions
+
+def load_profile_ids():
+    '''Load the taste profile IDs by API key'''
+    logger.debug('call function load_profile_ids')
+    if not is_file(PROFILE_IDS_FILE):
+        return {}
+    f = open(PROFILE_IDS_FILE, 'rb')
+    ids = pickle.load(f)
+    f.close()
+    return ids
+
+def save_profile_ids(ids):
+    '''Save the taste profile IDs by API key'''
+    logger.debug('call function save_profile_ids')
+    f = open(PROFILE_IDS_FILE, 'wb')
+    pickle.dump(ids, f)
+    f.close()
+
+def get_profile_id(api_key, refresh=False):
+    '''Get echonest profile profile ID, from the cache if known'''
     logger.debug('call get_profile_id')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/profile'
-    payload = {
-            'api_key': api_key,
-            'name': PROFILE_NAME}
-    r = requests.get(url, params=payload)
-    if r.status_code == 400:
-        logger.debug('no taste profile found')
-        url = 'http://developer.echonest.com/api/v4/tasteprofile/create'
-        headers = {'content-type': 'multipart/form-data'}
-        payload = {
-                'api_key': api_key,
-                'name': PROFILE_NAME,
-                'type': 'general'}
-        r = requests.post(url, headers=headers, params=payload)
-        ret = r.json()
-        profile_id = ret['response']['id']
-    else:
-        logger.debug('taste profile found')
-        ret = r.json()
-        profile_id = ret['response']['catalog']['id'] 
-    logger.debug('return: %s', r.text)
-    logger.debug('profile id: %s', profile_id)
+    if not refresh:
+        if api_key in profile_ids:
+            return profile_ids[api_key]
+        profile_ids.update(load_profile_ids())
+        if api_key in profile_ids:
+            return profile_ids[api_key]
+    profile_id = lookup_profile_id(api_key)
+    profile_ids[api_key] = profile_id
+    ids = load_profile_ids()
+    ids[api_key] = profile_id
+    save_profile_ids(ids)
     return profile_id
 
+def forget_profile_id(api_key):
+    '''Remove the profile ID of the key from the cache'''
+    logger.debug('call forget_profile_id')
+    profile_ids.pop(api_key, None)
+    ids = load_profile_ids()
+    if ids.pop(api_key, None) is not None:
+        save_profile_ids(ids)
+
+def call_with_profile(api_key, function, *args):
+    '''Call an echonest function with the profile ID of the key
+
+    The cached ID is only checked by echonest when it is used: if it is
+    unknown, it is looked up again and the call is made once more.
+    '''
+    try:
+        return function(api_key, get_profile_id(api_key), *args)
+    except en_api.ProfileNotFound:
+        logger.info('taste profile ID unknown, look it up again')
+        return function(api_key, get_profile_id(api_key, True), *args)
+
 def playback(kodi_params):
     '''Start playback'''
     logger.debug('call function playback')
@@ -580,14 +959,117 @@ def playback_stop(kodi_params):
     if kodi_api.player_get_active(kodi_params):
         kodi_api.player_stop(kodi_params)
 
-def populate_playlist(song_ids, kodi_params):
-    '''Create a playlist from an array of song_id'''
+class PlaylistFeeder(object):
+    '''Add songs to the playlist in the background, by chunks'''
+
+    def __init__(self, kodi_params, song_ids, chunk_size=FEED_CHUNK_SIZE):
+        self.kodi_params = kodi_params
+        self.song_ids = song_ids
+        self.chunk_size = chunk_size
+        self.nb_added = 0
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.feed)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def feed(self):
+        logger.debug('call feed of %i songs', len(self.song_ids))
+        for start in range(0, len(self.song_ids), self.chunk_size):
+            # checked between the chunks, a chunk is never cut
+            if self.cancelled.is_set():
+                logger.info('playlist feed cancelled after %i songs',
+                        self.nb_added)
+                return
+            chunk = self.song_ids[start:start + self.chunk_size]
+            batch = kodi_api.Batch(self.kodi_params, self.chunk_size)
+            for song_id in chunk:
+                batch.add(kodi_api.playlist_add_command(SONG, song_id))
+            try:
+                responses = batch.send()
+                for ret in responses.values():
+                    kodi_api.display_result(ret)
+            except Exception:
+                # connection lost, timeout or unexpected response
+                logger.exception('playlist feed stopped after %i songs',
+                        self.nb_added)
+                return
+            self.nb_added += len(chunk)
+        logger.info('%i songs added to the playlist', self.nb_added)
+
+    def cancel(self):
+        '''Stop adding songs, return once the current chunk is sent'''
+        self.cancelled.set()
+        self.thread.join()
+
+    def wait(self):
+        '''Return once all the songs are added'''
+        while self.thread.is_alive():
+            self.thread.join(LIBRARY_WAIT_DELAY)
+
+def stop_playlist_feeder(obj):
+    '''Cancel the songs still to be added by the previous playlist'''
+    logger.debug('call function stop_playlist_feeder')
+    if obj.playlist_feeder is not None:
+        obj.playlist_feeder.cancel()
+        obj.playlist_feeder = None
+
+def play_songs(obj, song_ids):
+    '''Play the first song at once, add the others in the background'''
+    logger.debug('call function play_songs')
+    if not song_ids:
+        logger.error('no songs to play')
+        return
+    stop_playlist_feeder(obj)
+    kodi_api.playlist_clear(obj.kodi_params)
+    kodi_api.playlist_add(SONG, song_ids[0], obj.kodi_params)
+    kodi_api.player_open(obj.kodi_params)
     print
-    print "Populating the playlist... "
-    for song_id in song_ids:
-        kodi_api.playlist_add(SONG, song_id, kodi_params)
+    if len(song_ids) > 1:
+        print "Playing, %i songs added in the background... " % (
+                len(song_ids) - 1)
+        obj.playlist_feeder = PlaylistFeeder(obj.kodi_params, song_ids[1:])
     print "   ... let's rock the house!"
 
+def load_library_background(obj):
+    '''Load the library in a thread, the prompt is available meanwhile'''
+    logger.debug('call function load_library_background')
+    def load():
+        try:
+            get_audio_library(obj)
+        except BaseException as e:
+            # IOError for a failed download, exit() for an empty library
+            logger.error('the library could not be loaded: %s', e)
+            obj.library_error = e
+        obj.library_ready.set()
+    loader = threading.Thread(target=load)
+    loader.daemon = True
+    loader.start()
+
+def wait_library(obj):
+    '''Wait for the library, return false if it could not be loaded'''
+    while not obj.library_ready.wait(LIBRARY_WAIT_DELAY):
+        fancy_disp.library_loading(obj.library_progress)
+    return obj.library_error is None
+
+def needs_library(method):
+    '''Decorator of the commands using the local library'''
+    @functools.wraps(method)
+    def wrapper(self, line):
+        if not wait_library(self):
+            fancy_disp.library_unavailable()
+            return
+        return method(self, line)
+    wrapper.needs_library = True
+    return wrapper
+
+def command_needs_library(obj, line):
+    '''True if the command line uses the local library'''
+    args = line.split()
+    if not args:
+        return False
+    method = getattr(obj, 'do_' + args[0], None)
+    return getattr(method, 'needs_library', False)
+
 # process return messages
 
 class KodiRemote(cmd.Cmd):
@@ -606,8 +1088,20 @@ class KodiRemote(cmd.Cmd):
         self.songs = {}
         self.nb_albums = 0
         self.albums = {}
-        # fill data
-        get_audio_library(self)
+        self.songs_index = None
+        self.albums_index = None
+        self.genres_index = None
+        self.library_ready = threading.Event()
+        self.library_error = None
+        self.library_progress = {}
+        self.playlist_feeder = None
+        # built on the first playlist, dropped when the library changes
+        self.recommender = None
+        # fill data, the commands using it wait for it
+        if self.command and not command_needs_library(self, self.command):
+            logger.info('one-shot command, the library is not loaded')
+        else:
+            load_library_background(self)
         cmd.Cmd.__init__(self)
         
     '''Subclass of the cmd class'''
@@ -618,6 +1112,10 @@ class KodiRemote(cmd.Cmd):
             logger.info("Executing custom command")
             self.onecmd(self.command)                
             #TODO find out how to detect errors.
+            if self.playlist_feeder is not None:
+                # the songs would not be added after the exit
+                self.playlist_feeder.wait()
+            save_api_stats(self.kodi_params)
             quit()
         else:
             # customize prompt
@@ -627,6 +1125,7 @@ class KodiRemote(cmd.Cmd):
 
     # albums functions
 
+    @needs_library
     def do_albums_random(self, line):
         '''
         Display a random selection of albums
@@ -636,6 +1135,7 @@ class KodiRemote(cmd.Cmd):
         albums_pos = random.sample(xrange(self.nb_albums), DISPLAY_NB_LINES)
         fancy_disp.albums_index(albums_pos, self.albums)
 
+    @needs_library
     def do_albums_page(self, line):
         '''
         Display a given page of the albums library
@@ -658,6 +1158,7 @@ class KodiRemote(cmd.Cmd):
         logger.debug('albums id range: %s', album_ids)
         fancy_disp.albums_index(album_ids, self.albums)
 
+    @needs_library
     def do_albums_recent(self, line):
         '''
         Display recently added albums
@@ -669,6 +1170,7 @@ class KodiRemote(cmd.Cmd):
                 self.nb_albums + 1)
         fancy_disp.albums_index(albums_pos, self.albums)
 
+    @needs_library
     def do_albums_search(self, line):
         '''
         Search into the albums
@@ -678,11 +1180,13 @@ class KodiRemote(cmd.Cmd):
         logger.debug('call function do_albums_search')
         search_string = line.lower()
         #TODO: general refactor to album_ids (pos should not be used)
-        albums_pos = get_albums_search(search_string, self.albums)
+        albums_pos = get_albums_search(
+                search_string, self.albums, self.albums_index)
         fancy_disp.albums_index(albums_pos, self.albums)
 
     # songs functions
     
+    @needs_library
     def do_songs_page(self, line):
         '''
         Display a given page of the songs library
@@ -699,6 +1203,7 @@ class KodiRemote(cmd.Cmd):
                 page_nb * DISPLAY_NB_LINES + 1)
         fancy_disp.songs_index(songs_pos, self.songs)
 
+    @needs_library
     def do_songs_display(self, line):
         '''
         Display details for a given song
@@ -710,6 +1215,7 @@ class KodiRemote(cmd.Cmd):
         song_id = parse_single_int(line)
         fancy_disp.songs_details(song_id, self.songs)
     
+    @needs_library
     def do_songs_search(self, line):
         '''
         Search into the songs
@@ -718,33 +1224,67 @@ class KodiRemote(cmd.Cmd):
         '''
         logger.debug('call function do_songs_search')
         search_string = line.lower()
-        songs_pos = get_songs_search(search_string, self.songs)
+        songs_pos = get_songs_search(
+                search_string, self.songs, self.songs_index)
         fancy_disp.songs_index(songs_pos, self.songs)
 
+    @needs_library
     def do_songs_sync(self, line):
         '''
         Sync playcount and rating
-        Usage: songs_sync
+        Usage: songs_sync [full]
             Sync playcount and rating from the Kodi server to PyKodi.
+            Only the songs played since the last sync are downloaded,
+            use full to download all songs (for the rating changes).
         '''
         logger.debug('call function do_songs_sync')
-        set_songs_sync(self.kodi_params, self.songs)
+        try:
+            set_songs_sync(
+                    self.kodi_params, self.songs, line.strip() == 'full')
+        except IOError as e:
+            logger.error('songs not synced: %s', e)
+        self.recommender = None
     
+    @needs_library
+    def do_songs_refresh(self, line):
+        '''
+        Update the local library
+        Usage: songs_refresh
+            Download the songs and albums added to the Kodi server since
+            the last update and remove the deleted ones.
+        '''
+        logger.debug('call function do_songs_refresh')
+        try:
+            counts = refresh_audio_library(self)
+        except IOError as e:
+            logger.error('library not refreshed: %s', e)
+            return
+        self.recommender = None
+        fancy_disp.library_refresh(*counts)
+
     # playlist functions
 
+    @needs_library
     def do_playlist_show(self, line):
         '''
         Show the current audio playlist
         Usage: playlist_show
         '''
         logger.debug('call function do_playlist_show')
-        if kodi_api.player_get_active(self.kodi_params):
-            properties = kodi_api.player_get_properties(self.kodi_params)
+        batch = kodi_api.Batch(self.kodi_params)
+        active_id = batch.add(kodi_api.player_get_active_command())
+        properties_id = batch.add(kodi_api.player_get_properties_command())
+        items_id = batch.add(kodi_api.playlist_get_items_command())
+        rets = batch.send()
+        if kodi_api.player_get_active_result(rets[active_id]):
+            properties = kodi_api.player_get_properties_result(
+                    rets[properties_id])
         else:
             properties = None
-        song_ids = kodi_api.playlist_get_items(self.kodi_params)
+        song_ids = kodi_api.playlist_get_items_result(rets[items_id])
         fancy_disp.playlist(properties, song_ids, self.songs)
 
+    @needs_library
     def do_playlist_add(self, line):
         '''
         Add an album to the playlist
@@ -771,58 +1311,69 @@ class KodiRemote(cmd.Cmd):
             Remove all items from the current playlist.
         '''
         logger.debug('call function do_playlist_clear')
+        stop_playlist_feeder(self)
         kodi_api.playlist_clear(self.kodi_params)
 
+    @needs_library
     def do_playlist_tasteprofile(self, line):
         '''
-        Create a playlist from echonest taste profile
+        Create a playlist from the taste profile
         Usage: playlist_tasteprofile
             Generate and play a new playlist based on
-            echonest taste profile. The current playlist
-            is removed before.
+            the best rated and most played songs. The
+            current playlist is removed before.
         '''
         logger.debug('call function do_playlist_tasteprofile')
-        profile_id = get_profile_id(self.api_key)
+        recommender = get_recommender(self)
         while True:
-            song_ids = echonest_playlist(self.api_key, profile_id)
+            song_ids = recommender.profile_playlist()
+            if not song_ids:
+                # nothing rated, played or similar enough
+                logger.error('no songs found for the playlist')
+                return
             fancy_disp.songs_index(song_ids, self.songs)
             action = fancy_disp.validate_playlist()
             if action <> 'r':
                 break
         if action == 'p':
             playback_stop(self.kodi_params)
-            kodi_api.playlist_clear(self.kodi_params)
-            populate_playlist(song_ids, self.kodi_params) 
-            kodi_api.player_open(self.kodi_params)
+            play_songs(self, song_ids)
         print
 
+    @needs_library
     def do_playlist_taste_seed(self, line):
         '''
-        Create a playlist from echonest taste profile and seeded by a song
-        Usage: playlist_tasteprofile song_id
-            Generate and play a new playlist based on
-            echonest taste profile. The current playlist
+        Create a playlist seeded by a song
+        Usage: playlist_taste_seed song_id
+            Generate and play a new playlist of songs
+            similar to the seed song. The current playlist
             is removed before.
         '''
         #TODO: function for a single logic and several pl methods
-        logger.debug('call function do_playlist_tasteprofile')
+        logger.debug('call function do_playlist_taste_seed')
         song_id = parse_single_int(line)
-        profile_id = get_profile_id(self.api_key)
+        recommender = get_recommender(self)
+        if song_id not in recommender:
+            logger.error('song %s not found in the library', song_id)
+            return
         while True:
-            song_ids = echonest_pl_seed(self.api_key, profile_id, song_id)
+            song_ids = recommender.seed_playlist(song_id)
+            if not song_ids:
+                # nothing rated, played or similar enough
+                logger.error('no songs found for the playlist')
+                return
             fancy_disp.songs_index(song_ids, self.songs)
             action = fancy_disp.validate_playlist()
             if action <> 'r':
                 break
         if action == 'p':
             playback_stop(self.kodi_params)
-            kodi_api.playlist_clear(self.kodi_params)
-            populate_playlist(song_ids, self.kodi_params) 
-            kodi_api.player_open(self.kodi_params)
+            play_songs(self, song_ids)
         print
 
     # play functions
 
+    @needs_library
     def do_play_album(self, line):
         '''
         Play a single album
@@ -838,6 +1389,7 @@ class KodiRemote(cmd.Cmd):
             album_index = random.randrange(self.nb_albums)
             logger.debug('random album index: %i', album_index)
             album_id = self.albums.keys()[album_index]
+        stop_playlist_feeder(self)
         kodi_api.playlist_clear(self.kodi_params)
         kodi_api.playlist_add(ALBUM, album_id, self.kodi_params)
         kodi_api.player_open(self.kodi_params)
@@ -851,6 +1403,7 @@ class KodiRemote(cmd.Cmd):
         Usage: play_party
         '''
         logger.debug('call function do_play_party')
+        stop_playlist_feeder(self)
         kodi_api.player_open_party(self.kodi_params)
 
     def do_play_pause(self, line):
@@ -877,12 +1430,19 @@ class KodiRemote(cmd.Cmd):
         Usage: play_what
         '''
         logger.debug('call function do_play_what')
-        item = kodi_api.player_get_item(self.kodi_params)
-        properties = kodi_api.player_get_properties(self.kodi_params)
-        items = kodi_api.playlist_get_items(self.kodi_params)
+        batch = kodi_api.Batch(self.kodi_params)
+        item_id = batch.add(kodi_api.player_get_item_command())
+        properties_id = batch.add(kodi_api.player_get_properties_command())
+        items_id = batch.add(kodi_api.playlist_get_items_command())
+        rets = batch.send()
+        item = kodi_api.player_get_item_result(rets[item_id])
+        properties = kodi_api.player_get_properties_result(
+                rets[properties_id])
+        items = kodi_api.playlist_get_items_result(rets[items_id])
         fancy_disp.now_playing(item, properties)
         fancy_disp.next_playing(properties, items)
 
+    @needs_library
     def do_play_favorite(self, line):
         '''
         Like the current song (in your echonest tasteprofile)
@@ -890,12 +1450,12 @@ class KodiRemote(cmd.Cmd):
         '''
         logger.debug('call function do_play_favorite')
         song_id = kodi_api.player_get_item(self.kodi_params)
-        profile_id = get_profile_id(self.api_key)
-        en_api.echonest_favorite(self.api_key, profile_id, song_id)
+        call_with_profile(self.api_key, en_api.echonest_favorite, song_id)
         print
         fancy_disp.favorite(song_id, self.songs)
         print
     
+    @needs_library
     def do_play_skip(self, line):
         '''
         Skip the current song
@@ -903,13 +1463,13 @@ class KodiRemote(cmd.Cmd):
         '''
         logger.debug('call function do_play_skip')
         song_id = kodi_api.player_get_item(self.kodi_params)
-        profile_id = get_profile_id(self.api_key)
         kodi_api.player_goto(self.kodi_params)
-        en_api.echonest_skip(self.api_key, profile_id, song_id)
+        call_with_profile(self.api_key, en_api.echonest_skip, song_id)
         print
         fancy_disp.skip(song_id, self.songs)
         print
         
+    @needs_library
     def do_play_genre(self,line):
         '''
         Start playing songs from specific genre. 
@@ -917,23 +1477,33 @@ class KodiRemote(cmd.Cmd):
             The library is search for all songs with playlist is shuffled each time
         '''
         logger.debug('call function do_play_genre')
-        song_ids=get_genre_search(line, self.songs)
+        song_ids=get_genre_search(line, self.songs, self.genres_index)
         if len(song_ids) >= 1:
             #Listening to the same sequence is bornig, so shuffle the list each time. 
             random.shuffle(song_ids)
             #TODO check if result is empty and is really a list
-            kodi_api.playlist_clear(self.kodi_params)
-            #First add only one song and start playback
-            kodi_api.playlist_add(SONG, song_ids[0], self.kodi_params)
-            kodi_api.player_open(self.kodi_params)
-            #Adding the other songs takes very long
-            if len(song_ids)>=2:
-                populate_playlist(song_ids[1:-1],self.kodi_params)
-            else:
+            #First add only one song and start playback, the others follow
+            play_songs(self, song_ids)
+            if len(song_ids) == 1:
                 logger.info("Genre %s has only one song", line)
         else:
             logger.error("Genre %s has no songs", line)
 
+    @needs_library
+    def do_genres(self, line):
+        '''
+        List the genres of the library
+        Usage: genres
+            Display all genres with their number of songs, use one of them
+            with play_genre.
+        '''
+        logger.debug('call function do_genres')
+        if isinstance(self.songs, library_db.DbTable):
+            counts = library_db.genre_counts(self.songs)
+        else:
+            counts = self.genres_index.counts()
+        fancy_disp.genres(counts)
+
     # volume control
     def do_volume(self,percent):
        '''
@@ -949,23 +1519,36 @@ class KodiRemote(cmd.Cmd):
 
     # echonest functions
 
+    @needs_library
     def do_echonest_sync(self, line):
         '''
         Sync play count and rating with echonest taste profile
         Usage: echonest_sync
         '''
         logger.debug('call function do_echonest_sync')
-        profile_id = get_profile_id(self.api_key)
-        echonest_sync(self.api_key, profile_id, self.songs)
-        
+        call_with_profile(self.api_key, echonest_sync, self.songs)
+
+    @needs_library
+    def do_echonest_status(self, line):
+        '''
+        Display the songs waiting for the echonest sync
+        Usage: echonest_status
+            Number of songs with a rating or play count not yet pushed to
+            the taste profile, and date of the last songs sync.
+        '''
+        logger.debug('call function do_echonest_status')
+        fancy_disp.sync_status(
+                len(get_profile_delta(self.songs)),
+                load_sync_state().get('lastplayed'))
+        fancy_disp.echonest_calls(en_api.call_stats())
+
     def do_echonest_info(self, line):
         '''
         Display info about the echonest taste profile.
         Usage: echonest_info
         '''
         logger.debug('call function do_echonest_info')
-        profile_id = get_profile_id(self.api_key)
-        en_info = en_api.echonest_info(self.api_key, profile_id)
+        en_info = call_with_profile(self.api_key, en_api.echonest_info)
         #TODO: create disp function
         print
         print en_info
@@ -977,9 +1560,9 @@ class KodiRemote(cmd.Cmd):
         Usage: echonest_read item_id
         '''
         logger.debug('call function do_echonest_info')
-        profile_id = get_profile_id(self.api_key)
         item_id = parse_single_int(line)
-        song_data = en_api.echonest_read(self.api_key, profile_id, item_id)
+        song_data = call_with_profile(
+                self.api_key, en_api.echonest_read, item_id)
         print
         fancy_disp.echonest_read(song_data)
         print
@@ -994,7 +1577,9 @@ class KodiRemote(cmd.Cmd):
         if fancy_disp.sure_delete_tasteprofile(self.api_key, profile_id):
         #TODO: insert a validation prompt
             en_api.echonest_delete(self.api_key, profile_id)
+            forget_profile_id(self.api_key)
 
+    @needs_library
     def do_debug_kavod(self, line):
         '''
         Special debug function for Kavod library.
@@ -1019,9 +1604,38 @@ class KodiRemote(cmd.Cmd):
                 self.albums[album_id]['artist'])
         print
 
+    # server functions
+
+    def do_server_connections(self, line):
+        '''
+        Display the connections usage with the Kodi server
+        Usage: server_connections
+            Number of connections opened and reused by the transport.
+        '''
+        logger.debug('call function do_server_connections')
+        (opened, reused) = kodi_api.connection_stats(self.kodi_params)
+        fancy_disp.connections(opened, reused)
+
+    def do_stats(self, line):
+        '''
+        Display the statistics of the API calls
+        Usage: stats
+            Calls, errors, retries, bytes and latency percentiles of each
+            Kodi and echonest method in this session.
+        '''
+        logger.debug('call function do_stats')
+        fancy_disp.api_stats(api_stats.summary())
+
     def do_EOF(self, line):
         '''Override end of file'''
         logger.info('Bye!')
+        logger.info('connections opened / reused: %i / %i',
+                *kodi_api.connection_stats(self.kodi_params))
+        logger.info('echonest calls: %s', en_api.call_stats())
+        cache = kodi_api.response_cache(self.kodi_params)
+        logger.info('response cache hits / misses: %i / %i',
+                cache.hits, cache.misses)
+        save_api_stats(self.kodi_params)
         print 'Bye!'
         return True
 
@@ -0,0 +1,43 @@
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''Fixtures of the tests, a mock Kodi server on free local ports'''
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import pytest
+import mock_kodi
+
+NB_SONGS = 1000
+
+@pytest.fixture
+def library():
+    return mock_kodi.Library(NB_SONGS, seed=1)
+
+@pytest.fixture
+def mock(library):
+    '''Mock server sending its answers in small TCP writes'''
+    server = mock_kodi.MockKodi(library, mock_kodi.Faults(split=7, seed=1))
+    server.start(0, 0)
+    yield server
+    server.stop()
+
+@pytest.fixture
+def server_params(mock):
+    '''Parameters of the TCP transport to the mock server'''
+    return {
+        'tcp': True,
+        'ip': '127.0.0.1',
+        'port': mock.servers[1].server_address[1],
+        'user': None,
+        'password': None,
+        'pool_size': 4,
+        'database': None}
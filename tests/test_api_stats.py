@@ -0,0 +1,23 @@
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''Tests of the statistics of the API calls'''
+
+import api_stats
+
+def test_percentile_error():
+    for value in (0.00015, 0.001, 0.0123, 0.2, 1.7, 30.0):
+        histogram = api_stats.Histogram()
+        histogram.add(value)
+        assert abs(histogram.percentile(50) / value - 1) < 0.1
+
+def test_percentile_rank():
+    histogram = api_stats.Histogram()
+    for value in range(1, 101):
+        histogram.add(value / 100.0)
+    assert abs(histogram.percentile(50) / 0.5 - 1) < 0.1
+    assert abs(histogram.percentile(99) / 0.99 - 1) < 0.1
+    assert api_stats.Histogram().percentile(50) is None
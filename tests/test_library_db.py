@@ -0,0 +1,52 @@
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''Tests of the SQLite store of the library'''
+
+import library_db
+import library_recommend
+
+def song(song_id):
+    return {'title': u'song %i' % song_id,
+            'artist': u'artist %i' % (song_id % 7),
+            'year': 1990 + song_id % 20, 'rating': song_id % 6,
+            'playcount': song_id % 4, 'musicbrainztrackid': u'',
+            'genre': [u'rock', u'pop'][:1 + song_id % 2],
+            'rating_en': 0, 'playcount_en': 0}
+
+def test_column_values(tmpdir):
+    conn = library_db.open_db(str(tmpdir.join('library.db')))
+    songs = library_db.DbTable(conn, 'songs')
+    for song_id in range(1, 51):
+        songs[song_id] = song(song_id)
+    songs.flush()
+    songs[60] = song(60)
+    songs[3]['title'] = u'changed'
+    del songs[4]
+    for name in library_db.SONG_COLUMNS:
+        values = songs.column_values(name)
+        assert sorted(values) == songs.keys()
+        for song_id in songs.keys():
+            value = songs[song_id][name]
+            if name == 'genre':
+                # lists read from the database, tuples in the records
+                assert list(values[song_id]) == list(value)
+            else:
+                assert values[song_id] == value
+    assert songs.column_values('title')[3] == u'changed'
+
+def test_recommender(tmpdir):
+    conn = library_db.open_db(str(tmpdir.join('library.db')))
+    songs = library_db.DbTable(conn, 'songs')
+    records = {}
+    for song_id in range(1, 101):
+        records[song_id] = songs[song_id] = song(song_id)
+    songs.flush()
+    from_db = library_recommend.build_recommender(songs)
+    from_dict = library_recommend.build_recommender(records)
+    assert list(from_db.song_ids) == list(from_dict.song_ids)
+    assert from_db.song_features == from_dict.song_features
+    assert list(from_db.priors) == list(from_dict.priors)
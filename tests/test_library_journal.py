@@ -0,0 +1,36 @@
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''Tests of the journal of the library changes'''
+
+import library_journal
+
+def test_torn_write(tmpdir):
+    fname = str(tmpdir.join('songs.journal'))
+    journal = library_journal.Journal(fname)
+    journal.append([(1, {u'rating': 1})])
+    # a write interrupted by a crash
+    f = open(fname, 'ab')
+    f.write(b'[2, {"rati')
+    f.close()
+    journal = library_journal.Journal(fname)
+    journal.append([(3, {u'rating': 3}), (4, None)])
+    assert list(journal.entries()) == [
+            (1, {u'rating': 1}), (3, {u'rating': 3}), (4, None)]
+    assert journal.nb_entries == 3
+
+def test_torn_rotated(tmpdir):
+    fname = str(tmpdir.join('songs.journal'))
+    journal = library_journal.Journal(fname)
+    journal.append([(1, {u'rating': 1})])
+    journal.rotate()
+    # a compaction interrupted by a crash during a write
+    f = open(journal.rotated_fname, 'ab')
+    f.write(b'[2, {"rati')
+    f.close()
+    journal.append([(3, None)])
+    journal.rotate()
+    assert list(journal.entries()) == [(1, {u'rating': 1}), (3, None)]
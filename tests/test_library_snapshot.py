@@ -0,0 +1,63 @@
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''Tests of the memory-mapped library snapshots'''
+
+import os
+
+import library_snapshot
+
+def album(title):
+    return {'title': title, 'artist': u'artist', 'year': 2000}
+
+def open_table(fname):
+    return library_snapshot.SnapshotTable(fname,
+            library_snapshot.ALBUM_COLUMNS, library_snapshot.SnapshotAlbum)
+
+def test_keys(tmpdir):
+    fname = str(tmpdir.join('albums.snapshot'))
+    library_snapshot.create_snapshot(fname,
+            dict((i, album(u'album %i' % i)) for i in (2, 4, 6)),
+            library_snapshot.ALBUM_COLUMNS)
+    table = open_table(fname)
+    assert table.keys() == [2, 4, 6]
+    table[5] = album(u'new')
+    table[4]['title'] = u'changed'
+    del table[2]
+    assert table.keys() == [4, 5, 6]
+    assert len(table) == 3
+    table.flush()
+    table = open_table(fname)
+    assert table.keys() == [4, 5, 6]
+    assert table[4]['title'] == u'changed'
+    table.compact()
+    assert table.keys() == [4, 5, 6]
+    assert not os.path.exists(fname + '.tmp')
+
+def test_replace(tmpdir):
+    fname = str(tmpdir.join('albums.snapshot'))
+    for title in (u'first', u'second'):
+        library_snapshot.write_snapshot(fname, {1: album(title)},
+                library_snapshot.ALBUM_COLUMNS)
+    assert open_table(fname)[1]['title'] == u'second'
+
+def test_dirty(tmpdir):
+    fname = str(tmpdir.join('songs.snapshot'))
+    songs = {}
+    for song_id in range(1, 11):
+        songs[song_id] = {'title': u'song', 'genre': [u'rock'],
+                'rating': song_id % 3, 'rating_en': 0,
+                'playcount': 0, 'playcount_en': 0}
+    library_snapshot.create_snapshot(fname, songs,
+            library_snapshot.SONG_COLUMNS)
+    snapshot = library_snapshot.Snapshot(fname)
+    assert list(snapshot.dirty) == [1, 2, 4, 5, 7, 8, 10]
+    snapshot.close()
+    table = library_snapshot.SnapshotTable(fname,
+            library_snapshot.SONG_COLUMNS, library_snapshot.SnapshotSong)
+    table[1]['rating_en'] = 1
+    table[3]['playcount'] = 2
+    assert sorted(table.dirty) == [2, 3, 4, 5, 7, 8, 10]
@@ -0,0 +1,232 @@
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''Tests of the Kodi API functions against the mock server'''
+
+import json
+import socket
+
+import pytest
+
+import kodi_api
+import kodi_async
+import mock_kodi
+
+class ChunkSocket(object):
+    '''Socket stand-in receiving the data in the given chunks'''
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+def read_all(framer, sock):
+    messages = []
+    while sock.chunks:
+        framer.fill(sock)
+        while True:
+            message = framer.next_message()
+            if message is None:
+                break
+            messages.append(message)
+    return messages
+
+def songs_command(start, end, sort=None):
+    return kodi_api.audiolibrary_get_songs_command([], start, end, sort)
+
+def test_framer_split_reads():
+    sent = [
+        {'id': 1, 'result': {'title': u'a } tricky " title {'}},
+        [{'id': 2, 'result': u'back\\slash'}, {'id': 3, 'result': []}],
+        {'method': 'Player.OnPlay', 'params': {'data': None}}]
+    data = b''.join(json.dumps(message).encode('utf-8') for message in sent)
+    # every split position, down to a byte at a time
+    for size in (1, 2, 3, 7, len(data)):
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        framer = kodi_api.JsonFramer()
+        assert read_all(framer, ChunkSocket(chunks)) == sent
+
+def test_framer_shrinks():
+    large = {'id': 1, 'result': u'x' * 10 * kodi_api.BUFFER_SIZE}
+    data = json.dumps(large).encode('utf-8')
+    chunks = [data[i:i + 4096] for i in range(0, len(data), 4096)]
+    framer = kodi_api.JsonFramer()
+    assert read_all(framer, ChunkSocket(chunks)) == [large]
+    assert len(framer.buffer) == kodi_api.BUFFER_SIZE
+
+def test_call_round_trip(server_params):
+    ret = kodi_api.call_api(server_params, songs_command(0, 5))
+    assert ret['result']['limits']['total'] == 1000
+    assert [s['songid'] for s in ret['result']['songs']] == [1, 2, 3, 4, 5]
+
+def test_batch_round_trip(server_params):
+    batch = kodi_api.Batch(server_params, size=3)
+    ids = [batch.add(songs_command(start, start + 2))
+            for start in range(0, 20, 2)]
+    responses = batch.send()
+    assert sorted(responses) == sorted(ids)
+    for start, request_id in zip(range(0, 20, 2), ids):
+        songs = responses[request_id]['result']['songs']
+        assert [s['songid'] for s in songs] == [start + 1, start + 2]
+
+def test_batch_error_responses(server_params):
+    batch = kodi_api.Batch(server_params)
+    request_id = batch.add({"jsonrpc": "2.0", "method": "Unknown.Method"})
+    assert 'error' in batch.send()[request_id]
+
+def test_paging(library):
+    library.remove_song(3)
+    library.remove_song(10)
+    all_ids = [i for i in range(1, 1001) if i not in (3, 10)]
+    for sort, expected in (
+            (None, all_ids),
+            ({'method': 'dateadded', 'order': 'descending'}, all_ids[::-1])):
+        pages = []
+        for start in range(0, 1000, 64):
+            ret = library.get_songs({'sort': sort,
+                'limits': {'start': start, 'end': start + 64}})
+            assert ret['limits']['total'] == 998
+            pages.extend(s['songid'] for s in ret['songs'])
+        assert pages == expected
+
+def test_paging_sorted(library):
+    library.play(500)
+    sort = {'method': 'lastplayed', 'order': 'descending'}
+    ret = library.get_songs({'sort': sort, 'limits': {'start': 0, 'end': 3}})
+    assert ret['songs'][0]['songid'] == 500
+    ret = library.get_songs({'sort': sort,
+        'limits': {'start': 990, 'end': 1000}})
+    assert len(ret['songs']) == 10
+
+def test_fetch_pages(server_params):
+    client = kodi_async.kodi_client(server_params)
+    pager = kodi_async.AdaptivePager(1000, 50)
+    song_ids = []
+    nb_items, elapsed = kodi_async.fetch_pages(
+            client,
+            lambda start, end: kodi_api.audiolibrary_get_songs_command(
+                ['title'], start, end),
+            'songs', pager,
+            lambda songs: song_ids.extend(s['songid'] for s in songs))
+    client.close()
+    assert nb_items == 1000
+    assert sorted(song_ids) == range(1, 1001)
+
+def test_cache_invalidation(server_params):
+    cache = kodi_api.response_cache(server_params)
+    command = {"jsonrpc": "2.0", "method": "Playlist.GetItems",
+            "params": {"playlistid": 0}}
+    kodi_api.call_api(server_params, dict(command))
+    ret = kodi_api.call_api(server_params, dict(command))
+    assert cache.hits == 1
+    # the cached response is not shared with its callers
+    ret['result']['items'] = None
+    assert kodi_api.call_api(server_params, dict(command)) != ret
+    kodi_api.call_api(server_params, {"jsonrpc": "2.0",
+        "method": "Playlist.Remove",
+        "params": {"playlistid": 0, "position": 0}})
+    assert cache.get(dict(command)) is None
+
+def test_no_resend(server_params):
+    play_pause = {"jsonrpc": "2.0", "method": "Player.PlayPause",
+            "params": {"playerid": 0}}
+    conn = kodi_api.tcp_connection(server_params)
+    conn.connect()
+    conn.sock.shutdown(socket.SHUT_RDWR)
+    # the command may have been received, it is not sent twice
+    with pytest.raises(socket.error):
+        kodi_api.call_api(server_params, dict(play_pause))
+    assert conn.sock is None
+    conn.connect()
+    conn.sock.shutdown(socket.SHUT_RDWR)
+    # a read-only command is sent again on a new connection
+    ret = kodi_api.call_api(server_params, songs_command(0, 1))
+    assert ret['result']['songs'][0]['songid'] == 1
+
+def test_is_mutating():
+    for method in ('Playlist.Remove', 'Playlist.Swap', 'Player.Seek',
+            'Player.Move', 'Player.Open'):
+        assert kodi_api.is_mutating({'method': method})
+    for method in ('Playlist.GetItems', 'Player.GetProperties',
+            'Playlist.GetPlaylists', 'AudioLibrary.SetSongDetails'):
+        assert not kodi_api.is_mutating({'method': method})
+
+def test_fetch_pages_errors(library):
+    server = mock_kodi.MockKodi(library,
+            mock_kodi.Faults(error_rate=0.2, seed=1))
+    server.start(0, 0)
+    params = {'tcp': True, 'ip': '127.0.0.1',
+            'port': server.servers[1].server_address[1], 'user': None,
+            'password': None, 'pool_size': 4, 'database': None}
+    client = kodi_async.kodi_client(params)
+    song_ids = []
+    try:
+        nb_items, elapsed = kodi_async.fetch_pages(
+                client,
+                lambda start, end: kodi_api.audiolibrary_get_songs_command(
+                    ['title'], start, end),
+                'songs', kodi_async.AdaptivePager(1000, 50),
+                lambda songs: song_ids.extend(s['songid'] for s in songs))
+    finally:
+        client.close()
+        server.stop()
+    assert sorted(song_ids) == range(1, 1001)
+
+def test_failed_page_split(library):
+    class FailingClient(object):
+        '''Client failing the pages of more than 20 songs'''
+        max_in_flight = 2
+        def submit(self, command, callback):
+            limits = command['params']['limits']
+            if limits['end'] - limits['start'] > 20:
+                ret = {'id': 1, 'error': {'code': -32603, 'message': 'big'}}
+            else:
+                ret = {'id': 1, 'result': library.get_songs(
+                    command['params'])}
+            pending = kodi_async.Pending(command, callback)
+            pending.set_response(ret)
+            return pending
+    kodi_async.RETRY_DELAY, delay = 0.001, kodi_async.RETRY_DELAY
+    song_ids = []
+    try:
+        kodi_async.fetch_pages(
+                FailingClient(),
+                lambda start, end: kodi_api.audiolibrary_get_songs_command(
+                    [], start, end),
+                'songs', kodi_async.AdaptivePager(200, 80),
+                lambda songs: song_ids.extend(s['songid'] for s in songs))
+    finally:
+        kodi_async.RETRY_DELAY = delay
+    assert sorted(song_ids) == range(1, 201)
+
+def test_failed_download(library, monkeypatch):
+    import pykodi
+    server = mock_kodi.MockKodi(library, mock_kodi.Faults(error_rate=1.0))
+    server.start(0, 0)
+    params = {'tcp': True, 'ip': '127.0.0.1',
+            'port': server.servers[1].server_address[1], 'user': None,
+            'password': None, 'pool_size': 4, 'database': None}
+    monkeypatch.setattr(kodi_async, 'RETRY_DELAY', 0.001)
+    monkeypatch.setattr(pykodi, 'save_page_size', lambda *args: None)
+    merged = []
+    try:
+        # the error reaches the command, the session goes on
+        with pytest.raises(IOError):
+            pykodi.fetch_library_pages(
+                    params, 'Songs',
+                    lambda start, end:
+                        kodi_api.audiolibrary_get_songs_command(
+                            [], start, end),
+                    'songs', 100, 'songs', 50, merged.extend, {})
+    finally:
+        kodi_async.kodi_client(params).close()
+        server.stop()
+    assert merged == []
@@ -0,0 +1,47 @@
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+'''Tests of the library refresh against the mock server'''
+
+import pytest
+
+import pykodi
+
+class Remote(object):
+    '''Stand-in for the prompt object, which holds the library'''
+
+    def __init__(self, kodi_params):
+        self.kodi_params = kodi_params
+        self.songs = {}
+        self.albums = {}
+        self.songs_index = None
+        self.albums_index = None
+        self.genres_index = None
+        self.library_progress = {}
+
+def test_refresh(library, server_params, tmpdir, monkeypatch):
+    # the removed songs are found with a progress bar
+    pytest.importorskip('progressbar')
+    monkeypatch.chdir(tmpdir)
+    remote = Remote(server_params)
+    pykodi.get_audio_library(remote)
+    remote.songs[5]['rating_en'] = 3
+    assert remote.songs_index.search(u'brand new') == []
+    library.retag(5, {'title': u'Brand new title', 'genre': [u'Polka']})
+    library.add_songs(2)
+    library.remove_song(7)
+    counts = pykodi.refresh_audio_library(remote)
+    assert counts[:3] == (2, 1, 1)
+    assert counts[5] == 0
+    song = remote.songs[5]
+    assert song['title'] == u'Brand new title'
+    assert song['genre'] == (u'Polka',)
+    # not known by the server, kept
+    assert song['rating_en'] == 3
+    assert remote.songs_index.search(u'brand new') == [5]
+    assert remote.genres_index.search(u'polka') == [5]
+    assert 1002 in remote.songs and 7 not in remote.songs
+    assert pykodi.refresh_audio_library(remote) == (0, 0, 0, 0, 0, 0)